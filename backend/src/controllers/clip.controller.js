@@ -5,6 +5,23 @@ const clipStorageService = require('../services/clip-storage.service');
 // In-memory clip status storage (use database in production)
 const clipStatuses = new Map();
 
+/**
+ * Copy progress reported by the video processor into the clip status
+ */
+const updateProgress = (clipId, status) => {
+  const current = clipStatuses.get(clipId);
+  if (!current || current.status !== 'processing') {
+    return;
+  }
+
+  clipStatuses.set(clipId, {
+    ...current,
+    progress: status.progress || 0,
+    stage: status.stage,
+    eta: status.eta
+  });
+};
+
 /**
  * Create a clip from existing content
  */
@@ -60,7 +77,8 @@ exports.createClip = async (req, res, next) => {
       clipType,
       hashtags,
       startTime,
-      customCaption
+      customCaption,
+      onProgress: status => updateProgress(clipId, status)
     }).then(result => {
       clipStatuses.set(clipId, {
         clipId,
@@ -84,6 +102,93 @@ exports.createClip = async (req, res, next) => {
   }
 };
 
+/**
+ * Copy the per-clip results of a batch job into each clip's status
+ */
+const updateBatchClips = (status) => {
+  (status.clips || []).forEach(clip => {
+    const current = clipStatuses.get(clip.clipId);
+    if (!current || current.status !== 'processing') {
+      return;
+    }
+
+    if (clip.status === 'completed') {
+      clipStatuses.set(clip.clipId, {
+        clipId: clip.clipId,
+        status: 'completed',
+        progress: 100,
+        videoUrl: clip.videoUrl,
+        completedAt: new Date().toISOString()
+      });
+    } else {
+      updateProgress(clip.clipId, status);
+    }
+  });
+};
+
+/**
+ * Create several clips from the same content in one processor batch
+ */
+exports.createClips = async (req, res, next) => {
+  try {
+    const { contentId, clips } = req.body;
+
+    // Validate input
+    if (!contentId || !Array.isArray(clips) || clips.length === 0) {
+      return res.status(400).json({ error: 'Content ID and a list of clips are required' });
+    }
+
+    const maxLength = parseInt(process.env.MAX_CLIP_LENGTH || '180');
+    if (clips.some(clip => !clip.length || clip.length > maxLength)) {
+      return res.status(400).json({ error: 'Every clip needs a length within the maximum allowed' });
+    }
+
+    const batchId = uuidv4();
+    const specs = clips.map(clip => ({ ...clip, clipId: uuidv4() }));
+
+    specs.forEach(clip => {
+      clipStatuses.set(clip.clipId, {
+        clipId: clip.clipId,
+        status: 'processing',
+        progress: 0,
+        createdAt: new Date().toISOString()
+      });
+    });
+
+    res.json({
+      batchId,
+      clipIds: specs.map(clip => clip.clipId),
+      status: 'processing',
+      message: 'Clip batch creation started'
+    });
+
+    // Process the batch asynchronously; clips are marked completed as they finish
+    videoProcessorService.createClips({
+      batchId,
+      contentId,
+      clips: specs,
+      onProgress: updateBatchClips
+    }).then(results => {
+      updateBatchClips({ clips: results });
+    }).catch(error => {
+      console.error('Clip batch processing error:', error);
+      specs.forEach(clip => {
+        if (clipStatuses.get(clip.clipId).status === 'processing') {
+          clipStatuses.set(clip.clipId, {
+            clipId: clip.clipId,
+            status: 'failed',
+            error: error.message,
+            failedAt: new Date().toISOString()
+          });
+        }
+      });
+    });
+
+  } catch (error) {
+    next(error);
+  }
+};
+
 /**
  * Upload and process user's own video
  */
@@ -122,7 +227,8 @@ exports.uploadAndProcess = async (req, res, next) => {
       length: parseInt(length),
       addCaptions: addCaptions === 'true',
       hashtags: hashtags ? JSON.parse(hashtags) : [],
-      customText
+      customText,
+      onProgress: status => updateProgress(clipId, status)
     }).then(result => {
       clipStatuses.set(clipId, {
         clipId,
@@ -31,6 +31,9 @@ const upload = multer({
 // Create a new clip from content
 router.post('/create', clipController.createClip);
 
+// Create several clips from the same content in one batch
+router.post('/create-batch', clipController.createClips);
+
 // Upload user's own video for processing
 router.post('/upload', upload.single('video'), clipController.uploadAndProcess);
 
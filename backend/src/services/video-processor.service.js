@@ -1,8 +1,78 @@
 const axios = require('axios');
-const FormData = require('form-data');
 const fs = require('fs');
 
 const VIDEO_PROCESSOR_URL = process.env.VIDEO_PROCESSOR_URL || 'http://localhost:8000';
+const JOB_POLL_INTERVAL = 2000; // 2 seconds
+const JOB_TIMEOUT = 30 * 60 * 1000; // 30 minutes
+const UPLOAD_CHUNK_MULTIPLE = 8; // request bodies of 8 processor chunks
+const UPLOAD_RETRIES = 5;
+const JOB_POLL_RETRIES = 5; // consecutive failed polls before giving up on a job
+const JOB_POLL_MAX_BACKOFF = 60 * 1000;
+
+/**
+ * A failed poll is worth retrying unless the processor answered with a
+ * client error other than 429 (e.g. the job doesn't exist)
+ */
+const isTransient = (error) => {
+  const status = error.response && error.response.status;
+  return !status || status >= 500 || status === 429;
+};
+
+/**
+ * Wait before the next poll after a failure: the processor's Retry-After
+ * (seconds or an HTTP date) if it sent one, else exponential backoff
+ */
+const retryDelay = (error, failures) => {
+  const retryAfter = error.response && error.response.headers['retry-after'];
+  if (retryAfter) {
+    const delay = isNaN(retryAfter) ? Date.parse(retryAfter) - Date.now() : Number(retryAfter) * 1000;
+    if (!isNaN(delay)) {
+      return Math.max(delay, 0);
+    }
+  }
+  return Math.min(JOB_POLL_INTERVAL * 2 ** (failures - 1), JOB_POLL_MAX_BACKOFF);
+};
+
+/**
+ * Poll the processor until a queued job finishes.
+ * Failed polls are retried; only a failed or cancelled job, a client error,
+ * or JOB_POLL_RETRIES failures in a row end the wait early.
+ */
+const waitForJob = async (clipId, onProgress) => {
+  const deadline = Date.now() + JOB_TIMEOUT;
+  let failures = 0;
+
+  while (Date.now() < deadline) {
+    let status;
+    try {
+      status = await fetchStatus(clipId);
+      failures = 0;
+    } catch (error) {
+      if (!isTransient(error) || ++failures > JOB_POLL_RETRIES) {
+        console.error('Status check error:', error.message);
+        throw new Error('Failed to check processing status');
+      }
+      const delay = Math.min(retryDelay(error, failures), Math.max(deadline - Date.now(), 0));
+      console.warn(`Status check failed (${error.message}), retrying in ${delay}ms`);
+      await new Promise(resolve => setTimeout(resolve, delay));
+      continue;
+    }
+
+    if (status.status === 'completed') {
+      return status;
+    }
+    if (status.status === 'failed' || status.status === 'cancelled') {
+      throw new Error(status.error || `Processing ${status.status}`);
+    }
+    if (onProgress) {
+      onProgress(status);
+    }
+
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+  }
+
+  throw new Error('Timed out waiting for video processing');
+};
 
 /**
  * Create a clip from content
@@ -22,10 +92,10 @@ exports.createClip = async (options) => {
       startTime: options.startTime,
       customCaption: options.customCaption
     }, {
-      timeout: 600000 // 10 minutes timeout
+      timeout: 30000 // job is queued, result is polled below
     });
 
-    return response.data;
+    return await waitForJob(response.data.clipId, options.onProgress);
   } catch (error) {
     console.error('Video processor not available, using mock mode:', error.message);
     
@@ -41,46 +111,111 @@ exports.createClip = async (options) => {
   }
 };
 
+/**
+ * Create several clips from one piece of content in a single batch job
+ * The source is analysed and decoded once; the batch status lists each clip
+ * as it completes
+ */
+exports.createClips = async (options) => {
+  const response = await axios.post(`${VIDEO_PROCESSOR_URL}/process/batch-clips`, {
+    batchId: options.batchId,
+    contentId: options.contentId,
+    clips: options.clips.map(clip => ({
+      clipId: clip.clipId,
+      length: clip.length,
+      clipType: clip.clipType,
+      startTime: clip.startTime
+    }))
+  }, {
+    timeout: 30000 // job is queued, result is polled below
+  });
+
+  const status = await waitForJob(response.data.jobId, options.onProgress);
+  return status.clips;
+};
+
 /**
  * Process uploaded video
  */
 exports.processUploadedVideo = async (options) => {
   try {
-    const formData = new FormData();
-    formData.append('video', fs.createReadStream(options.videoPath));
-    formData.append('clipId', options.clipId);
-    formData.append('length', options.length);
-    formData.append('addCaptions', options.addCaptions);
-    formData.append('hashtags', JSON.stringify(options.hashtags));
-    formData.append('customText', options.customText || '');
+    const uploadId = await uploadVideo(options.videoPath);
 
     const response = await axios.post(
       `${VIDEO_PROCESSOR_URL}/process/uploaded-video`,
-      formData,
       {
-        headers: formData.getHeaders(),
-        maxContentLength: Infinity,
-        maxBodyLength: Infinity,
-        timeout: 600000 // 10 minutes
+        uploadId,
+        clipId: options.clipId,
+        length: options.length,
+        addCaptions: options.addCaptions,
+        hashtags: options.hashtags,
+        customText: options.customText || ''
       }
     );
 
-    return response.data;
+    return await waitForJob(response.data.clipId, options.onProgress);
   } catch (error) {
     console.error('Video processing error:', error.message);
     throw new Error('Failed to process uploaded video');
   }
 };
 
+/**
+ * Stream a file to the processor as a resumable upload, one chunk per request.
+ * A failed chunk is retried from the offset the processor reports.
+ */
+const uploadVideo = async (videoPath) => {
+  const { size } = await fs.promises.stat(videoPath);
+  const created = await axios.post(`${VIDEO_PROCESSOR_URL}/uploads`, { size });
+  const { uploadId } = created.data;
+  const chunkSize = created.data.chunkSize * UPLOAD_CHUNK_MULTIPLE;
+  const url = `${VIDEO_PROCESSOR_URL}/uploads/${uploadId}`;
+
+  let offset = 0;
+  let failures = 0;
+  while (offset < size) {
+    const end = Math.min(offset + chunkSize, size);
+    try {
+      const response = await axios.patch(url, fs.createReadStream(videoPath, { start: offset, end: end - 1 }), {
+        headers: {
+          'Content-Type': 'application/offset+octet-stream',
+          'Content-Length': end - offset,
+          'Upload-Offset': offset
+        },
+        maxBodyLength: Infinity,
+        timeout: 120000
+      });
+      offset = response.data.offset;
+      failures = 0;
+    } catch (error) {
+      if (++failures > UPLOAD_RETRIES) {
+        throw error;
+      }
+      // Resume from whatever the processor actually stored
+      const status = await axios.get(url);
+      offset = status.data.offset;
+    }
+  }
+
+  return uploadId;
+};
+
+/**
+ * Fetch a job's status, leaving errors to the caller
+ */
+const fetchStatus = async (clipId) => {
+  const response = await axios.get(`${VIDEO_PROCESSOR_URL}/process/status/${clipId}`, {
+    timeout: 30000
+  });
+  return response.data;
+};
+
 /**
  * Check processing status
  */
 exports.getProcessingStatus = async (clipId) => {
   try {
-    const response = await axios.get(
-      `${VIDEO_PROCESSOR_URL}/process/status/${clipId}`
-    );
-    return response.data;
+    return await fetchStatus(clipId);
   } catch (error) {
     console.error('Status check error:', error.message);
     throw new Error('Failed to check processing status');
@@ -1,10 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
+import tempfile
+import time
+import uuid
 from dotenv import load_dotenv
 from services.video_processor import VideoProcessor
 from services.caption_generator import CaptionGenerator
+from services.transcript_cache import TranscriptCache
 from services.clip_extractor import ClipExtractor
+from services.analysis_index import AnalysisIndex
+from services.media_probe import MediaProbe, ProbeError
+from services.output_cache import OutputCache, evict_lru
+from services.upload_store import UploadError, UploadStore
+from services.renditions import is_published_name
+from services.admission import (PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_SHORT, AdmissionController,
+                                CapacityError)
+from services.job_manager import JobManager, QueueFullError
+from services.encoding_profiles import LADDER, ProfilePolicy, load_calibration
+from services.job_store import create_job_store
+from services.metrics import (ADMISSION_REJECTIONS, BYTES_IN, BYTES_OUT, ENCODE_SLOTS_BUSY, QUEUE_DEPTH,
+                              RUNNING_JOBS, STARTUP_SECONDS, Tracer, render)
 import logging
 
 # Load environment variables
@@ -19,99 +35,294 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize services
-video_processor = VideoProcessor()
-caption_generator = CaptionGenerator()
-clip_extractor = ClipExtractor()
+PROBE_CACHE_DIR = os.getenv('PROBE_CACHE_DIR', './cache/probe')
+PROBE_CACHE_MAX_BYTES = int(os.getenv('PROBE_CACHE_MAX_MB', 64)) * 1024 * 1024
+PROBE_CACHE_MAX_AGE = int(os.getenv('PROBE_CACHE_MAX_AGE_DAYS', 30)) * 86400
+media_probe = MediaProbe(cache_dir=PROBE_CACHE_DIR)
+# Encode capacity of this node, shared by every process on it (ADMISSION_SLOT_DIR must be node-local)
+admission = AdmissionController(os.getenv('ADMISSION_SLOT_DIR'),
+                                max_slots=int(os.getenv('ENCODE_SLOTS', 0)) or None,
+                                reserved_slots=int(os.getenv('INTERACTIVE_SLOTS', 1)),
+                                tenant_share=float(os.getenv('TENANT_SLOT_SHARE', 0.5)),
+                                max_load=float(os.getenv('MAX_LOAD_PER_CORE', 1.5)),
+                                min_free_memory=int(os.getenv('MIN_FREE_MEMORY_MB', 512)) * 1024 * 1024)
+# A job holds one slot: by default its encodes get that slot's share of the cores plus the idle ones
+video_processor = VideoProcessor(probe=media_probe,
+                                 encode_cores=int(os.getenv('ENCODE_CORES_PER_JOB', 0)) or admission.core_budget,
+                                 reframe=os.getenv('VERTICAL_CROP', 'content') == 'content')
+transcript_cache = TranscriptCache(os.getenv('TRANSCRIPT_CACHE_DIR', './cache/transcripts'),
+                                   max_bytes=int(os.getenv('TRANSCRIPT_CACHE_MAX_MB', 256)) * 1024 * 1024)
+ANALYSIS_INDEX_DIR = os.getenv('ANALYSIS_INDEX_DIR', './cache/index')
+analysis_index = AnalysisIndex(ANALYSIS_INDEX_DIR)
+caption_generator = CaptionGenerator(probe=media_probe,
+                                     audio_format=os.getenv('CAPTION_AUDIO_FORMAT', 'flac'),
+                                     cache=transcript_cache,
+                                     index=analysis_index)
+clip_extractor = ClipExtractor(probe=media_probe, index=analysis_index)
+output_cache = OutputCache(os.getenv('OUTPUT_CACHE_DIR', './cache/outputs'),
+                           max_bytes=int(os.getenv('OUTPUT_CACHE_MAX_MB', 10240)) * 1024 * 1024)
 
-# Storage directories
+# Storage directories (shared volumes when running several nodes)
 UPLOAD_DIR = os.getenv('VIDEO_UPLOAD_DIR', './uploads')
 OUTPUT_DIR = os.getenv('VIDEO_OUTPUT_DIR', './processed')
+SOURCE_DIR = os.getenv('VIDEO_SOURCE_DIR', './sources')
+UPLOAD_DIR_MAX_BYTES = int(os.getenv('UPLOAD_DIR_MAX_MB', 20480)) * 1024 * 1024
+OUTPUT_DIR_MAX_BYTES = int(os.getenv('OUTPUT_DIR_MAX_MB', 20480)) * 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_MB', 4096)) * 1024 * 1024
+VIDEO_MAX_AGE = int(os.getenv('VIDEO_MAX_AGE', 3600))
+TRACE_DIR = os.getenv('TRACE_DIR', './cache/traces')
+TRACE_DIR_MAX_BYTES = int(os.getenv('TRACE_DIR_MAX_MB', 256)) * 1024 * 1024
+# Where the pre-forked worker processes share their metrics (node-local, see gunicorn.conf.py)
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'video-processor-metrics'))
+
+# Oversized multipart uploads are refused from Content-Length, before any body is read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+# Behind nginx/Apache, hand file bodies to the proxy with X-Sendfile
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false') == 'true'
+upload_store = UploadStore(UPLOAD_DIR, max_bytes=MAX_UPLOAD_BYTES,
+                           abandon_after=int(os.getenv('UPLOAD_ABANDON_HOURS', 24)) * 3600)
+
+ADMISSION_WAIT_SECONDS = float(os.getenv('ADMISSION_WAIT_SECONDS', 10))
+# Clips encoding at most this many seconds of video (length x outputs) are scheduled ahead of bulk work
+SHORT_JOB_SECONDS = int(os.getenv('SHORT_JOB_SECONDS', 90))
+ENCODE_SLOTS_BUSY.set_function(admission.busy)
+
+# Job queue shared by every node through JOB_STORE / JOB_DB_PATH
+# Per-job traces are written to TRACE_DIR (shared, so any node can serve them)
+job_manager = JobManager(create_job_store(max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3))),
+                         max_workers=int(os.getenv('MAX_CONCURRENT_JOBS', 2)),
+                         max_queued=int(os.getenv('MAX_QUEUED_JOBS', 20)),
+                         lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', 30)),
+                         tracer=Tracer(TRACE_DIR),
+                         admission=admission,
+                         max_queued_per_tenant=int(os.getenv('MAX_QUEUED_JOBS_PER_TENANT', 0)) or None)
+QUEUE_DEPTH.set_function(job_manager.queue_depth)
+RUNNING_JOBS.set_function(lambda: len(job_manager.running))
+
+# Encoding profile: 'auto' steps down the quality ladder as the queue grows (using profile
+# speeds measured by `benchmark.py --calibrate` when ENCODING_CALIBRATION exists), a name pins it
+ENCODING_PROFILE = os.getenv('ENCODING_PROFILE', 'auto')
+video_processor.profile_policy = ProfilePolicy(
+    ladder=LADDER if ENCODING_PROFILE == 'auto' else (ENCODING_PROFILE,),
+    queue_depth=job_manager.queue_depth,
+    calibration=load_calibration(os.getenv('ENCODING_CALIBRATION', './cache/encoding_calibration.json')),
+    clip_seconds=int(os.getenv('TYPICAL_CLIP_SECONDS', 60)),
+    target_wait=int(os.getenv('PROFILE_TARGET_WAIT_SECONDS', 300)))
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(SOURCE_DIR, exist_ok=True)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'ok', 'service': 'video-processor'})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this node's server processes"""
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/traces/<clip_id>', methods=['GET'])
+def get_trace(clip_id):
+    """Per-stage timings of a clip's most recent job run"""
+    trace = job_manager.tracer.get(clip_id)
+    if not trace:
+        return jsonify({'error': 'Trace not found', 'clipId': clip_id}), 404
+    return jsonify(trace)
+
+@app.route('/videos/<path:filename>', methods=['GET', 'HEAD'])
+def serve_video(filename):
+    """
+    Serve a finished output
+    Supports Range requests (seeking, resumed downloads) and ETag /
+    If-None-Match. Full responses are sent with the server's file wrapper
+    (sendfile under gunicorn); Range responses are copied through Python
+    unless USE_X_SENDFILE hands every response to the fronting proxy
+    """
+    # Only published outputs: not partial files, job work directories or subtitles
+    if not is_published_name(filename):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    response = send_from_directory(OUTPUT_DIR, filename, conditional=True, max_age=VIDEO_MAX_AGE)
+    if request.method == 'GET' and response.status_code in (200, 206):
+        BYTES_OUT.inc(response.content_length or 0, kind='served')
+    return response
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: {"size": bytes, "filename": optional}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        _enforce_storage_limits()
+        state = upload_store.create(data.get('size'), filename=data.get('filename'))
+        return _upload_response(state, 201)
+        
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        logger.error(f"Error creating upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Upload state; offset is where the next chunk must start"""
+    try:
+        return _upload_response(upload_store.status(upload_id))
+    except UploadError as e:
+        return _upload_error(e)
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_upload(upload_id):
+    """Append the request body to an upload at the Upload-Offset header"""
+    try:
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Upload-Offset header required'}), 400
+        
+        state = upload_store.append(upload_id, request.stream, offset, request.content_length)
+        BYTES_IN.inc(state['offset'] - offset, source='upload')
+        state = _probe_upload(state)
+        return _upload_response(state)
+        
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        logger.error(f"Error appending to upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    """Abort an upload"""
+    try:
+        upload_store.delete(upload_id)
+        return jsonify({'uploadId': upload_id, 'deleted': True})
+    except UploadError as e:
+        return _upload_error(e)
+
 @app.route('/process/create-clip', methods=['POST'])
 def create_clip():
-    """Create a clip from content metadata"""
+    """Queue creation of a clip from content metadata"""
     try:
         data = request.json
-        clip_id = data.get('clipId')
+        clip_id = data.get('clipId') or uuid.uuid4().hex
         content_id = data.get('contentId')
-        content_type = data.get('contentType')
-        length = data.get('length', 60)
-        clip_type = data.get('clipType', 'highlight')
         
         logger.info(f"Creating clip {clip_id} for content {content_id}")
         
-        # In a real implementation, this would:
-        # 1. Find/download the source video
-        # 2. Use AI to identify interesting segments
-        # 3. Extract the clip
-        # 4. Add captions and credits
-        # 5. Format to vertical (9:16)
+        _enforce_storage_limits()
+        params = {
+            'clipId': clip_id,
+            'contentId': content_id,
+            'length': data.get('length', 60),
+            'clipType': data.get('clipType', 'highlight'),
+            'startTime': data.get('startTime'),
+            'platform': data.get('platform'),
+            'renditions': data.get('renditions') or []
+        }
+        status = job_manager.submit(clip_id, 'create-clip', params,
+                                    priority=_job_priority('create-clip', params), tenant=_tenant())
+        return _job_accepted(status)
         
-        # For now, we'll simulate the process
-        output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
+    except QueueFullError as e:
+        return _capacity_error(e, 'queue')
+    except Exception as e:
+        logger.error(f"Error creating clip: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/process/batch-clips', methods=['POST'])
+def create_batch_clips():
+    """Queue several clips from one source, analysed and decoded once"""
+    try:
+        data = request.json
+        batch_id = data.get('batchId') or uuid.uuid4().hex
+        content_id = data.get('contentId')
+        specs = data.get('clips') or []
+        if not specs:
+            return jsonify({'error': 'No clips requested'}), 400
         
-        # Simulate processing (in production, call actual video processing)
-        video_url = f"/videos/{clip_id}.mp4"
+        clips = [{
+            'clipId': spec.get('clipId') or uuid.uuid4().hex,
+            'length': spec.get('length', 60),
+            'clipType': spec.get('clipType', 'highlight'),
+            'startTime': spec.get('startTime')
+        } for spec in specs]
         
-        return jsonify({
-            'clipId': clip_id,
-            'status': 'completed',
-            'videoUrl': video_url,
-            'message': 'Clip created successfully'
-        })
+        logger.info(f"Creating {len(clips)} clips in batch {batch_id} for content {content_id}")
+        
+        _enforce_storage_limits()
+        status = job_manager.submit(batch_id, 'batch-clips', {
+            'clipId': batch_id,
+            'contentId': content_id,
+            'clips': clips
+        }, priority=PRIORITY_BULK, tenant=_tenant())
+        return _job_accepted(status)
         
+    except QueueFullError as e:
+        return _capacity_error(e, 'queue')
     except Exception as e:
-        logger.error(f"Error creating clip: {str(e)}")
+        logger.error(f"Error creating clip batch: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/process/uploaded-video', methods=['POST'])
 def process_uploaded_video():
-    """Process a user-uploaded video"""
+    """
+    Queue processing of a user-uploaded video
+    The video is either a completed resumable upload (uploadId, form or JSON)
+    or a multipart 'video' file
+    """
     try:
-        if 'video' not in request.files:
+        data = request.get_json(silent=True) or request.form
+        upload_id = data.get('uploadId')
+        if not upload_id and 'video' not in request.files:
             return jsonify({'error': 'No video file provided'}), 400
         
-        video_file = request.files['video']
-        clip_id = request.form.get('clipId')
-        length = int(request.form.get('length', 60))
-        add_captions = request.form.get('addCaptions', 'false') == 'true'
+        clip_id = data.get('clipId') or uuid.uuid4().hex
         
         logger.info(f"Processing uploaded video for clip {clip_id}")
         
-        # Save uploaded file
-        input_path = os.path.join(UPLOAD_DIR, f"{clip_id}_original.mp4")
-        video_file.save(input_path)
-        
-        output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
-        
-        # Process video
-        video_processor.convert_to_vertical(input_path, output_path)
+        content_hash = None
+        if upload_id:
+            input_path = upload_store.path(upload_id)
+            content_hash = upload_store.status(upload_id)['sha256']  # hashed while it was written
+        else:
+            # Save uploaded file (UPLOAD_DIR must be shared by all nodes)
+            _enforce_storage_limits()
+            input_path = os.path.join(UPLOAD_DIR, f"{clip_id}_original.mp4")
+            request.files['video'].save(input_path)
+            BYTES_IN.inc(os.path.getsize(input_path), source='multipart')
         
-        # Trim to desired length
-        video_processor.trim_video(output_path, output_path, length)
+        renditions = data.get('renditions') or []
+        params = {
+            'clipId': clip_id,
+            'inputPath': input_path,
+            'contentHash': content_hash,
+            'length': int(data.get('length', 60)),
+            'addCaptions': str(data.get('addCaptions', 'false')).lower() == 'true',
+            'credits': data.get('credits'),
+            'platform': data.get('platform'),
+            'renditions': renditions.split(',') if isinstance(renditions, str) else list(renditions)
+        }
         
-        # Add captions if requested
-        if add_captions:
-            captions = caption_generator.generate_captions(output_path)
-            video_processor.add_captions(output_path, output_path, captions)
+        # The same bytes with the same parameters were processed before: reuse the output
+        output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
+        paths = output_cache.restore(_output_key(input_path, 'uploaded-video', params), output_path)
+        if paths:
+            if upload_id:
+                upload_store.delete(upload_id)
+            else:
+                os.remove(input_path)
+            result = _outputs_result(paths, output_path)
+            return jsonify(dict(result, clipId=clip_id, status='completed', progress=100, cached=True))
         
-        video_url = f"/videos/{clip_id}.mp4"
-        
-        return jsonify({
-            'clipId': clip_id,
-            'status': 'completed',
-            'videoUrl': video_url,
-            'message': 'Video processed successfully'
-        })
+        status = job_manager.submit(clip_id, 'uploaded-video', params,
+                                    priority=_job_priority('uploaded-video', params), tenant=_tenant())
+        return _job_accepted(status)
         
+    except QueueFullError as e:
+        return _capacity_error(e, 'queue')
+    except UploadError as e:
+        return _upload_error(e)
     except Exception as e:
         logger.error(f"Error processing video: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -120,8 +331,12 @@ def process_uploaded_video():
 def get_status(clip_id):
     """Get processing status for a clip"""
     try:
-        output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
+        status = job_manager.status(clip_id)
+        if status:
+            return jsonify(status)
         
+        # Outputs whose job record has been pruned
+        output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
         if os.path.exists(output_path):
             video_url = f"/videos/{clip_id}.mp4"
             return jsonify({
@@ -130,41 +345,332 @@ def get_status(clip_id):
                 'progress': 100,
                 'videoUrl': video_url
             })
-        else:
-            return jsonify({
-                'clipId': clip_id,
-                'status': 'processing',
-                'progress': 50
-            })
+        
+        return jsonify({'error': 'Clip not found', 'clipId': clip_id}), 404
             
     except Exception as e:
         logger.error(f"Error checking status: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/process/cancel/<clip_id>', methods=['POST'])
+def cancel_job(clip_id):
+    """Cancel a queued or running job"""
+    try:
+        status = job_manager.cancel(clip_id)
+        if not status:
+            return jsonify({'error': 'Clip not found', 'clipId': clip_id}), 404
+        return jsonify(status)
+        
+    except Exception as e:
+        logger.error(f"Error cancelling job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def run_create_clip(job):
+    """Job handler: extract a clip from a source video in SOURCE_DIR"""
+    params = job.params
+    clip_id = params['clipId']
+    content_id = params['contentId']
+    length = params['length']
+    
+    source_path = _source_path(content_id)
+    output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
+    
+    # Identical jobs wait here for the first one and reuse its output
+    key = _output_key(source_path, job.kind, params)
+    with output_cache.lock(key):
+        paths = output_cache.restore(key, output_path)
+        if paths is None:
+            if params.get('startTime') is None:
+                job.set_stage('analyzing')
+                clip_start, _ = clip_extractor.extract_clip(source_path, params['clipType'], length)
+            else:
+                clip_start = float(params['startTime'])
+            
+            job.set_stage('encoding')
+            paths = _encode_clip(job, source_path, output_path,
+                                 start_time=clip_start,
+                                 duration=length)
+            output_cache.store(key, output_path, paths)
+    return _outputs_result(paths, output_path)
+
+def run_batch_clips(job):
+    """Job handler: several clips from one source video, analysed and decoded once"""
+    params = job.params
+    clips = params['clips']
+    source_path = _source_path(params['contentId'])
+    
+    starts = {c['clipId']: float(c['startTime']) for c in clips if c.get('startTime') is not None}
+    pending = [c for c in clips if c.get('startTime') is None]
+    if pending:
+        # One analysis pass places every clip, each avoiding the windows already taken
+        job.set_stage('analyzing')
+        taken = [(starts[c['clipId']], starts[c['clipId']] + c['length']) for c in clips
+                 if c['clipId'] in starts]
+        windows = clip_extractor.extract_clips(source_path,
+                                               [(c['clipType'], c['length']) for c in pending],
+                                               exclude=taken)
+        starts.update({c['clipId']: start for c, (start, _) in zip(pending, windows)})
+    
+    results = {c['clipId']: {'clipId': c['clipId'], 'status': 'processing',
+                             'startTime': starts[c['clipId']]} for c in clips}
+    outputs = {os.path.join(OUTPUT_DIR, f"{c['clipId']}.mp4"): c for c in clips}
+    
+    def clip_done(output_path):
+        clip_id = outputs[output_path]['clipId']
+        BYTES_OUT.inc(os.path.getsize(output_path), kind='written')
+        results[clip_id].update(status='completed', videoUrl=f"/videos/{clip_id}.mp4")
+        job.publish({'clips': list(results.values())})
+    
+    job.set_stage('encoding')
+    video_processor.create_vertical_clips(
+        source_path,
+        [(output_path, starts[c['clipId']], c['length']) for output_path, c in outputs.items()],
+        progress=job,
+        on_complete=clip_done)
+    return {'clips': list(results.values())}
+
+def run_uploaded_video(job):
+    """Job handler: turn an uploaded video into a vertical clip"""
+    params = job.params
+    clip_id = params['clipId']
+    input_path = params['inputPath']
+    length = params['length']
+    output_path = os.path.join(OUTPUT_DIR, f"{clip_id}.mp4")
+    
+    # Identical jobs wait here for the first one and reuse its output
+    key = _output_key(input_path, job.kind, params)
+    with output_cache.lock(key):
+        paths = output_cache.restore(key, output_path)
+        if paths is None:
+            # Transcribe only the range that ends up in the clip
+            captions = None
+            if params.get('addCaptions'):
+                job.set_stage('captions')
+                captions = caption_generator.generate_captions(input_path, start_time=0, duration=length)
+                if params.get('platform'):
+                    captions = caption_generator.format_for_social_media(captions, params['platform'])
+            
+            # Crop, scale, trim, captions and credits in a single encode
+            job.set_stage('encoding')
+            paths = _encode_clip(job, input_path, output_path,
+                                 start_time=0,
+                                 duration=length,
+                                 captions=captions,
+                                 credits_text=params.get('credits'))
+            
+            # Placeholder captions mean transcription failed; let a retry try again
+            if not (captions and caption_generator.is_mock(captions)):
+                output_cache.store(key, output_path, paths)
+    return _outputs_result(paths, output_path)
+
+def _encode_clip(job, input_path, output_path, start_time, duration, captions=None, credits_text=None):
+    """
+    Encode a clip for the job's platform and renditions, if any, in one FFmpeg run
+    Without either the default single-output encode is used
+    Returns {name: path} of the files written ('video' for the default encode)
+    """
+    names = _rendition_names(job.params)
+    if not names:
+        video_processor.create_vertical_clip(input_path, output_path,
+                                             start_time=start_time,
+                                             duration=duration,
+                                             captions=captions,
+                                             credits_text=credits_text,
+                                             progress=job)
+        paths = {'video': output_path}
+    else:
+        paths = video_processor.create_renditions(input_path, output_path, names,
+                                                  start_time=start_time,
+                                                  duration=duration,
+                                                  captions=captions,
+                                                  credits_text=credits_text,
+                                                  progress=job)
+    BYTES_OUT.inc(sum(os.path.getsize(path) for path in paths.values()), kind='written')
+    return paths
+
+def _outputs_result(paths, output_path):
+    """Job result for the files {name: path} written by _encode_clip"""
+    result = {}
+    if output_path in paths.values():
+        result['videoUrl'] = f"/videos/{os.path.basename(output_path)}"
+    if list(paths) != ['video']:
+        result['renditions'] = {name: f"/videos/{os.path.basename(path)}" for name, path in paths.items()}
+    return result
+
+def _rendition_names(params):
+    names = [params['platform']] if params.get('platform') else []
+    return names + (params.get('renditions') or [])
+
+def _output_key(input_path, kind, params):
+    """Output cache key: the input's content plus everything that changes the output"""
+    settings = {k: v for k, v in params.items() if k not in ('clipId', 'contentId', 'inputPath', 'contentHash')}
+    return output_cache.key(params.get('contentHash') or analysis_index.content_hash(input_path), {
+        'kind': kind,
+        'params': settings,
+        'output': video_processor.output_settings(_rendition_names(params))
+    })
+
+def _enforce_storage_limits():
+    """Evict the least recently used uploads, outputs, traces and probe results beyond their budgets"""
+    # Never the input of a queued or running job, nor an upload still arriving; an upload's files go together
+    in_use = {upload_store.eviction_unit(os.path.basename(params['inputPath']))
+              for params in job_manager.active_params() if params.get('inputPath')}
+    evict_lru(UPLOAD_DIR, UPLOAD_DIR_MAX_BYTES, group=upload_store.eviction_unit,
+              keep=lambda unit: unit in in_use or upload_store.in_progress(unit))
+    evict_lru(OUTPUT_DIR, OUTPUT_DIR_MAX_BYTES)
+    evict_lru(TRACE_DIR, TRACE_DIR_MAX_BYTES)
+    evict_lru(PROBE_CACHE_DIR, PROBE_CACHE_MAX_BYTES, max_age=PROBE_CACHE_MAX_AGE)
+    # Content hashes remembered for files that are long gone
+    evict_lru(os.path.join(ANALYSIS_INDEX_DIR, 'hashes'), PROBE_CACHE_MAX_BYTES, max_age=PROBE_CACHE_MAX_AGE)
+
+def _probe_upload(state):
+    """
+    Probe an upload once its container header has arrived, and again on
+    completion: the duration and streams read from a partial file may be
+    truncated, and its probe may have failed (e.g. the index is at the end)
+    A completed upload that can't be probed is rejected
+    """
+    if not upload_store.header_ready(state):
+        return state
+    if state.get('probedComplete') if state['complete'] else state['probed']:
+        return state
+    
+    upload_id = state['uploadId']
+    try:
+        info = media_probe.probe(upload_store.partial_path(upload_id), cached=False)
+    except ProbeError as e:
+        if state['complete']:
+            upload_store.delete(upload_id)
+            raise UploadError(f"Uploaded file is not a usable video: {str(e)}", status=415)
+        state = upload_store.set_info(upload_id, None)
+        return state
+    
+    return upload_store.set_info(upload_id, {
+        'duration': info.duration,
+        'width': info.width,
+        'height': info.height,
+        'fps': info.fps,
+        'videoCodec': info.video_codec,
+        'hasAudio': info.has_audio
+    }, complete=state['complete'])
+
+def _upload_response(state, status_code=200):
+    body = {k: state[k] for k in ('uploadId', 'size', 'offset', 'complete', 'info')}
+    body['chunkSize'] = upload_store.chunk_size
+    response = jsonify(body)
+    response.headers['Upload-Offset'] = str(state['offset'])
+    return response, status_code
+
+def _upload_error(error):
+    body = {'error': str(error)}
+    if error.offset is not None:
+        body['offset'] = error.offset
+    return jsonify(body), error.status
+
+def _source_path(content_id):
+    """Path of the source video for content_id in SOURCE_DIR"""
+    source_path = os.path.join(SOURCE_DIR, f"{content_id}.mp4")
+    if not os.path.exists(source_path):
+        raise FileNotFoundError(f"Source video not found for content {content_id}")
+    return source_path
+
+def _tenant():
+    """Tenant a request is accounted to for fair sharing (X-Tenant-Id, e.g. the user)"""
+    return request.headers.get('X-Tenant-Id') or 'default'
+
+def _job_priority(kind, params):
+    """Short single clips are scheduled ahead of batches and long or multi-output encodes"""
+    if kind == 'batch-clips':
+        return PRIORITY_BULK
+    seconds = float(params['length']) * (1 + len(params.get('renditions') or []))
+    return PRIORITY_SHORT if seconds <= SHORT_JOB_SECONDS else PRIORITY_BULK
+
+def _capacity_error(e, reason):
+    """429 for a request refused for lack of capacity, with Retry-After in seconds"""
+    ADMISSION_REJECTIONS.inc(reason=reason)
+    response = jsonify({'error': str(e), 'retryAfter': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+def _job_accepted(status):
+    """202 response pointing the caller at the status endpoint"""
+    status['statusUrl'] = f"/process/status/{status['jobId']}"
+    return jsonify(status), 202
+
+job_manager.register('create-clip', run_create_clip)
+job_manager.register('batch-clips', run_batch_clips)
+job_manager.register('uploaded-video', run_uploaded_video)
+# Under the pre-forking server the job workers start in each worker process instead
+# (threads don't survive a fork; see gunicorn.conf.py)
+if os.getenv('JOB_WORKERS_AUTOSTART', 'true') == 'true':
+    job_manager.start()
+
+def warm_up():
+    """
+    Load what the first requests would otherwise load lazily
+    Called in the pre-fork master so every worker process shares it copy-on-write
+    """
+    import numpy  # noqa: F401  imported by the analysis services on first use
+    if video_processor.crop_planner:
+        video_processor.crop_planner.load_face_detector()
+    if os.getenv('OPENAI_API_KEY'):
+        import openai  # noqa: F401  the client itself is created in each worker process
+
+def check_startup(started):
+    """Record the time to become ready since started (time.monotonic) against STARTUP_BUDGET_SECONDS"""
+    elapsed = time.monotonic() - started
+    STARTUP_SECONDS.set(round(elapsed, 3))
+    budget = float(os.getenv('STARTUP_BUDGET_SECONDS', 10))
+    if elapsed <= budget:
+        logger.info(f"Ready in {elapsed:.2f}s")
+        return
+    
+    message = f"Startup took {elapsed:.2f}s, over the {budget:g}s budget"
+    if os.getenv('STARTUP_BUDGET_STRICT', 'false') == 'true':
+        raise RuntimeError(message)
+    logger.warning(message)
+
 @app.route('/captions/generate', methods=['POST'])
 def generate_captions():
-    """Generate captions for a video"""
+    """Generate captions for a video (multipart 'video' file or a completed uploadId)"""
     try:
-        if 'video' not in request.files:
+        upload_id = request.form.get('uploadId') or (request.get_json(silent=True) or {}).get('uploadId')
+        if not upload_id and 'video' not in request.files:
             return jsonify({'error': 'No video file provided'}), 400
         
-        video_file = request.files['video']
-        temp_path = os.path.join(UPLOAD_DIR, 'temp_caption.mp4')
-        video_file.save(temp_path)
-        
-        captions = caption_generator.generate_captions(temp_path)
-        
-        # Clean up temp file
-        os.remove(temp_path)
+        # Interactive: may use the slots reserved ahead of queued encodes, and
+        # is refused after a short wait rather than left to time out
+        with admission.acquire(PRIORITY_INTERACTIVE, _tenant(), timeout=ADMISSION_WAIT_SECONDS):
+            if upload_id:
+                return jsonify({
+                    'captions': caption_generator.generate_captions(upload_store.path(upload_id))
+                })
+            
+            video_file = request.files['video']
+            
+            # Per-request name so concurrent uploads never share a file
+            fd, temp_path = tempfile.mkstemp(suffix='.mp4', prefix='caption_', dir=UPLOAD_DIR)
+            os.close(fd)
+            try:
+                video_file.save(temp_path)
+                BYTES_IN.inc(os.path.getsize(temp_path), source='multipart')
+                captions = caption_generator.generate_captions(temp_path)
+            finally:
+                os.remove(temp_path)
         
         return jsonify({
             'captions': captions
         })
         
+    except CapacityError as e:
+        return _capacity_error(e, e.reason)
+    except UploadError as e:
+        return _upload_error(e)
     except Exception as e:
         logger.error(f"Error generating captions: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # Development server; production runs gunicorn with gunicorn.conf.py
+    app.run(host='0.0.0.0', port=port, debug=os.getenv('FLASK_DEBUG', 'true') == 'true')
@@ -0,0 +1,523 @@
+"""
+Performance benchmarks for the video-processor services
+
+    python benchmark.py --suite quick                  # run, compare with the baseline
+    python benchmark.py --suite quick --save-baseline  # record the current numbers as the baseline
+    python benchmark.py --list                         # show sources, stages and suites
+    python benchmark.py --calibrate                    # measure the encoding profiles on this machine
+
+Sources are generated locally with FFmpeg lavfi (testsrc2 video, sine beeps
+for audio) and kept in --source-dir, so every run decodes identical inputs.
+Each case (one stage on one source) runs in a fresh Python process, so caches
+and peak RSS never carry over from an earlier case. Captions use
+FakeTranscriptionBackend; nothing leaves the machine.
+
+Recorded per case (median over --repeat runs):
+wall_seconds, fps (frames encoded or analysed per second), peak_rss_mb (the
+Python process), child_peak_rss_mb (largest FFmpeg child), output_bytes
+(files the case wrote) and subprocesses (processes it started).
+
+A metric that moves past its threshold in REGRESSION_THRESHOLDS compared with
+the baseline fails the run (exit status 1).
+
+--calibrate encodes CALIBRATION_SECONDS of --calibration-source to the
+vertical output with each encoding profile (services/encoding_profiles.py)
+and records its speed (seconds of video per wall second), fps, bitrate and
+SSIM against the unencoded crop. The app reads the file (ENCODING_CALIBRATION)
+to pick the profile that keeps up with the queue.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger('benchmark')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCE_DIR = os.path.join(BASE_DIR, 'benchmarks', 'sources')
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'benchmarks', 'baseline.json')
+DEFAULT_CALIBRATION = os.path.join(BASE_DIR, 'cache', 'encoding_calibration.json')
+CALIBRATION_SECONDS = 20
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+@dataclass(frozen=True)
+class SyntheticSource:
+    """A lavfi-generated test source"""
+    name: str
+    width: int
+    height: int
+    duration: int
+    fps: int = 30
+
+    @property
+    def frames(self):
+        return self.duration * self.fps
+
+    def path(self, source_dir):
+        return os.path.join(source_dir, f"{self.name}.mp4")
+
+    def generate(self, source_dir):
+        """Encode the source into source_dir unless it is already there; returns its path"""
+        path = self.path(source_dir)
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(source_dir, exist_ok=True)
+        logger.info(f"Generating {self.name} ({self.width}x{self.height}, {self.duration}s)")
+        tmp_path = f"{path}.{os.getpid()}.tmp.mp4"
+        subprocess.run([
+            'ffmpeg', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f"testsrc2=size={self.width}x{self.height}:rate={self.fps}:duration={self.duration}",
+            '-f', 'lavfi', '-i', f"sine=frequency=440:beep_factor=4:sample_rate=48000:duration={self.duration}",
+            '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(self.fps * 2), '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '128k',
+            # Byte-identical output on every machine with the same FFmpeg build
+            '-map_metadata', '-1', '-flags:v', '+bitexact', '-flags:a', '+bitexact', '-fflags', '+bitexact',
+            tmp_path
+        ], check=True)
+        os.replace(tmp_path, path)
+        return path
+
+
+SOURCES = {source.name: source for source in [
+    SyntheticSource('720p-30s', 1280, 720, 30),
+    SyntheticSource('720p-30s-portrait', 720, 1280, 30),
+    SyntheticSource('1080p-2m', 1920, 1080, 120),
+    SyntheticSource('1080p-2m-portrait', 1080, 1920, 120),
+    SyntheticSource('4k-30s', 3840, 2160, 30),
+    SyntheticSource('1080p-10m', 1920, 1080, 600),
+    SyntheticSource('1080p-30m', 1920, 1080, 1800),
+]}
+
+SUITES = {
+    'quick': ['720p-30s', '720p-30s-portrait'],
+    'standard': ['720p-30s', '720p-30s-portrait', '1080p-2m', '1080p-2m-portrait', '4k-30s'],
+    'full': list(SOURCES)
+}
+
+# metric -> (better direction, allowed relative change the wrong way)
+REGRESSION_THRESHOLDS = {
+    'wall_seconds': ('lower', 0.15),
+    'fps': ('higher', 0.15),
+    'peak_rss_mb': ('lower', 0.25),
+    'child_peak_rss_mb': ('lower', 0.25),
+    'output_bytes': ('lower', 0.10),
+    'subprocesses': ('lower', 0.0)
+}
+
+
+# Stages: each runs in the case's own process and returns the number of
+# video frames it encoded or analysed (0 when fps isn't meaningful)
+
+def _clip_length(source, limit):
+    return min(limit, source.duration)
+
+
+def _fake_captions(length):
+    from services.transcription import FakeTranscriptionBackend
+    return FakeTranscriptionBackend().transcribe(io.BytesIO(), 'audio.flac', length)
+
+
+def stage_probe(source, path, work_dir):
+    from services.media_probe import MediaProbe
+    probe = MediaProbe()
+    probe.probe(path)
+    probe.keyframes(path)
+    return 0
+
+
+def stage_signals(source, path, work_dir):
+    from services.signal_analyzer import SignalAnalyzer
+    SignalAnalyzer().analyze(path)
+    return source.frames
+
+
+def stage_extract(source, path, work_dir):
+    from services.analysis_index import AnalysisIndex
+    from services.clip_extractor import ClipExtractor
+    extractor = ClipExtractor(index=AnalysisIndex(os.path.join(work_dir, 'index')))
+    length = _clip_length(source, 15) // 3
+    extractor.extract_clips(path, [('highlight', length), ('action', length), ('dramatic', length)])
+    return source.frames
+
+
+def stage_captions(source, path, work_dir):
+    from services.caption_generator import CaptionGenerator
+    from services.transcription import FakeTranscriptionBackend
+    CaptionGenerator(backend=FakeTranscriptionBackend()).generate_captions(path)
+    return 0
+
+
+def stage_crop_plan(source, path, work_dir):
+    from services.video_processor import VideoProcessor
+    VideoProcessor()._plan_crop(path, 0, _clip_length(source, 60))
+    return _clip_length(source, 60) * source.fps
+
+
+def stage_vertical_clip(source, path, work_dir):
+    from services.video_processor import VideoProcessor
+    length = _clip_length(source, 60)
+    VideoProcessor().create_vertical_clip(path, os.path.join(work_dir, 'clip.mp4'), 0, length,
+                                          captions=_fake_captions(length))
+    return length * source.fps
+
+
+def stage_renditions(source, path, work_dir):
+    from services.video_processor import VideoProcessor
+    length = _clip_length(source, 30)
+    VideoProcessor().create_renditions(path, os.path.join(work_dir, 'clip.mp4'),
+                                       ['tiktok', 'preview', 'poster', 'sprite'], 0, length)
+    return 2 * length * source.fps
+
+
+def stage_batch_clips(source, path, work_dir):
+    from services.video_processor import VideoProcessor
+    length = _clip_length(source, 30) // 3
+    clips = [(os.path.join(work_dir, f"clip_{i}.mp4"), i * length, length) for i in range(3)]
+    VideoProcessor().create_vertical_clips(path, clips)
+    return 3 * length * source.fps
+
+
+def stage_convert(source, path, work_dir):
+    from services.video_processor import VideoProcessor
+    VideoProcessor().convert_to_vertical(path, os.path.join(work_dir, 'vertical.mp4'))
+    return source.frames
+
+
+# End-to-end routes: the Flask app in-process, storage under work_dir
+
+def _load_app(source, path, work_dir):
+    for name, directory in [('VIDEO_UPLOAD_DIR', 'uploads'), ('VIDEO_OUTPUT_DIR', 'processed'),
+                            ('VIDEO_SOURCE_DIR', 'sources'), ('PROBE_CACHE_DIR', 'cache/probe'),
+                            ('TRANSCRIPT_CACHE_DIR', 'cache/transcripts'), ('ANALYSIS_INDEX_DIR', 'cache/index'),
+                            ('OUTPUT_CACHE_DIR', 'cache/outputs')]:
+        os.environ[name] = os.path.join(work_dir, directory)
+    os.environ['JOB_DB_PATH'] = os.path.join(work_dir, 'jobs.db')
+    os.makedirs(os.environ['VIDEO_SOURCE_DIR'], exist_ok=True)
+    os.link(path, os.path.join(os.environ['VIDEO_SOURCE_DIR'], 'benchmark.mp4'))
+
+    import app as service
+    from services.transcription import FakeTranscriptionBackend
+    service.caption_generator.backend = FakeTranscriptionBackend()
+    return service.app.test_client()
+
+
+def _wait_for_job(client, response, timeout=6 * 3600):
+    if response.status_code != 202:
+        raise RuntimeError(f"Request failed ({response.status_code}): {response.get_json()}")
+    status_url = response.get_json()['statusUrl']
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(status_url).get_json()
+        if status['status'] == 'completed':
+            return status
+        if status['status'] in ('failed', 'cancelled'):
+            raise RuntimeError(f"Job {status['status']}: {status.get('error')}")
+        time.sleep(0.2)
+    raise RuntimeError('Job timed out')
+
+
+def stage_route_uploaded_video(source, path, work_dir):
+    client = _load_app(source, path, work_dir)
+    size = os.path.getsize(path)
+    upload = client.post('/uploads', json={'size': size}).get_json()
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            chunk = f.read(8 * upload['chunkSize'])
+            response = client.patch(f"/uploads/{upload['uploadId']}", data=chunk,
+                                    headers={'Upload-Offset': str(offset)})
+            offset = response.get_json()['offset']
+
+    length = _clip_length(source, 60)
+    _wait_for_job(client, client.post('/process/uploaded-video', json={
+        'uploadId': upload['uploadId'], 'length': length, 'addCaptions': True
+    }))
+    return length * source.fps
+
+
+def stage_route_create_clip(source, path, work_dir):
+    client = _load_app(source, path, work_dir)
+    length = _clip_length(source, 60)
+    _wait_for_job(client, client.post('/process/create-clip', json={
+        'contentId': 'benchmark', 'length': length, 'clipType': 'highlight', 'renditions': ['preview']
+    }))
+    return 2 * length * source.fps
+
+
+def stage_route_batch_clips(source, path, work_dir):
+    client = _load_app(source, path, work_dir)
+    length = _clip_length(source, 30) // 3
+    _wait_for_job(client, client.post('/process/batch-clips', json={
+        'contentId': 'benchmark',
+        'clips': [{'clipType': clip_type, 'length': length} for clip_type in ('highlight', 'action', 'dramatic')]
+    }))
+    return 3 * length * source.fps
+
+
+STAGES = {
+    'probe': stage_probe,
+    'signals': stage_signals,
+    'extract': stage_extract,
+    'captions': stage_captions,
+    'crop_plan': stage_crop_plan,
+    'vertical_clip': stage_vertical_clip,
+    'renditions': stage_renditions,
+    'batch_clips': stage_batch_clips,
+    'convert': stage_convert,
+    'route_uploaded_video': stage_route_uploaded_video,
+    'route_create_clip': stage_route_create_clip,
+    'route_batch_clips': stage_route_batch_clips
+}
+
+
+class _CountingPopen(subprocess.Popen):
+    """subprocess.Popen that counts the processes a case starts (FFmpeg, ffprobe)"""
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        _CountingPopen.count += 1
+        super().__init__(*args, **kwargs)
+
+
+def run_case(stage, source, source_dir):
+    """Run one stage on one source in this process and print its metrics"""
+    subprocess.Popen = _CountingPopen
+    path = source.path(source_dir)
+    work_dir = tempfile.mkdtemp(prefix=f"benchmark_{stage}_")
+    try:
+        started = time.perf_counter()
+        frames = STAGES[stage](source, path, work_dir)
+        wall = time.perf_counter() - started
+
+        output_bytes = 0
+        for root, _, files in os.walk(work_dir):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if not os.path.samefile(file_path, path):
+                    output_bytes += os.path.getsize(file_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # ru_maxrss is in KB on Linux
+    metrics = {
+        'wall_seconds': round(wall, 3),
+        'fps': round(frames / wall, 1) if frames else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'child_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'output_bytes': output_bytes,
+        'subprocesses': _CountingPopen.count
+    }
+    print(RESULT_PREFIX + json.dumps(metrics), flush=True)
+
+
+def measure(stage, source, source_dir, repeat):
+    """Median metrics of repeat fresh-process runs of stage on source"""
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', stage,
+                                 '--source', source.name, '--source-dir', source_dir],
+                                cwd=BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, env=dict(os.environ, PYTHONHASHSEED='0'))
+        lines = [line for line in result.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if result.returncode != 0 or not lines:
+            raise RuntimeError(f"{stage} on {source.name} failed:\n{result.stderr[-2000:]}")
+        runs.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+
+    metrics = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs if run[name] is not None]
+        metrics[name] = statistics.median(values) if values else None
+    return metrics
+
+
+def compare(results, baseline, thresholds=REGRESSION_THRESHOLDS):
+    """[(case, metric, baseline value, value, relative change)] for metrics past their threshold"""
+    regressions = []
+    for case, metrics in results.items():
+        previous = baseline.get(case)
+        if not previous:
+            continue
+        for metric, (better, tolerance) in thresholds.items():
+            old, new = previous.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (float('inf') if new > old else 0.0)
+            worse = change if better == 'lower' else -change
+            if worse > tolerance:
+                regressions.append((case, metric, old, new, change))
+    return regressions
+
+
+def measure_profile(processor, source, path, work_dir):
+    """
+    Speed and quality of processor's (single) encoding profile on the first CALIBRATION_SECONDS of path
+    The encode has every core (processor has no core budget), so the speed is the node's throughput
+    """
+    import ffmpeg
+    length = _clip_length(source, CALIBRATION_SECONDS)
+    output_path = os.path.join(work_dir, 'calibration.mp4')
+    pipeline = processor.build_vertical_pipeline(path)
+    pipeline.trim(0, length)
+
+    started = time.perf_counter()
+    pipeline.run(output_path, **processor._encode_options(processor.probe.probe(path)))
+    wall = time.perf_counter() - started
+
+    # SSIM of the encode against the same crop and scale, unencoded
+    reference = ffmpeg.input(path, t=length).video
+    for name, args, kwargs in pipeline.filters:
+        reference = reference.filter(name, *args, **kwargs)
+    _, stderr = (ffmpeg.filter([ffmpeg.input(output_path).video, reference], 'ssim')
+                 .output('-', f='null')
+                 .run(capture_stdout=True, capture_stderr=True))
+    match = re.search(r'All:([\d.]+)', stderr.decode('utf-8', errors='replace'))
+
+    return {
+        'speed': round(length / wall, 2),
+        'fps': round(length * source.fps / wall, 1),
+        'bitrate_kbps': round(os.path.getsize(output_path) * 8 / length / 1000),
+        'ssim': float(match.group(1)) if match else None
+    }
+
+
+def calibrate(source, source_dir, output_path):
+    """Measure every encoding profile on source and write the calibration the app reads"""
+    from services.encoding_profiles import PROFILES, ProfilePolicy
+    from services.video_processor import VideoProcessor
+    path = source.generate(source_dir)
+    profiles = {}
+    for name in PROFILES:
+        processor = VideoProcessor(reframe=False, profile_policy=ProfilePolicy(ladder=(name,)))
+        work_dir = tempfile.mkdtemp(prefix=f"calibrate_{name}_")
+        try:
+            profiles[name] = measure_profile(processor, source, path, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        measured = profiles[name]
+        logger.info(f"{name}: {measured['speed']:.2f}x realtime, {measured['fps']:.0f} fps, "
+                    f"{measured['bitrate_kbps']} kbps, SSIM {measured['ssim']}")
+
+    report = {'machine': machine_info(), 'created_at': time.time(), 'source': source.name,
+              'rendition': processor.rendition.name, 'profiles': profiles}
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, output_path)
+    logger.info(f"Saved encoding calibration to {output_path}")
+
+
+def machine_info():
+    """What the numbers depend on; a baseline from another machine is only indicative"""
+    ffmpeg_version = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE,
+                                    universal_newlines=True).stdout.split('\n')[0]
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg_version
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    parser.add_argument('--sources', help='comma-separated source names (overrides --suite)')
+    parser.add_argument('--stages', help='comma-separated stage names (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--source-dir', default=DEFAULT_SOURCE_DIR)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--output', help='also write the results as JSON to this path')
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--calibrate', action='store_true', help='measure the encoding profiles instead')
+    parser.add_argument('--calibration-source', choices=sorted(SOURCES), default='1080p-2m')
+    parser.add_argument('--calibration-output', default=DEFAULT_CALIBRATION)
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if not args.run_case else logging.WARNING)
+
+    if args.run_case:
+        run_case(args.run_case, SOURCES[args.source], args.source_dir)
+        return 0
+
+    if args.list:
+        for source in SOURCES.values():
+            print(f"source {source.name}: {source.width}x{source.height}, {source.duration}s at {source.fps} fps")
+        print('stages: ' + ', '.join(STAGES))
+        for name, sources in SUITES.items():
+            print(f"suite {name}: {', '.join(sources)}")
+        return 0
+
+    if args.calibrate:
+        calibrate(SOURCES[args.calibration_source], args.source_dir, args.calibration_output)
+        return 0
+
+    sources = [SOURCES[name] for name in (args.sources.split(',') if args.sources else SUITES[args.suite])]
+    stages = args.stages.split(',') if args.stages else list(STAGES)
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"Unknown stage: {stage}")
+
+    results = {}
+    for source in sources:
+        source.generate(args.source_dir)
+        for stage in stages:
+            case = f"{stage}/{source.name}"
+            results[case] = measure(stage, source, args.source_dir, args.repeat)
+            metrics = results[case]
+            logger.info(f"{case}: {metrics['wall_seconds']:.2f}s"
+                        + (f", {metrics['fps']:.0f} fps" if metrics['fps'] else '')
+                        + f", rss {metrics['peak_rss_mb']:.0f}/{metrics['child_peak_rss_mb']:.0f} MB"
+                        + f", {metrics['output_bytes']} bytes, {metrics['subprocesses']} subprocesses")
+
+    report = {'machine': machine_info(), 'created_at': time.time(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    status = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('machine') != report['machine']:
+            logger.warning(f"Baseline was recorded on {baseline.get('machine')}; comparisons are indicative only")
+        regressions = compare(results, baseline.get('results', {}))
+        for case, metric, old, new, change in regressions:
+            logger.error(f"REGRESSION {case} {metric}: {old} -> {new} ({change:+.0%})")
+        if regressions:
+            status = 1
+        else:
+            logger.info(f"No regressions against {args.baseline}")
+    elif not args.save_baseline:
+        logger.info(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                # Keep cases this run didn't cover
+                report['results'] = dict(json.load(f).get('results', {}), **results)
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logger.info(f"Saved baseline to {args.baseline}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Production server settings (gunicorn -c gunicorn.conf.py app:app)
+
+The app is imported and warmed up once in the master (preload_app), so the
+worker processes fork ready to serve and share that memory copy-on-write.
+Each worker runs its own job worker threads; on SIGTERM a worker stops
+taking requests and jobs and drains its running encodes for up to
+JOB_DRAIN_SECONDS before exiting (jobs still running are requeued).
+The processes share their metrics through METRICS_DIR, so any worker
+answers /metrics for the whole server.
+"""
+import os
+import time
+
+_started = time.monotonic()
+
+# Started per worker process in post_fork instead of in the master
+os.environ['JOB_WORKERS_AUTOSTART'] = 'false'
+
+JOB_DRAIN_SECONDS = int(os.getenv('JOB_DRAIN_SECONDS', 300))
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 8))  # concurrent requests per worker (uploads, downloads, polling)
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+keepalive = 5
+# The master kills workers that haven't exited this long after SIGTERM
+graceful_timeout = JOB_DRAIN_SECONDS + 30
+accesslog = '-'
+
+
+def when_ready(server):
+    """Runs in the master after the app is loaded, before the first fork"""
+    import app
+    from services.metrics import share_metrics
+    app.warm_up()
+    app.check_startup(_started)
+    # Written once: no threads in the master, they would not survive the fork
+    share_metrics(app.METRICS_DIR, interval=None, clear=True)
+
+
+def post_fork(server, worker):
+    import app
+    from services.metrics import share_metrics
+    share_metrics(app.METRICS_DIR)
+    # MAX_CONCURRENT_JOBS is for the whole node: split it across the worker processes
+    app.job_manager.max_workers = max(1, app.job_manager.max_workers // workers)
+    app.job_manager.start()
+
+
+def worker_exit(server, worker):
+    import app
+    from services.metrics import save_metrics
+    app.job_manager.stop(timeout=JOB_DRAIN_SECONDS)
+    save_metrics()
@@ -0,0 +1,242 @@
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+PRIORITY_INTERACTIVE = 0  # synchronous requests someone is waiting on (captions)
+PRIORITY_SHORT = 1  # short clip jobs
+PRIORITY_BULK = 2  # long clips, many renditions, batches
+
+
+class CapacityError(Exception):
+    """Raised when the node has no capacity for more work; retry_after is in seconds"""
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Slot:
+    """An encode slot held by this process; release() frees it for any process"""
+
+    def __init__(self, controller, lock_file, priority, tenant):
+        self.controller = controller
+        self.priority = priority
+        self.started = time.time()
+        self._lock_file = lock_file
+        self.assign(tenant)
+
+    def assign(self, tenant):
+        """Record the tenant the slot's work is for (counted against its share)"""
+        self.tenant = tenant
+        self._lock_file.seek(0)
+        self._lock_file.truncate()
+        self._lock_file.write(json.dumps({'tenant': tenant, 'priority': self.priority, 'started': self.started}))
+        self._lock_file.flush()
+
+    def release(self, record=True):
+        """Free the slot; record=False when it ran no work (so it doesn't count towards retry_after)"""
+        if self._lock_file is None:
+            return
+        self._lock_file.seek(0)
+        self._lock_file.truncate()
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+        if record:
+            self.controller._record(time.time() - self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Node-wide admission control for FFmpeg work
+
+    The node has max_slots encode slots shared by every process through lock
+    files in slot_dir (which must be local to the node, not a shared
+    volume); a slot held by a process that dies is freed with it.
+    reserved_slots are only for interactive work, so queued encodes can
+    never fill the node. A tenant holds at most tenant_share of the slots.
+    Apart from interactive work, nothing new starts while the load per core
+    is over max_load, and nothing at all while less than min_free_memory is
+    available.
+    """
+
+    def __init__(self, slot_dir=None, max_slots=None, reserved_slots=1, tenant_share=0.5,
+                 max_load=1.5, min_free_memory=512 * 1024 * 1024, poll_interval=0.5,
+                 default_duration=30.0):
+        self.slot_dir = slot_dir or os.path.join(tempfile.gettempdir(), 'video-processor-slots')
+        self.max_slots = max_slots or max(2, (os.cpu_count() or 2) // 2)
+        self.reserved_slots = min(reserved_slots, self.max_slots - 1)
+        self.tenant_slots = max(1, math.ceil(self.max_slots * tenant_share))
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.poll_interval = poll_interval
+        self.default_duration = default_duration  # assumed slot hold time before any has finished
+        self._durations = collections.deque(maxlen=50)
+        self._lock = threading.Lock()
+        os.makedirs(self.slot_dir, exist_ok=True)
+
+    def acquire(self, priority, tenant=None, timeout=0):
+        """
+        Hold a slot for work of the given priority, waiting up to timeout seconds
+        Raises CapacityError (with a retry_after estimate) when none is free.
+        Without a tenant, assign one before the work starts (see full_tenants).
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            reason = self._pressure(priority)
+            if reason is None:
+                if tenant is None:
+                    slot, reason = self._try_acquire(priority, tenant)
+                else:
+                    with self.tenant_lock():
+                        slot, reason = self._try_acquire(priority, tenant)
+                if slot:
+                    return slot
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CapacityError(f"No processing capacity available ({reason})", reason, self.retry_after())
+            time.sleep(min(self.poll_interval, remaining))
+
+    def busy(self):
+        """Number of slots held on this node"""
+        return sum(1 for state in self._slot_states() if state)
+
+    def cores_per_slot(self):
+        """The node's cores divided between its slots"""
+        return max(1, (os.cpu_count() or 1) // self.max_slots)
+
+    def core_budget(self):
+        """
+        Cores for the work of one held slot right now: its own share plus the
+        shares of the slots standing idle, so a job alone on the node can use
+        all of it while a full node isn't oversubscribed
+        """
+        cores = os.cpu_count() or 1
+        idle = max(0, self.max_slots - self.busy())
+        return max(1, min(cores, cores * (1 + idle) // self.max_slots))
+
+    def full_tenants(self):
+        """Tenants holding their whole share of the slots (call under tenant_lock to act on it)"""
+        held = collections.Counter(state.get('tenant') for state in self._slot_states() if state)
+        return {tenant for tenant, count in held.items() if tenant is not None and count >= self.tenant_slots}
+
+    @contextlib.contextmanager
+    def tenant_lock(self):
+        """
+        Node-wide lock for choosing a slot's tenant: hold it from counting a
+        tenant's slots until the slot is assigned, or two processes can both
+        take a tenant's last share
+        """
+        with open(os.path.join(self.slot_dir, 'tenants.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def retry_after(self):
+        """Seconds until a slot is expected to free up, from how long recent slots were held"""
+        with self._lock:
+            durations = list(self._durations)
+        expected = sum(durations) / len(durations) if durations else self.default_duration
+
+        now = time.time()
+        remaining = [state['started'] + expected - now for state in self._slot_states() if state]
+        estimate = min(remaining) if remaining else expected / self.max_slots
+        return int(max(1, min(600, math.ceil(estimate))))
+
+    def _pressure(self, priority):
+        """Why the node can't take more work of this priority right now, or None"""
+        available = _available_memory()
+        if available is not None and available < self.min_free_memory:
+            return 'memory'
+        if priority > PRIORITY_INTERACTIVE:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load > self.max_load:
+                return 'cpu'
+        return None
+
+    def _try_acquire(self, priority, tenant):
+        """(Slot, None), or (None, reason) when no usable slot is free"""
+        usable = self.max_slots if priority == PRIORITY_INTERACTIVE else self.max_slots - self.reserved_slots
+        candidate = None
+        tenant_held = 0
+        for index in range(self.max_slots):
+            lock_file = open(self._slot_path(index), 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                tenant_held += _read_state(lock_file).get('tenant') == tenant
+                lock_file.close()
+                continue
+
+            if candidate is None and index < usable:
+                candidate = lock_file
+            else:
+                lock_file.truncate(0)  # left behind by a holder that died
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+        if candidate is None:
+            return None, 'slots'
+        if tenant is not None and tenant_held >= self.tenant_slots:
+            fcntl.flock(candidate, fcntl.LOCK_UN)
+            candidate.close()
+            return None, 'tenant'
+        return Slot(self, candidate, priority, tenant), None
+
+    def _slot_states(self):
+        states = []
+        for index in range(self.max_slots):
+            try:
+                with open(self._slot_path(index), 'r') as f:
+                    states.append(_read_state(f))
+            except FileNotFoundError:
+                states.append({})
+        return states
+
+    def _slot_path(self, index):
+        return os.path.join(self.slot_dir, f"slot-{index}.lock")
+
+    def _record(self, duration):
+        with self._lock:
+            self._durations.append(duration)
+
+
+def _read_state(f):
+    """State a holder wrote into a slot file ({} when free or being written)"""
+    f.seek(0)
+    try:
+        return json.loads(f.read() or '{}')
+    except ValueError:
+        return {}
+
+
+def _available_memory():
+    """MemAvailable in bytes, or None where /proc/meminfo doesn't exist"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,246 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+from services.fingerprint import content_hash, remember_content_hash, remembered_content_hash, stat_key
+from services.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+
+class SourceIndex:
+    """
+    Read-only view of the analysis index for one source
+
+    Each column is a .npy file opened memory-mapped, so loading an index only
+    touches the pages that are actually read.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self._columns = {}
+        self._meta_mtime = _mtime(os.path.join(path, 'meta.json'))
+
+    @property
+    def content_hash(self):
+        return self.meta['content_hash']
+
+    def has(self, group):
+        return group in self.meta['groups']
+
+    def is_current(self):
+        """False once another worker (or node) has added a group since this view was opened"""
+        return _mtime(os.path.join(self.path, 'meta.json')) == self._meta_mtime
+
+    def column(self, name):
+        """Memory-mapped array for a column, or None if it hasn't been built"""
+        import numpy as np
+        if name not in self._columns:
+            column_path = os.path.join(self.path, f"{name}.npy")
+            if not os.path.exists(column_path):
+                return None
+            self._columns[name] = np.load(column_path, mmap_mode='r')
+        return self._columns[name]
+
+    def transcript(self):
+        """Transcript segments as [{'start', 'end', 'text'}], or None if not built"""
+        times = self.column('transcript_times')
+        if times is None:
+            return None
+        with open(os.path.join(self.path, 'transcript_text.json'), 'r', encoding='utf-8') as f:
+            texts = json.load(f)
+        return [{'start': float(start), 'end': float(end), 'text': text}
+                for (start, end), text in zip(times, texts)]
+
+
+class AnalysisIndex:
+    """
+    Persistent per-source analysis index keyed by content hash
+
+    Columns are grouped by the builder that produces them ('signals', ...).
+    load() builds only the groups that are missing, so registering a new
+    builder extends existing indexes instead of re-analysing them. The
+    'transcript' group has no builder: it collects the segments transcribed
+    for captions (add_transcript). A file lock per source keeps concurrent
+    workers (or nodes sharing the directory) from building the same group
+    twice.
+    """
+
+    def __init__(self, index_dir, max_open=32):
+        self.index_dir = index_dir
+        self.max_open = max_open
+        self.builders = {}
+        self._open = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(index_dir, 'hashes'), exist_ok=True)
+
+    def register(self, group, builder):
+        """Register builder(video_path) -> {column_name: array} for a column group"""
+        self.builders[group] = builder
+
+    def load(self, video_path, require=('signals',)):
+        """Return the SourceIndex for video_path, building any required groups it lacks"""
+        digest = self.content_hash(video_path)
+        index = self._get_open(digest)
+        if index and index.is_current() and all(index.has(group) for group in require):
+            cache_lookup('analysis', True)
+            return index
+
+        source_dir = self._source_dir(digest)
+        os.makedirs(source_dir, exist_ok=True)
+        built = False
+        with self._file_lock(source_dir):
+            meta = self._read_meta(source_dir, digest)
+            for group in require:
+                if group in meta['groups']:
+                    continue
+                built = True
+                builder = self.builders.get(group)
+                if builder is None:
+                    raise ValueError(f"No builder registered for index group {group}")
+
+                logger.info(f"Building '{group}' index for {video_path} ({digest[:12]})")
+                columns = builder(video_path)
+                for name, values in columns.items():
+                    self._write_column(source_dir, name, values)
+                meta['groups'][group] = sorted(columns)
+                self._write_meta(source_dir, meta)
+
+        cache_lookup('analysis', not built)
+        index = SourceIndex(source_dir, meta)
+        self._set_open(digest, index)
+        return index
+
+    def add_transcript(self, video_path, start_time, end_time, captions):
+        """
+        Merge caption segments transcribed for [start_time, end_time) of video_path
+        (timestamps relative to start_time, as CaptionGenerator returns them)
+        into its 'transcript' group, replacing what was indexed for that range
+        """
+        digest = self.content_hash(video_path)
+        source_dir = self._source_dir(digest)
+        os.makedirs(source_dir, exist_ok=True)
+        with self._file_lock(source_dir):
+            meta = self._read_meta(source_dir, digest)
+            segments = []
+            if 'transcript' in meta['groups']:
+                segments = [s for s in SourceIndex(source_dir, meta).transcript()
+                            if s['end'] <= start_time or s['start'] >= end_time]
+            segments += [{'start': c['start'] + start_time, 'end': c['end'] + start_time, 'text': c['text']}
+                         for c in captions]
+            columns = transcript_columns(sorted(segments, key=lambda s: s['start']))
+            for name, values in columns.items():
+                self._write_column(source_dir, name, values)
+            meta['groups']['transcript'] = sorted(columns)
+            self._write_meta(source_dir, meta)
+        with self._lock:
+            self._open.pop(digest, None)
+
+    def content_hash(self, video_path):
+        """
+        Content hash of video_path, remembered on disk by stat key so other
+        processes, nodes sharing the directory and restarts don't rehash large
+        files (the output cache keys inputs by it too)
+        """
+        key = stat_key(video_path)
+        hash_path = os.path.join(self.index_dir, 'hashes', key)
+        try:
+            with open(hash_path, 'r') as f:
+                digest = f.read().strip()
+            os.utime(hash_path)  # for eviction by age (see app._enforce_storage_limits)
+            remember_content_hash(video_path, digest, key)
+            return digest
+        except OSError:
+            pass
+
+        # Known to this process (e.g. hashed while uploaded), or read the file
+        digest = remembered_content_hash(key) or content_hash(video_path)
+        tmp_path = f"{hash_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(digest)
+        os.replace(tmp_path, hash_path)
+        return digest
+
+    def _source_dir(self, digest):
+        return os.path.join(self.index_dir, digest[:2], digest)
+
+    def _read_meta(self, source_dir, digest):
+        meta_path = os.path.join(source_dir, 'meta.json')
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') == INDEX_VERSION:
+                return meta
+            logger.info(f"Discarding index {digest[:12]} built by version {meta.get('version')}")
+        except (OSError, ValueError):
+            pass
+        return {'version': INDEX_VERSION, 'content_hash': digest, 'groups': {}}
+
+    def _write_meta(self, source_dir, meta):
+        meta_path = os.path.join(source_dir, 'meta.json')
+        tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _write_column(self, source_dir, name, values):
+        import numpy as np
+        if name == 'transcript_text':
+            column_path = os.path.join(source_dir, 'transcript_text.json')
+            tmp_path = f"{column_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(values), f)
+        else:
+            column_path = os.path.join(source_dir, f"{name}.npy")
+            tmp_path = f"{column_path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+            np.save(tmp_path, np.ascontiguousarray(values))
+        os.replace(tmp_path, column_path)
+
+    @contextlib.contextmanager
+    def _file_lock(self, source_dir):
+        with open(os.path.join(source_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_open(self, digest):
+        with self._lock:
+            return self._open.get(digest)
+
+    def _set_open(self, digest, index):
+        with self._lock:
+            self._open[digest] = index
+            while len(self._open) > self.max_open:
+                self._open.pop(next(iter(self._open)))
+
+
+def _mtime(path):
+    """Identity of a file's current version (it is only ever replaced, never rewritten)"""
+    try:
+        st = os.stat(path)
+        return st.st_ino, st.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def signal_columns(signals):
+    """Index columns for a SignalSet, plus shot boundaries derived from its cuts"""
+    import numpy as np
+    columns = {name: np.asarray(values, dtype=np.float32)
+               for name, values in signals.as_dict().items()}
+    columns['shot_boundaries'] = np.flatnonzero(columns['cuts'] > 0).astype(np.float32)
+    return columns
+
+
+def transcript_columns(captions):
+    """Index columns for caption segments [{'start', 'end', 'text'}]"""
+    import numpy as np
+    times = np.array([[c['start'], c['end']] for c in captions], dtype=np.float32).reshape(-1, 2)
+    return {'transcript_times': times, 'transcript_text': [c['text'] for c in captions]}
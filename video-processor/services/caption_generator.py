@@ -1,75 +1,185 @@
 import os
 import logging
-from openai import OpenAI
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from services.ffmpeg_runner import drain_stderr, wait_process
+from services.media_probe import MediaProbe
+from services.metrics import MOCK_CAPTIONS, propagate, stage
+from services.renditions import rendition_for_platform
+from services.transcription import WhisperBackend, detect_silences, merge_chunk_segments, plan_chunks
 
 logger = logging.getLogger(__name__)
 
+# Audio sent for transcription: 16 kHz mono, as WAV, lossless FLAC (~2x smaller)
+# or low-bitrate Opus (~10x smaller than WAV)
+AUDIO_FORMATS = {
+    'wav': {'extension': 'wav', 'options': {'format': 'wav', 'acodec': 'pcm_s16le'}},
+    'flac': {'extension': 'flac', 'options': {'format': 'flac', 'acodec': 'flac'}},
+    'opus': {'extension': 'ogg', 'options': {'format': 'ogg', 'acodec': 'libopus', 'audio_bitrate': '24k'}}
+}
+
 class CaptionGenerator:
     """Generate captions for videos using speech-to-text"""
     
-    def __init__(self):
-        self.client = None
-        api_key = os.getenv('OPENAI_API_KEY')
-        if api_key:
-            self.client = OpenAI(api_key=api_key)
+    def __init__(self, backend=None, probe=None, max_chunk_seconds=600, max_parallel=4,
+                 chunk_padding=2.0, audio_format='flac', spool_size=32 * 1024 * 1024,
+                 cache=None, index=None):
+        self.backend = backend
+        self.cache = cache
+        self.index = index  # AnalysisIndex that collects transcripts for clip selection
+        # The OpenAI client (and its import) waits for the first transcription, so it
+        # is neither paid for at startup nor shared across forked worker processes
+        self._api_key = os.getenv('OPENAI_API_KEY') if backend is None else None
+        self._backend_lock = threading.Lock()
+        self.probe = probe or MediaProbe()
+        self.max_chunk_seconds = max_chunk_seconds  # 16 kHz WAV chunks stay under the 25 MB upload limit
+        self.max_parallel = max_parallel
+        self.chunk_padding = chunk_padding  # seconds of overlap transcribed on each side of a boundary
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported caption audio format: {audio_format}")
+        self.audio_format = audio_format
+        self.spool_size = spool_size  # bytes of audio kept in memory before spilling to a temp file
     
-    def generate_captions(self, video_path):
+    def generate_captions(self, video_path, start_time=0, duration=None):
         """
-        Generate captions from video audio using Whisper
+        Generate captions from video audio using the transcription backend
+        When start_time/duration are given only that range is transcribed and
+        caption timestamps are relative to start_time
+        Long ranges are split at silences and the chunks transcribed in parallel
+        Ranges already transcribed for the same audio are served from the cache
         Returns list of caption segments
         """
         try:
-            if not self.client:
+            if not self._get_backend():
                 logger.warning("OpenAI API key not configured, using mock captions")
+                MOCK_CAPTIONS.inc(reason='no_backend')
                 return self._generate_mock_captions()
             
             logger.info(f"Generating captions for: {video_path}")
             
-            # Extract audio from video
-            audio_path = self._extract_audio(video_path)
+            info = self.probe.probe(video_path)
+            if not info.has_audio:
+                logger.info(f"No audio stream in {video_path}, no captions to generate")
+                return []
+            
+            remaining = max(0, info.duration - start_time)
+            total = min(duration, remaining) if duration else remaining
+            
+            audio_key = self._audio_key(video_path, info.duration)
+            if audio_key:
+                cached = self.cache.lookup(audio_key, start_time, start_time + total)
+                if cached is not None:
+                    logger.info(f"Serving {len(cached)} caption segments from transcript cache")
+                    return cached
             
-            # Transcribe using Whisper
-            with open(audio_path, 'rb') as audio_file:
-                transcript = self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="verbose_json",
-                    timestamp_granularities=["segment"]
-                )
+            silences = []
+            if total > self.max_chunk_seconds:
+                silences = detect_silences(video_path, start_time, total)
+            chunks = plan_chunks(total, silences, self.max_chunk_seconds)
             
-            # Convert to caption format
-            captions = []
-            for segment in transcript.segments:
-                captions.append({
-                    'start': segment['start'],
-                    'end': segment['end'],
-                    'text': segment['text'].strip()
-                })
+            with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(chunks))) as executor:
+                results = list(executor.map(
+                    propagate(lambda chunk: self._transcribe_chunk(video_path, start_time, total, *chunk)),
+                    chunks))
             
-            # Clean up temp audio file
-            os.remove(audio_path)
+            captions = merge_chunk_segments(results)
+            logger.info(f"Generated {len(captions)} caption segments from {len(chunks)} chunks")
             
-            logger.info(f"Generated {len(captions)} caption segments")
+            if audio_key:
+                self.cache.store(audio_key, start_time, start_time + total, captions)
+            self._index_transcript(video_path, start_time, start_time + total, captions)
             return captions
             
         except Exception as e:
             logger.error(f"Error generating captions: {str(e)}")
+            MOCK_CAPTIONS.inc(reason='error')
             return self._generate_mock_captions()
     
-    def _extract_audio(self, video_path):
-        """Extract audio from video file"""
+    def _get_backend(self):
+        """The transcription backend, creating the Whisper client on first use"""
+        with self._backend_lock:
+            if self.backend is None and self._api_key:
+                from openai import OpenAI
+                self.backend = WhisperBackend(OpenAI(api_key=self._api_key))
+            return self.backend
+    
+    def _audio_key(self, video_path, duration):
+        """Transcript cache key for video_path, or None when caching is off or fails"""
+        if not self.cache:
+            return None
+        try:
+            return self.cache.audio_key(video_path, duration)
+        except Exception as e:
+            logger.warning(f"Transcript cache unavailable for {video_path}: {str(e)}")
+            return None
+    
+    def _index_transcript(self, video_path, start_time, end_time, captions):
+        """Add a fresh transcript to the analysis index; failures only cost the quotes heuristic"""
+        if not self.index:
+            return
+        try:
+            self.index.add_transcript(video_path, start_time, end_time, captions)
+        except Exception as e:
+            logger.warning(f"Could not index transcript for {video_path}: {str(e)}")
+    
+    def _transcribe_chunk(self, video_path, start_time, total, chunk_start, chunk_end):
+        """Transcribe [chunk_start, chunk_end) plus padding; returns a merge_chunk_segments entry"""
+        audio_start = max(0.0, chunk_start - self.chunk_padding)
+        audio_end = min(total, chunk_end + self.chunk_padding)
+        
+        with stage('audio_extract'):
+            audio = self._extract_audio(video_path, start_time + audio_start, audio_end - audio_start)
+        with audio as audio_file, stage('transcribe'):
+            extension = AUDIO_FORMATS[self.audio_format]['extension']
+            segments = self.backend.transcribe(audio_file, f"chunk_{int(chunk_start)}.{extension}",
+                                               audio_end - audio_start)
+        
+        return chunk_start, chunk_end, audio_start, segments
+    
+    def _extract_audio(self, video_path, start_time=0, duration=None):
+        """
+        Extract audio from video file, optionally limited to a time range
+        FFmpeg's stdout is streamed into a spooled buffer, so nothing touches
+        disk unless the encoded audio outgrows spool_size
+        Returns the buffer rewound to the start; close it when done
+        """
         import ffmpeg
         
-        audio_path = video_path.replace('.mp4', '_audio.wav')
+        input_kwargs = {}
+        if start_time:
+            input_kwargs['ss'] = start_time
+        if duration:
+            input_kwargs['t'] = duration
         
-        stream = ffmpeg.input(video_path)
-        stream = ffmpeg.output(stream, audio_path,
-                              acodec='pcm_s16le',
-                              ac=1,
-                              ar='16k')
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
+        output_kwargs = dict(AUDIO_FORMATS[self.audio_format]['options'])
+        stream = ffmpeg.input(video_path, **input_kwargs).audio
+        stream = ffmpeg.output(stream, 'pipe:1', ac=1, ar='16k', **output_kwargs)
         
-        return audio_path
+        process = subprocess.Popen(stream.compile(), stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr_thread, stderr_tail = drain_stderr(process)
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            shutil.copyfileobj(process.stdout, buffer)
+            wait_process(process)
+            stderr_thread.join(timeout=1)
+            if process.returncode != 0:
+                raise ffmpeg.Error('ffmpeg', None, b''.join(stderr_tail))
+        except BaseException:
+            buffer.close()
+            process.kill()
+            process.wait()
+            raise
+        
+        buffer.seek(0)
+        return buffer
+    
+    def is_mock(self, captions):
+        """True if captions are the placeholder returned when transcription isn't available"""
+        return captions == self._generate_mock_captions()
     
     def _generate_mock_captions(self):
         """Generate mock captions for testing"""
@@ -82,7 +192,13 @@ class CaptionGenerator:
     def format_for_social_media(self, captions, platform='tiktok'):
         """
         Format captions specifically for social media platforms
+        platform may also be a rendition profile name (e.g. 'shorts', 'reels'),
+        which formats captions in that profile's caption style
         """
+        rendition = rendition_for_platform(platform)
+        if rendition and rendition.caption_format:
+            platform = rendition.caption_format
+        
         if platform == 'tiktok':
             # TikTok style: shorter segments, more dynamic
             return self._format_for_tiktok(captions)
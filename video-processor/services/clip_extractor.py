@@ -1,12 +1,21 @@
 import logging
+import os
 import random
+import tempfile
+from services.analysis_index import AnalysisIndex, signal_columns
+from services.media_probe import MediaProbe, ProbeError
+from services.signal_analyzer import SignalAnalyzer, SignalSet
 
 logger = logging.getLogger(__name__)
 
 class ClipExtractor:
-    """Extract interesting clips from videos using AI analysis"""
+    """Extract interesting clips from videos using signal analysis"""
     
-    def __init__(self):
+    def __init__(self, probe=None, analyzer=None, index=None):
+        self.probe = probe or MediaProbe()
+        self.analyzer = analyzer or SignalAnalyzer()
+        self.index = index or AnalysisIndex(os.path.join(tempfile.gettempdir(), 'clip-index'))
+        self.index.register('signals', self._build_signals)
         self.clip_types = {
             'highlight': self._find_highlights,
             'funny': self._find_funny_moments,
@@ -16,76 +25,99 @@ class ClipExtractor:
             'random': self._find_random_clip
         }
     
-    def extract_clip(self, video_path, clip_type='highlight', duration=60):
+    def extract_clip(self, video_path, clip_type='highlight', duration=60, exclude=()):
         """
         Extract a clip from video based on type
+        exclude is [(start_time, end_time)] of windows the clip must not overlap
         Returns: (start_time, end_time)
         """
         try:
             logger.info(f"Extracting {clip_type} clip from {video_path}")
             
             extractor_func = self.clip_types.get(clip_type, self._find_highlights)
-            start_time, end_time = extractor_func(video_path, duration)
+            start_time, end_time = extractor_func(video_path, duration, exclude)
             
             logger.info(f"Clip extracted: {start_time}s to {end_time}s")
             return start_time, end_time
             
+        except ProbeError:
+            raise
         except Exception as e:
             logger.error(f"Error extracting clip: {str(e)}")
             # Fallback to random clip
             return self._find_random_clip(video_path, duration)
     
-    def _find_highlights(self, video_path, duration):
-        """
-        Find highlight moments using video analysis
-        In production, this would use Google Cloud Video Intelligence API
-        or custom ML models to detect interesting moments
-        """
-        # Mock implementation - would use actual video analysis
-        video_length = self._get_video_duration(video_path)
-        start_time = random.randint(0, max(0, int(video_length - duration)))
-        end_time = start_time + duration
-        return start_time, end_time
+    def extract_clips(self, video_path, specs, exclude=()):
+        """
+        Extract several distinct clips [(clip_type, duration)] from one source
+        The source is analysed once; each clip avoids the windows already picked
+        Returns: [(start_time, end_time)] in the order of specs
+        """
+        picked = list(exclude)
+        windows = []
+        for clip_type, duration in specs:
+            window = self.extract_clip(video_path, clip_type, duration, exclude=picked)
+            picked.append(window)
+            windows.append(window)
+        return windows
     
-    def _find_funny_moments(self, video_path, duration):
+    def _find_highlights(self, video_path, duration, exclude=()):
         """
-        Detect funny moments using audio analysis (laughter detection)
-        and visual cues
+        Find highlight moments: sustained motion, cuts and loud, bright audio together
         """
-        # Mock implementation
-        video_length = self._get_video_duration(video_path)
-        start_time = random.randint(0, max(0, int(video_length - duration)))
-        return start_time, start_time + duration
+        return self._best_window(self._highlight_scores(self._get_signals(video_path)), duration, exclude)
     
-    def _find_action_scenes(self, video_path, duration):
+    def _highlight_scores(self, signals):
+        """Equal-weight blend of motion, cuts, loudness and high-frequency energy"""
+        return (_zscore(signals.motion) + _zscore(signals.cuts) +
+                _zscore(signals.audio_rms) + _zscore(signals.high_energy)) / 4
+    
+    def _find_funny_moments(self, video_path, duration, exclude=()):
         """
-        Detect action scenes using motion detection and audio analysis
+        Detect funny moments from audio bursts with strong high-frequency
+        content (laughter, cheering)
         """
-        # Mock implementation
-        video_length = self._get_video_duration(video_path)
-        start_time = random.randint(0, max(0, int(video_length - duration)))
-        return start_time, start_time + duration
+        signals = self._get_signals(video_path)
+        scores = _zscore(signals.audio_rms) + _zscore(signals.high_energy)
+        return self._best_window(scores, duration, exclude)
     
-    def _find_dramatic_scenes(self, video_path, duration):
+    def _find_action_scenes(self, video_path, duration, exclude=()):
         """
-        Detect dramatic moments using music analysis and scene changes
+        Detect action scenes from frame motion, fast cutting and loud audio
         """
-        # Mock implementation
-        video_length = self._get_video_duration(video_path)
-        start_time = random.randint(0, max(0, int(video_length - duration)))
-        return start_time, start_time + duration
+        signals = self._get_signals(video_path)
+        scores = 2 * _zscore(signals.motion) + _zscore(signals.cuts) + _zscore(signals.audio_rms)
+        return self._best_window(scores, duration, exclude)
     
-    def _find_memorable_quotes(self, video_path, duration):
+    def _find_dramatic_scenes(self, video_path, duration, exclude=()):
         """
-        Extract clips with memorable quotes using speech-to-text
-        and sentiment analysis
+        Detect dramatic moments from large swings in audio level and scene changes
         """
-        # Mock implementation
-        video_length = self._get_video_duration(video_path)
-        start_time = random.randint(0, max(0, int(video_length - duration)))
-        return start_time, start_time + duration
+        import numpy as np
+        signals = self._get_signals(video_path)
+        swings = np.abs(np.diff(signals.audio_rms, prepend=signals.audio_rms[:1]))
+        scores = 2 * _zscore(swings) + _zscore(signals.cuts)
+        return self._best_window(scores, duration, exclude)
+    
+    def _find_memorable_quotes(self, video_path, duration, exclude=()):
+        """
+        Find dialogue-heavy stretches: voice-band audio energy with little motion
+        """
+        import numpy as np
+        index = self.index.load(video_path)
+        signals = self._get_signals(video_path)
+        scores = 2 * _zscore(signals.speech) + _zscore(signals.audio_rms) - _zscore(signals.motion)
+        
+        # Prefer seconds that have transcribed speech when a transcript is indexed
+        # (ranges captioned before, see CaptionGenerator)
+        times = index.column('transcript_times')
+        if times is not None and len(times):
+            seconds = np.arange(len(scores))
+            spoken = ((seconds[:, None] >= times[:, 0]) & (seconds[:, None] < times[:, 1])).any(axis=1)
+            scores = scores + spoken
+        return self._best_window(scores, duration, exclude)
     
-    def _find_random_clip(self, video_path, duration):
+    def _find_random_clip(self, video_path, duration, exclude=()):
         """
         Extract a random clip from the video
         """
@@ -94,26 +126,68 @@ class ClipExtractor:
         return start_time, start_time + duration
     
     def _get_video_duration(self, video_path):
-        """Get video duration in seconds"""
-        import ffmpeg
-        try:
-            probe = ffmpeg.probe(video_path)
-            video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-            duration = float(video_info.get('duration', 0))
-            return duration
-        except:
-            # Default to 10 minutes if can't determine
-            return 600
+        """Get video duration in seconds (raises ProbeError if it can't be determined)"""
+        return self.probe.probe(video_path).duration
+    
+    def _get_signals(self, video_path):
+        """Per-second signals for video_path from the analysis index (built on first use)"""
+        index = self.index.load(video_path)
+        return SignalSet(**{name: index.column(name) for name in SignalSet.NAMES})
+    
+    def _build_signals(self, video_path):
+        """Index builder for the 'signals' group"""
+        info = self.probe.probe(video_path)
+        return signal_columns(self.analyzer.analyze(video_path, has_audio=info.has_audio))
+    
+    def _window_means(self, scores, duration):
+        """Mean score of every duration-second window, via a cumulative sum"""
+        import numpy as np
+        window = max(1, min(int(round(duration)), len(scores)))
+        totals = np.concatenate([[0.0], np.cumsum(scores, dtype=np.float64)])
+        return (totals[window:] - totals[:-window]) / window
+    
+    def _best_window(self, scores, duration, exclude=()):
+        """(start_time, end_time) of the highest scoring window not overlapping any in exclude"""
+        import numpy as np
+        if len(scores) == 0:
+            return 0, duration
+        means = self._window_means(scores, duration)
+        
+        allowed = np.ones(len(means), dtype=bool)
+        for excluded_start, excluded_end in exclude:
+            first = max(0, int(np.floor(excluded_start - duration)) + 1)
+            allowed[first:max(0, int(np.ceil(excluded_end)))] = False
+        if allowed.any():
+            means = np.where(allowed, means, -np.inf)
+        
+        start_time = int(np.argmax(means))
+        return start_time, start_time + duration
     
     def analyze_engagement_score(self, video_path, start_time, end_time):
         """
-        Analyze potential engagement score for a clip
-        This would use ML models trained on viral content
-        """
-        # Mock implementation - would use actual ML model
-        score = random.uniform(0.5, 1.0)
+        Estimate engagement for a clip from how its highlight signals rank
+        against every other window of the same length in the source
+        """
+        scores = self._highlight_scores(self._get_signals(video_path))
+        
+        duration = max(1, end_time - start_time)
+        windows = self._window_means(scores, duration)
+        index = min(max(0, int(start_time)), len(windows) - 1)
+        percentile = float((windows <= windows[index]).mean()) if len(windows) else 0.5
+        
+        score = 0.5 + 0.5 * percentile
         return {
             'engagement_score': score,
             'predicted_views': int(score * 100000),
             'viral_potential': 'high' if score > 0.8 else 'medium' if score > 0.6 else 'low'
         }
+
+
+def _zscore(values):
+    """Standardise a signal so different units can be summed"""
+    import numpy as np
+    values = np.asarray(values, dtype=np.float32)
+    std = values.std()
+    if not std:
+        return np.zeros_like(values)
+    return (values - values.mean()) / std
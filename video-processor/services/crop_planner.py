@@ -0,0 +1,307 @@
+import bisect
+import logging
+import subprocess
+import threading
+import time
+import ffmpeg
+from services.ffmpeg_runner import drain_stderr, wait_process
+from services.metrics import stage
+from services.signal_analyzer import AnalysisError, _read_exact, luma_histograms
+
+logger = logging.getLogger(__name__)
+
+
+class CropPath:
+    """
+    Time-varying crop offset along one axis ('x' or 'y') of the source
+
+    keypoints are (time, offset) pairs with times relative to the start of
+    the planned range and offsets in source pixels. The offset moves
+    linearly between keypoints; two keypoints at the same time are a jump
+    (a shot cut).
+    """
+
+    def __init__(self, axis, keypoints):
+        self.axis = axis
+        self.keypoints = keypoints
+
+    def value_at(self, t):
+        """Crop offset at time t"""
+        times = [keypoint[0] for keypoint in self.keypoints]
+        i = bisect.bisect_right(times, t)
+        if i == 0:
+            return self.keypoints[0][1]
+        if i == len(self.keypoints):
+            return self.keypoints[-1][1]
+        (a, start), (b, end) = self.keypoints[i - 1], self.keypoints[i]
+        return start + (end - start) * (t - a) / (b - a)
+
+    def window(self, start, duration=None):
+        """The path for [start, start + duration), with times relative to start"""
+        end = start + duration if duration is not None else float('inf')
+        keypoints = [(0.0, int(round(self.value_at(start))))]
+        keypoints += [(round(t - start, 3), offset) for t, offset in self.keypoints if start < t < end]
+        if end != float('inf'):
+            keypoints.append((round(end - start, 3), int(round(self.value_at(end)))))
+        return CropPath(self.axis, keypoints)
+
+    def expression(self):
+        """
+        FFmpeg expression for the offset at frame time t
+        A flat sum of clipped ramps and steps, so its length grows linearly
+        with the number of keypoints instead of nesting if() calls
+        """
+        terms = [str(self.keypoints[0][1])]
+        for (a, start), (b, end) in zip(self.keypoints, self.keypoints[1:]):
+            if end == start:
+                continue
+            if b - a < 1e-6:
+                terms.append(f"{end - start:+d}*gte(t,{a:.3f})")
+            else:
+                terms.append(f"{(end - start) / (b - a):+.3f}*clip(t-{a:.3f},0,{b - a:.3f})")
+        return ''.join(terms)
+
+
+class CropPlanner:
+    """
+    Plan a content-aware crop path from a low-resolution proxy decode
+
+    The range is decoded once at proxy size and a few frames per second
+    (non-reference frames are skipped by the decoder), and every frame is
+    scored with vectorized NumPy: motion energy plus texture, plus detected
+    faces when OpenCV is installed. Each frame's best crop window is the one
+    holding the most saliency. The per-frame positions are split into shots
+    at histogram cuts, median-filtered, smoothed, speed-limited and reduced
+    to a few keypoints per shot. Shots that barely move hold one position,
+    and a path that stays near the centre is dropped so the caller keeps
+    its static crop.
+    """
+
+    def __init__(self, probe, width=160, fps=4, smoothing=1.0, max_speed=0.5, hold_tolerance=0.04,
+                 center_bias=0.15, cut_threshold=0.5, face_weight=4.0):
+        self.probe = probe
+        self.width = width  # proxy width in pixels
+        self.fps = fps
+        self.smoothing = smoothing  # Gaussian smoothing sigma in seconds
+        self.max_speed = max_speed  # fastest pan, in crop widths per second
+        self.hold_tolerance = hold_tolerance  # movement (fraction of the source) treated as still
+        self.center_bias = center_bias  # score penalty for windows at the very edge
+        self.cut_threshold = cut_threshold  # L1 histogram distance (0-2) counted as a cut
+        self.face_weight = face_weight
+        self._face_detector = None
+        self._face_detector_loaded = False
+        self._lock = threading.Lock()
+
+    def load_face_detector(self):
+        """
+        OpenCV's face detector, imported and loaded on first use (OpenCV is
+        slow to import); None when OpenCV isn't installed
+        """
+        with self._lock:
+            if not self._face_detector_loaded:
+                try:
+                    import cv2
+                    self._face_detector = cv2.CascadeClassifier(
+                        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+                except ImportError:  # face detection is optional; saliency alone still finds the subject
+                    logger.info("OpenCV not installed, planning crops without face detection")
+                self._face_detector_loaded = True
+            return self._face_detector
+
+    def plan(self, input_path, crop, start_time=0, end_time=None):
+        """
+        CropPath for the static crop (width, height, x, y) over [start_time, end_time),
+        or None when the centre crop should be kept
+        """
+        info = self.probe.probe(input_path)
+        end_time = min(end_time, info.duration) if end_time else info.duration
+        crop_width, crop_height, _, _ = crop
+        if crop_width < info.width:
+            axis, span, size = 'x', info.width, crop_width
+        elif crop_height < info.height:
+            axis, span, size = 'y', info.height, crop_height
+        else:
+            return None
+
+        proxy_width = self.width
+        proxy_height = max(2, int(round(proxy_width * info.height / info.width / 2)) * 2)
+        started = time.monotonic()
+        with stage('crop_plan'):
+            positions, cuts = self._analyze(input_path, start_time, end_time, proxy_width, proxy_height,
+                                            axis, size / span)
+        if len(positions) == 0:
+            return None
+
+        slack = span - size
+        targets = positions * slack
+        keypoints = self._keypoints(targets, cuts, slack, span, size)
+        elapsed = time.monotonic() - started
+        logger.info(f"Planned crop path for {input_path} ({start_time}s-{end_time}s) in {elapsed:.2f}s: "
+                    f"{len(keypoints)} keypoints over {len(positions)} proxy frames")
+
+        center = slack / 2
+        if all(abs(offset - center) <= self.hold_tolerance * span for _, offset in keypoints):
+            return None
+        return CropPath(axis, keypoints)
+
+    def _analyze(self, input_path, start_time, end_time, proxy_width, proxy_height, axis, window_fraction):
+        """
+        Per proxy frame: the best window position as a fraction (0-1) of the
+        crop's travel, and a flag for frames that start a new shot
+        """
+        import numpy as np
+        stream = (ffmpeg.input(input_path, ss=start_time, t=end_time - start_time, skip_frame='noref')
+                  .video
+                  .filter('fps', self.fps)
+                  .filter('scale', proxy_width, proxy_height)
+                  .output('pipe:1', format='rawvideo', pix_fmt='gray'))
+        args = stream.global_args('-v', 'error').compile()
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stderr_thread, stderr_tail = drain_stderr(process)
+
+        frame_size = proxy_width * proxy_height
+        positions, cuts = [], []
+        previous, previous_hist = None, None
+        try:
+            while True:
+                data = _read_exact(process.stdout, frame_size * self.fps * 8)
+                count = len(data) // frame_size
+                if count == 0:
+                    break
+
+                frames = np.frombuffer(data[:count * frame_size], dtype=np.uint8)
+                frames = frames.reshape(count, proxy_height, proxy_width)
+                if axis == 'y':
+                    frames = frames.transpose(0, 2, 1)
+
+                hists = luma_histograms(frames.reshape(count, -1).astype(np.int16))
+                if previous_hist is None:
+                    distances = np.concatenate([[0.0], np.abs(np.diff(hists, axis=0)).sum(axis=1)])
+                else:
+                    distances = np.abs(np.diff(np.vstack([previous_hist, hists]), axis=0)).sum(axis=1)
+                block_cuts = distances > self.cut_threshold
+
+                profiles = self._profiles(frames, previous, block_cuts)
+                positions.append(self._best_windows(profiles, window_fraction))
+                cuts.append(block_cuts)
+                previous, previous_hist = frames[-1:], hists[-1:]
+        finally:
+            process.stdout.close()
+            wait_process(process)
+            stderr_thread.join(timeout=1)
+
+        if process.returncode != 0:
+            stderr = b''.join(stderr_tail).decode('utf-8', 'replace').strip()
+            raise AnalysisError(f"Crop analysis decode failed for {input_path}: {stderr}")
+        if not positions:
+            return np.zeros(0), np.zeros(0, dtype=bool)
+        return np.concatenate(positions), np.concatenate(cuts)
+
+    def _profiles(self, frames, previous, cuts):
+        """Saliency summed down each column of every frame, shape (frames, columns)"""
+        import numpy as np
+        current = frames.astype(np.float32)
+        before = np.concatenate([previous.astype(np.float32) if previous is not None else current[:1],
+                                 current[:-1]])
+        motion = np.abs(current - before)
+        motion[cuts] = 0  # the difference across a cut says nothing about the new shot
+        texture = (np.abs(np.diff(current, axis=2, append=current[:, :, -1:]))
+                   + np.abs(np.diff(current, axis=1, append=current[:, -1:, :])))
+
+        def normalised(maps):
+            return maps / (maps.mean(axis=(1, 2), keepdims=True) + 1e-6)
+
+        saliency = 0.6 * normalised(motion) + 0.4 * normalised(texture)
+        profiles = saliency.sum(axis=1)
+
+        face_detector = self.load_face_detector()
+        if face_detector is not None:
+            for i, frame in enumerate(frames):
+                # Boxes are (x, y, w, h) in the frame as analysed (transposed for 'y')
+                for x, _, w, h in face_detector.detectMultiScale(np.ascontiguousarray(frame),
+                                                                  scaleFactor=1.2, minNeighbors=4,
+                                                                  minSize=(12, 12)):
+                    profiles[i, x:x + w] += self.face_weight * profiles[i].mean() * h
+        return profiles
+
+    def _best_windows(self, profiles, window_fraction):
+        """Left edge of each frame's highest-scoring window, as a fraction of the travel"""
+        import numpy as np
+        columns = profiles.shape[1]
+        window = min(columns - 1, max(1, int(round(columns * window_fraction))))
+        totals = np.concatenate([np.zeros((len(profiles), 1)), np.cumsum(profiles, axis=1)], axis=1)
+        scores = totals[:, window:] - totals[:, :-window]
+
+        travel = scores.shape[1] - 1
+        if travel <= 0:
+            return np.full(len(profiles), 0.5)
+        # Gently prefer the centre so flat frames don't wander
+        distance = np.abs(np.arange(travel + 1) / travel - 0.5) * 2
+        scores = scores * (1 - self.center_bias * distance ** 2)
+        return np.argmax(scores, axis=1) / travel
+
+    def _keypoints(self, targets, cuts, slack, span, size):
+        """Smoothed, speed-limited keypoints [(time, offset)] for per-frame target offsets"""
+        import numpy as np
+        boundaries = [0] + [int(i) for i in np.flatnonzero(cuts) if i > 0] + [len(targets)]
+        keypoints = []
+        for first, last in zip(boundaries, boundaries[1:]):
+            path = self._smooth(targets[first:last], slack, size)
+            if np.ptp(path) <= self.hold_tolerance * span:
+                path = np.full(len(path), np.median(path))
+
+            # Proxy frame i shows time i / fps; a cut is placed between the frames either side of it
+            times = np.arange(first, last) / self.fps
+            if first:
+                times[0] = (first - 0.5) / self.fps
+            shot = [(round(float(t), 3), int(round(o))) for t, o in
+                    _simplify(times, path, self.hold_tolerance * span / 2)]
+            if keypoints:
+                # Hold the previous shot's crop up to the cut, then jump
+                keypoints.append((shot[0][0], keypoints[-1][1]))
+            keypoints.extend(shot)
+        return keypoints
+
+    def _smooth(self, targets, slack, size):
+        """Median filter (drop single-frame outliers), Gaussian smoothing, then a pan speed limit"""
+        import numpy as np
+        if len(targets) >= 3:
+            padded = np.pad(targets, 1, mode='edge')
+            targets = np.median(np.lib.stride_tricks.sliding_window_view(padded, 3), axis=1)
+
+        sigma = self.smoothing * self.fps
+        if sigma > 0 and len(targets) > 1:
+            radius = int(3 * sigma)
+            kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+            padded = np.pad(targets, radius, mode='edge')
+            targets = np.convolve(padded, kernel / kernel.sum(), mode='valid')
+
+        max_step = self.max_speed * size / self.fps
+        path = np.empty(len(targets))
+        path[0] = targets[0]
+        for i in range(1, len(targets)):
+            path[i] = path[i - 1] + np.clip(targets[i] - path[i - 1], -max_step, max_step)
+        return np.clip(path, 0, slack)
+
+
+def _simplify(times, values, tolerance):
+    """Ramer-Douglas-Peucker: the fewest points whose linear interpolation stays within tolerance"""
+    import numpy as np
+    keep = np.zeros(len(times), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(times) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        span = np.arange(first + 1, last)
+        line = values[first] + (values[last] - values[first]) * (
+            (times[span] - times[first]) / max(times[last] - times[first], 1e-9))
+        errors = np.abs(values[span] - line)
+        worst = int(np.argmax(errors))
+        if errors[worst] > tolerance:
+            keep[span[worst]] = True
+            stack.append((first, span[worst]))
+            stack.append((span[worst], last))
+    return list(zip(times[keep], values[keep]))
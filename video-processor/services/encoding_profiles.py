@@ -0,0 +1,169 @@
+import json
+import logging
+import math
+import re
+from dataclasses import asdict, dataclass
+from services.metrics import ENCODES
+
+logger = logging.getLogger(__name__)
+
+# Source audio codecs that can be stream-copied into an MP4 output
+COPYABLE_AUDIO = ('aac', 'mp3')
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """
+    libx264 speed/quality settings applied on top of a rendition's encode options
+
+    With crf set the encode is constant-quality, capped by VBV at
+    maxrate_factor times the rendition's bitrate (so platform limits still
+    hold); without it the rendition's bitrate is the average target. audio
+    is 'copy' (stream-copy the source's audio when it is MP4-compatible and
+    unfiltered) or 'encode' (AAC at the rendition's audio bitrate).
+    threads of None leaves the choice to x264.
+    """
+    name: str
+    preset: str
+    crf: int = None
+    maxrate_factor: float = 1.5
+    bufsize_factor: float = 2.0
+    threads: int = None
+    tune: str = None
+    audio: str = 'encode'
+
+    def apply(self, options, copy_audio=False):
+        """A copy of options (see Rendition.encode_options) with this profile's settings"""
+        options = dict(options)
+        options['preset'] = self.preset
+        if self.tune:
+            options['tune'] = self.tune
+        if self.threads:
+            options['threads'] = self.threads
+
+        bitrate = parse_bitrate(options.get('video_bitrate'))
+        if self.crf is not None:
+            options.pop('video_bitrate', None)
+            options['crf'] = self.crf
+        if bitrate:
+            maxrate = int(bitrate * self.maxrate_factor)
+            options['maxrate'] = maxrate
+            options['bufsize'] = int(maxrate * self.bufsize_factor)
+
+        if copy_audio and self.audio == 'copy':
+            options['acodec'] = 'copy'
+            options.pop('audio_bitrate', None)
+        return options
+
+
+# Registry of encoding profiles by name
+PROFILES = {}
+
+# Default ladder, highest quality first
+LADDER = ('quality', 'balanced', 'fast', 'fastest')
+
+
+def register_profile(profile):
+    """Add (or replace) an encoding profile"""
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name):
+    """Encoding profile registered under name, raising ValueError for unknown ones"""
+    if name not in PROFILES:
+        raise ValueError(f"Unknown encoding profile: {name}")
+    return PROFILES[name]
+
+
+register_profile(EncodingProfile('quality', preset='slow', crf=20, tune='film'))
+register_profile(EncodingProfile('balanced', preset='medium', crf=22))
+register_profile(EncodingProfile('fast', preset='veryfast', crf=23, audio='copy'))
+register_profile(EncodingProfile('fastest', preset='ultrafast', crf=26, maxrate_factor=1.0, audio='copy'))
+
+
+class ProfilePolicy:
+    """
+    Pick the encoding profile for each encode from the current demand
+
+    ladder lists profile names from highest quality to fastest. Without a
+    queue_depth callable the default profile is always used. Otherwise, with
+    a calibration (profile speeds measured on this machine, see
+    `benchmark.py --calibrate`), the highest-quality profile that would clear
+    the queued work plus this encode within target_wait seconds is used,
+    assuming clip_seconds of video per job. A calibrated speed is the
+    node's throughput (one encode with every core), so it is the same
+    however many encodes share the node.
+    Without a calibration the ladder is stepped down one profile per
+    depth_step queued jobs. A ladder of one profile pins it.
+    """
+
+    def __init__(self, ladder=LADDER, default='balanced', queue_depth=None, calibration=None,
+                 clip_seconds=60, target_wait=300, depth_step=2):
+        self.ladder = [get_profile(name) for name in ladder]
+        self.default = get_profile(default) if len(self.ladder) > 1 else self.ladder[0]
+        self.queue_depth = queue_depth
+        self.calibration = calibration or {}
+        self.clip_seconds = clip_seconds
+        self.target_wait = target_wait
+        self.depth_step = depth_step
+
+    def select(self):
+        """The profile to encode with now"""
+        profile = self._select()
+        ENCODES.inc(profile=profile.name)
+        return profile
+
+    def adaptive(self):
+        """True when the profile depends on demand"""
+        return len(self.ladder) > 1 and self.queue_depth is not None
+
+    def settings(self):
+        """
+        The policy's configuration, for output cache keys: an output made with
+        any profile of an adaptive ladder is reused, whatever the load is now
+        """
+        if self.adaptive():
+            return {'ladder': [asdict(profile) for profile in self.ladder]}
+        return {'profile': asdict(self.default)}
+
+    def _select(self):
+        if not self.adaptive():
+            return self.default
+        try:
+            depth = self.queue_depth()
+        except Exception as e:
+            logger.warning(f"Queue depth unavailable, using the {self.default.name} profile: {str(e)}")
+            return self.default
+
+        speeds = {name: measured.get('speed') for name, measured in self.calibration.items()}
+        if all(speeds.get(profile.name) for profile in self.ladder):
+            for profile in self.ladder:
+                clear_seconds = (depth + 1) * self.clip_seconds / speeds[profile.name]
+                if clear_seconds <= self.target_wait:
+                    return profile
+            return self.ladder[-1]
+
+        return self.ladder[min(math.ceil(depth / self.depth_step), len(self.ladder) - 1)]
+
+
+def load_calibration(path):
+    """Per-profile measurements written by `benchmark.py --calibrate`, or {} if there are none"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('profiles', {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable encoding calibration {path}: {str(e)}")
+        return {}
+
+
+def parse_bitrate(bitrate):
+    """Bits per second for an FFmpeg bitrate such as '4M' or '3500k' (None passes through)"""
+    if bitrate is None:
+        return None
+    match = re.fullmatch(r'([\d.]+)([kKmM]?)', str(bitrate))
+    if not match:
+        raise ValueError(f"Invalid bitrate: {bitrate}")
+    return int(float(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()])
@@ -0,0 +1,124 @@
+import collections
+import logging
+import os
+import subprocess
+import threading
+import ffmpeg
+from services.metrics import record_process
+
+logger = logging.getLogger(__name__)
+
+
+class FFmpegCancelled(Exception):
+    """Raised when a running FFmpeg process is stopped because its job was cancelled"""
+
+
+def run_ffmpeg(stream, duration=None, progress=None):
+    """
+    Run an ffmpeg-python stream, reporting progress from FFmpeg's -progress output
+
+    progress is an optional reporter with update(out_time, fps, speed, duration)
+    and is_cancelled() methods (see services.job_manager.Job). Without one this
+    behaves like ffmpeg.run(stream, overwrite_output=True, quiet=True).
+    The process's CPU time and peak RSS are recorded in services.metrics.
+    """
+    if progress is None:
+        args = ffmpeg.compile(stream, overwrite_output=True)
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr_thread, stderr_tail = drain_stderr(process)
+        wait_process(process)
+        stderr_thread.join(timeout=1)
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', None, b''.join(stderr_tail))
+        return None, None
+
+    stream = stream.global_args('-progress', 'pipe:1', '-nostats')
+    args = ffmpeg.compile(stream, overwrite_output=True)
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+
+    stderr_thread, stderr_tail = drain_stderr(process)
+
+    stats = {}
+    cancelled = False
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        stats[key] = value
+        if key != 'progress':
+            continue
+
+        progress.update(_parse_out_time(stats), _parse_float(stats.get('fps')),
+                        _parse_speed(stats.get('speed')), duration)
+        if progress.is_cancelled():
+            cancelled = True
+            process.terminate()
+            break
+        stats = {}
+
+    if cancelled:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    else:
+        wait_process(process)
+    stderr_thread.join(timeout=1)
+
+    if cancelled:
+        raise FFmpegCancelled('FFmpeg process cancelled')
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, ''.join(stderr_tail).encode('utf-8'))
+    return None, None
+
+
+def wait_process(process):
+    """
+    Wait for a child process, recording its CPU time and peak RSS in services.metrics
+    Returns its exit code
+    """
+    if process.returncode is None:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Already reaped elsewhere; no usage to record
+            return process.wait()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        record_process(usage)
+    return process.returncode
+
+
+def drain_stderr(process, max_lines=50):
+    """
+    Read a process's stderr in the background so a chatty FFmpeg can't block on a full pipe
+    Returns (thread, deque of the last max_lines lines)
+    """
+    tail = collections.deque(maxlen=max_lines)
+    thread = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+    thread.start()
+    return thread, tail
+
+
+def _parse_out_time(stats):
+    """Encoded position in seconds (out_time_us, falling back to the mislabelled out_time_ms)"""
+    for key in ('out_time_us', 'out_time_ms'):
+        value = _parse_float(stats.get(key))
+        if value is not None:
+            return value / 1000000
+    return None
+
+
+def _parse_speed(value):
+    """Parse FFmpeg's speed field, e.g. '2.53x'"""
+    if not value:
+        return None
+    return _parse_float(value.rstrip('x'))
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,55 @@
+import collections
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+_content_hashes = collections.OrderedDict()
+_content_hashes_lock = threading.Lock()
+_MAX_REMEMBERED = 1024
+
+
+def stat_key(path):
+    """Cheap identity for a file: device, inode, size and mtime"""
+    st = os.stat(path)
+    return f"{st.st_dev}-{st.st_ino}-{st.st_size}-{st.st_mtime_ns}"
+
+
+def content_hash(path):
+    """
+    SHA-256 of the file contents
+    Memoized by stat_key, so a file is only read once until it changes
+    """
+    key = stat_key(path)
+    digest = remembered_content_hash(key)
+    if digest:
+        return digest
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    remember_content_hash(path, digest, key)
+    return digest
+
+
+def remembered_content_hash(key):
+    """Hash this process already knows for a stat_key, or None"""
+    with _content_hashes_lock:
+        digest = _content_hashes.get(key)
+        if digest:
+            _content_hashes.move_to_end(key)
+        return digest
+
+
+def remember_content_hash(path, digest, key=None):
+    """Record a hash computed elsewhere (e.g. while the file was being written)"""
+    key = key or stat_key(path)
+    with _content_hashes_lock:
+        _content_hashes[key] = digest
+        _content_hashes.move_to_end(key)
+        while len(_content_hashes) > _MAX_REMEMBERED:
+            _content_hashes.popitem(last=False)
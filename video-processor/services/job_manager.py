@@ -0,0 +1,343 @@
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from services.admission import PRIORITY_SHORT, CapacityError
+from services.ffmpeg_runner import FFmpegCancelled
+from services.metrics import JOB_SECONDS, JOBS, Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job; retry_after is in seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when the job has been cancelled"""
+
+
+class Job:
+    """Progress and cancellation handle for a job running on this node"""
+
+    def __init__(self, job_id, kind, params=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.params = params or {}
+        self.stage = None
+        self.progress = 0
+        self.fps = None
+        self.eta = None
+        self.result = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_stage(self, stage):
+        """Record the pipeline stage currently running and raise if cancelled"""
+        self.check_cancelled()
+        with self._lock:
+            self.stage = stage
+        logger.info(f"Job {self.job_id}: {stage}")
+
+    def update(self, out_time, fps, speed, duration):
+        """Progress callback for services.ffmpeg_runner.run_ffmpeg"""
+        with self._lock:
+            self.fps = fps
+            if out_time is None or not duration:
+                return
+            self.progress = min(99, int(out_time / duration * 100))
+            if speed:
+                self.eta = round(max(0, duration - out_time) / speed, 1)
+
+    def publish(self, result):
+        """Record a partial result, shown in the job's status before it finishes"""
+        with self._lock:
+            self.result = dict(result)
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {'stage': self.stage, 'progress': self.progress, 'fps': self.fps, 'eta': self.eta}
+            if self.result is not None:
+                snapshot['result'] = self.result
+            return snapshot
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise JobCancelled(f"Job {self.job_id} cancelled")
+
+
+class JobManager:
+    """
+    Run processing jobs from a shared JobStore on a bounded pool of worker threads
+
+    Job handlers are registered by kind and receive a Job whose params came
+    from the store, so any node can run a job submitted on any other node.
+    Running jobs heartbeat their lease and progress into the store; a job
+    whose node dies is requeued by the store once its lease expires.
+    Each run is traced under its job ID (see services.metrics.Tracer).
+
+    Queued jobs are claimed by priority, then from the tenant with the
+    fewest running jobs. With an admission controller a worker only claims
+    a job once it holds an encode slot, so the node never starts more
+    encodes than it has capacity for.
+    """
+
+    def __init__(self, store, max_workers=2, max_queued=20, lease_seconds=30,
+                 heartbeat_interval=2, poll_interval=1, retention=3600, tracer=None,
+                 admission=None, max_queued_per_tenant=None, throughput_window=600):
+        self.store = store
+        self.tracer = tracer or Tracer()
+        self.admission = admission
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_queued_per_tenant = max_queued_per_tenant
+        self.throughput_window = throughput_window  # seconds of completions behind retry_after()
+        self._created_at = time.time()
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.retention = retention  # seconds finished jobs stay queryable
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.handlers = {}
+        self.running = {}
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._abandoned = set()  # jobs interrupted by stop(), handed back to the queue
+
+    def register(self, kind, handler):
+        """Register handler(job) -> result dict for jobs of the given kind"""
+        self.handlers[kind] = handler
+
+    def start(self):
+        """
+        Start the worker threads
+        Call after forking: the node ID (and so every worker ID) is per process
+        """
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._stopping.clear()
+        for i in range(self.max_workers):
+            worker_id = f"{self.node_id}-{i}"
+            thread = threading.Thread(target=self._worker_loop, args=(worker_id,),
+                                      name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.max_workers} job workers on {self.node_id}")
+
+    def stop(self, timeout=300):
+        """
+        Drain this node: claim no new jobs and wait up to timeout seconds for
+        the running ones to finish. Jobs still running then are cancelled and
+        given back to the queue, so another node retries them right away
+        instead of waiting for their lease to expire.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self.running:
+            logger.info(f"Draining {len(self.running)} running jobs on {self.node_id}")
+
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        for job_id, job in list(self.running.items()):
+            logger.warning(f"Job {job_id} did not finish within {timeout}s, requeueing it")
+            self._abandoned.add(job_id)
+            job.cancel()
+        for thread in self._threads:
+            thread.join(self.heartbeat_interval + 5)
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        logger.info(f"Stopped job workers on {self.node_id}")
+
+    def submit(self, job_id, kind, params=None, priority=PRIORITY_SHORT, tenant=None):
+        """
+        Queue a job and return its status
+        An active job with the same ID is returned as-is instead of being queued twice
+        Raises QueueFullError when the queue, or the tenant's share of it, is full
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind {kind}")
+
+        self.store.prune(time.time() - self.retention)
+        existing = self.store.get(job_id)
+        if not (existing and existing['status'] in ('queued', 'processing')):
+            depth = self.store.queue_depth()
+            if depth >= self.max_queued:
+                raise QueueFullError('Processing queue is full, try again later',
+                                     self.retry_after(depth - self.max_queued + 1))
+            if tenant is not None and self.max_queued_per_tenant:
+                tenant_depth = self.store.queue_depth(tenant)
+                if tenant_depth >= self.max_queued_per_tenant:
+                    raise QueueFullError(f"Too many queued jobs for {tenant}, try again later",
+                                         self.retry_after(tenant_depth - self.max_queued_per_tenant + 1))
+
+        record = self.store.enqueue(job_id, kind, params or {}, priority=priority, tenant=tenant)
+        self._wakeup.set()
+        logger.info(f"Queued {kind} job {job_id}")
+        return self._to_status(record)
+
+    def status(self, job_id):
+        """Status dict for a job, or None if unknown"""
+        record = self.store.get(job_id)
+        return self._to_status(record) if record else None
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job on any node; returns its status or None"""
+        record = self.store.request_cancel(job_id)
+        if not record:
+            return None
+
+        job = self.running.get(job_id)
+        if job:
+            job.cancel()
+        logger.info(f"Cancellation requested for job {job_id}")
+        return self._to_status(record)
+
+    def queue_depth(self):
+        """Number of jobs waiting for a worker across all nodes"""
+        return self.store.queue_depth()
+
+    def active_params(self):
+        """Params of the queued and running jobs across all nodes"""
+        return [record['params'] for record in self.store.active()]
+
+    def retry_after(self, ahead=1):
+        """Seconds until about `ahead` more jobs have finished, at the recent completion rate"""
+        now = time.time()
+        window = max(1, min(self.throughput_window, now - self._created_at))
+        completed = self.store.completed_since(now - window)
+        if not completed:
+            return 60
+        return int(max(1, min(3600, math.ceil(ahead * window / completed))))
+
+    def _to_status(self, record):
+        data = {
+            'jobId': record['job_id'],
+            'clipId': record['params'].get('clipId', record['job_id']),
+            'kind': record['kind'],
+            'status': record['status'],
+            'stage': record['stage'],
+            'progress': record['progress'],
+            'fps': record['fps'],
+            'eta': record['eta'],
+            'attempts': record['attempts']
+        }
+        if record['result']:
+            data.update(record['result'])
+        if record['error']:
+            data['error'] = record['error']
+        return data
+
+    def _worker_loop(self, worker_id):
+        while not self._stopping.is_set():
+            slot = None
+            if self.admission:
+                try:
+                    slot = self.admission.acquire(PRIORITY_SHORT)
+                except CapacityError:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+
+            try:
+                record = self._claim(worker_id, slot)
+            except Exception as e:
+                logger.error(f"Error claiming job: {str(e)}")
+                record = None
+
+            if not record:
+                if slot:
+                    slot.release(record=False)
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._execute(worker_id, record)
+            finally:
+                if slot:
+                    slot.release()
+
+    def _claim(self, worker_id, slot):
+        """Claim the next job for the slot, skipping tenants that hold their share of this node's slots"""
+        if slot is None:
+            return self.store.claim(worker_id, self.lease_seconds)
+        with self.admission.tenant_lock():
+            record = self.store.claim(worker_id, self.lease_seconds,
+                                      exclude_tenants=self.admission.full_tenants())
+            if record:
+                slot.assign(record['tenant'])
+        return record
+
+    def _execute(self, worker_id, record):
+        job = Job(record['job_id'], record['kind'], record['params'])
+        self.running[job.job_id] = job
+        if record['cancel_requested']:
+            job.cancel()
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(worker_id, job, done),
+                                     daemon=True)
+        heartbeat.start()
+        logger.info(f"Worker {worker_id} running {job.kind} job {job.job_id} "
+                    f"(attempt {record['attempts']})")
+
+        started = time.monotonic()
+        status = 'failed'
+        try:
+            with self.tracer.trace(job.job_id, kind=job.kind, node=self.node_id,
+                                   attempt=record['attempts']) as trace:
+                try:
+                    handler = self.handlers.get(job.kind)
+                    if handler is None:
+                        raise ValueError(f"No handler registered for job kind {job.kind}")
+                    job.check_cancelled()
+                    result = handler(job) or {}
+                    self.store.finish(job.job_id, worker_id, 'completed', result=result)
+                    status = 'completed'
+                except (JobCancelled, FFmpegCancelled):
+                    if job.job_id in self._abandoned:
+                        self.store.release(job.job_id, worker_id, f"Node {self.node_id} shut down")
+                        status = 'requeued'
+                    else:
+                        self.store.finish(job.job_id, worker_id, 'cancelled')
+                        status = 'cancelled'
+                        logger.info(f"Job {job.job_id} cancelled")
+                except Exception as e:
+                    self.store.finish(job.job_id, worker_id, 'failed', error=str(e))
+                    trace.attributes['error'] = str(e)
+                    logger.error(f"Job {job.job_id} failed: {str(e)}")
+                trace.attributes['status'] = status
+        finally:
+            done.set()
+            heartbeat.join()
+            self.running.pop(job.job_id, None)
+            self._abandoned.discard(job.job_id)
+            JOBS.inc(kind=job.kind, status=status)
+            JOB_SECONDS.observe(time.monotonic() - started, kind=job.kind)
+
+    def _heartbeat_loop(self, worker_id, job, done):
+        while not done.wait(self.heartbeat_interval):
+            try:
+                alive = self.store.heartbeat(job.job_id, worker_id, self.lease_seconds,
+                                             **job.snapshot())
+            except Exception as e:
+                logger.error(f"Heartbeat failed for job {job.job_id}: {str(e)}")
+                continue
+
+            if not alive and not job.is_cancelled():
+                # Cancelled from another node, or our lease was taken over
+                logger.info(f"Stopping job {job.job_id}: cancelled or lease lost")
+                job.cancel()
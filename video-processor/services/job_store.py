@@ -0,0 +1,441 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('queued', 'processing')
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+class JobStore:
+    """
+    Durable job queue shared by every video-processor node
+
+    Records are plain dicts with the keys listed in FIELDS. A worker claims a
+    queued job by taking a lease; it must heartbeat before the lease expires
+    or the job is considered orphaned and is requeued (up to max_attempts).
+    Jobs are claimed in priority order (lowest first); within a priority,
+    from the tenant with the fewest running jobs, then oldest first.
+    """
+
+    FIELDS = ('job_id', 'kind', 'params', 'status', 'stage', 'progress', 'fps', 'eta',
+              'result', 'error', 'attempts', 'worker_id', 'lease_expires',
+              'cancel_requested', 'priority', 'tenant', 'created_at', 'updated_at', 'finished_at')
+
+    def __init__(self, max_attempts=3):
+        self.max_attempts = max_attempts
+
+    def enqueue(self, job_id, kind, params, priority=1, tenant=None):
+        """Add a job, or return the existing record if one with job_id is still active"""
+        raise NotImplementedError
+
+    def claim(self, worker_id, lease_seconds, exclude_tenants=()):
+        """
+        Lease the next queued job (see the class docstring) to worker_id; returns the record or None
+        Jobs of exclude_tenants are left queued
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, job_id, worker_id, lease_seconds, **progress):
+        """
+        Extend the lease and store progress fields (stage, progress, fps, eta, and
+        result for partial results)
+        Returns False if the worker no longer holds the job or it was cancelled
+        """
+        raise NotImplementedError
+
+    def finish(self, job_id, worker_id, status, result=None, error=None):
+        """Record the final status of a job held by worker_id"""
+        raise NotImplementedError
+
+    def release(self, job_id, worker_id, error):
+        """Give a failed attempt back to the queue, or fail it when out of attempts"""
+        raise NotImplementedError
+
+    def request_cancel(self, job_id):
+        """Cancel a queued job outright or flag a running one; returns the record or None"""
+        raise NotImplementedError
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    def queue_depth(self, tenant=None):
+        """Number of queued jobs across all nodes (only tenant's when given)"""
+        raise NotImplementedError
+
+    def active(self):
+        """Records of the queued and processing jobs across all nodes"""
+        raise NotImplementedError
+
+    def completed_since(self, timestamp):
+        """Number of jobs completed after timestamp"""
+        raise NotImplementedError
+
+    def prune(self, older_than):
+        """Delete finished jobs that finished before the given timestamp"""
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Single-process job store, for development and tests"""
+
+    def __init__(self, max_attempts=3):
+        super().__init__(max_attempts)
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, job_id, kind, params, priority=1, tenant=None):
+        with self._lock:
+            existing = self.jobs.get(job_id)
+            if existing and existing['status'] in ACTIVE_STATUSES:
+                return dict(existing)
+
+            now = time.time()
+            record = dict.fromkeys(self.FIELDS)
+            record.update(job_id=job_id, kind=kind, params=params, status='queued',
+                          progress=0, attempts=0, cancel_requested=False,
+                          priority=priority, tenant=tenant, created_at=now, updated_at=now)
+            self.jobs[job_id] = record
+            return dict(record)
+
+    def claim(self, worker_id, lease_seconds, exclude_tenants=()):
+        with self._lock:
+            now = time.time()
+            self._requeue_expired(now)
+            queued = [r for r in self.jobs.values()
+                      if r['status'] == 'queued' and r['tenant'] not in exclude_tenants]
+            if not queued:
+                return None
+
+            running = collections.Counter(r['tenant'] for r in self.jobs.values()
+                                          if r['status'] == 'processing')
+            record = min(queued, key=lambda r: (r['priority'], running[r['tenant']], r['created_at']))
+            record.update(status='processing', worker_id=worker_id,
+                          lease_expires=now + lease_seconds,
+                          attempts=record['attempts'] + 1, updated_at=now)
+            return dict(record)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds, **progress):
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if not record or record['worker_id'] != worker_id or record['status'] != 'processing':
+                return False
+
+            now = time.time()
+            record.update(progress, lease_expires=now + lease_seconds, updated_at=now)
+            return not record['cancel_requested']
+
+    def finish(self, job_id, worker_id, status, result=None, error=None):
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if not record or record['worker_id'] != worker_id:
+                return
+            now = time.time()
+            record.update(status=status, result=result, error=error,
+                          lease_expires=None, updated_at=now, finished_at=now)
+            if status == 'completed':
+                record.update(progress=100, eta=0)
+
+    def release(self, job_id, worker_id, error):
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if not record or record['worker_id'] != worker_id:
+                return
+            self._retry_or_fail(record, error, time.time())
+
+    def request_cancel(self, job_id):
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if not record:
+                return None
+            now = time.time()
+            if record['status'] == 'queued':
+                record.update(status='cancelled', updated_at=now, finished_at=now)
+            record['cancel_requested'] = True
+            return dict(record)
+
+    def get(self, job_id):
+        with self._lock:
+            record = self.jobs.get(job_id)
+            return dict(record) if record else None
+
+    def queue_depth(self, tenant=None):
+        with self._lock:
+            return sum(1 for r in self.jobs.values()
+                       if r['status'] == 'queued' and (tenant is None or r['tenant'] == tenant))
+
+    def active(self):
+        with self._lock:
+            return [dict(r) for r in self.jobs.values() if r['status'] in ACTIVE_STATUSES]
+
+    def completed_since(self, timestamp):
+        with self._lock:
+            return sum(1 for r in self.jobs.values()
+                       if r['status'] == 'completed' and r['finished_at'] > timestamp)
+
+    def prune(self, older_than):
+        with self._lock:
+            for job_id, record in list(self.jobs.items()):
+                if record['finished_at'] and record['finished_at'] < older_than:
+                    del self.jobs[job_id]
+
+    def _requeue_expired(self, now):
+        for record in self.jobs.values():
+            if record['status'] == 'processing' and record['lease_expires'] < now:
+                logger.warning(f"Lease expired for job {record['job_id']} on {record['worker_id']}")
+                self._retry_or_fail(record, 'Worker lease expired', now)
+
+    def _retry_or_fail(self, record, error, now):
+        if record['cancel_requested']:
+            record.update(status='cancelled', finished_at=now)
+        elif record['attempts'] < self.max_attempts:
+            record.update(status='queued', worker_id=None)
+        else:
+            record.update(status='failed', finished_at=now)
+        record.update(error=error, lease_expires=None, updated_at=now)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Job store backed by a SQLite file
+
+    Every node points at the same database file on a shared volume; claims use
+    BEGIN IMMEDIATE so only one node can lease a given job. The default
+    rollback journal is kept because WAL mode does not work across hosts.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL,
+            stage TEXT,
+            progress INTEGER DEFAULT 0,
+            fps REAL,
+            eta REAL,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker_id TEXT,
+            lease_expires REAL,
+            cancel_requested INTEGER DEFAULT 0,
+            priority INTEGER DEFAULT 1,
+            tenant TEXT,
+            created_at REAL,
+            updated_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+    """
+
+    # Columns added since the first schema, added to existing databases on open
+    MIGRATIONS = {
+        'priority': 'ALTER TABLE jobs ADD COLUMN priority INTEGER DEFAULT 1',
+        'tenant': 'ALTER TABLE jobs ADD COLUMN tenant TEXT'
+    }
+
+    def __init__(self, path, max_attempts=3):
+        super().__init__(max_attempts)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, statement in self.MIGRATIONS.items():
+                if column not in columns:
+                    try:
+                        conn.execute(statement)
+                    except sqlite3.OperationalError:  # added by another node meanwhile
+                        pass
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    def _to_record(self, row):
+        if row is None:
+            return None
+        record = dict(row)
+        record['params'] = json.loads(record['params']) if record['params'] else {}
+        record['result'] = json.loads(record['result']) if record['result'] else None
+        record['cancel_requested'] = bool(record['cancel_requested'])
+        return record
+
+    def enqueue(self, job_id, kind, params, priority=1, tenant=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row and row['status'] in ACTIVE_STATUSES:
+                conn.execute('COMMIT')
+                return self._to_record(row)
+
+            conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            conn.execute(
+                'INSERT INTO jobs (job_id, kind, params, status, progress, attempts, '
+                'cancel_requested, priority, tenant, created_at, updated_at) '
+                "VALUES (?, ?, ?, 'queued', 0, 0, 0, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), priority, tenant, now, now))
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            conn.execute('COMMIT')
+            return self._to_record(row)
+
+    def claim(self, worker_id, lease_seconds, exclude_tenants=()):
+        now = time.time()
+        exclude_tenants = list(exclude_tenants)
+        excluded = f" AND (q.tenant IS NULL OR q.tenant NOT IN ({', '.join('?' * len(exclude_tenants))}))"
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._requeue_expired(conn, now)
+            row = conn.execute(
+                'SELECT q.job_id FROM jobs q LEFT JOIN '
+                "(SELECT tenant, COUNT(*) AS running FROM jobs WHERE status = 'processing' "
+                'GROUP BY tenant) r ON r.tenant IS q.tenant '
+                f"WHERE q.status = 'queued'{excluded if exclude_tenants else ''} "
+                'ORDER BY q.priority, COALESCE(r.running, 0), q.created_at LIMIT 1',
+                exclude_tenants).fetchone()
+            if not row:
+                conn.execute('COMMIT')
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET status = 'processing', worker_id = ?, lease_expires = ?, "
+                'attempts = attempts + 1, updated_at = ? WHERE job_id = ?',
+                (worker_id, now + lease_seconds, now, row['job_id']))
+            claimed = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (row['job_id'],)).fetchone()
+            conn.execute('COMMIT')
+            return self._to_record(claimed)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds, **progress):
+        now = time.time()
+        fields = {k: progress[k] for k in ('stage', 'progress', 'fps', 'eta') if k in progress}
+        if progress.get('result') is not None:
+            fields['result'] = json.dumps(progress['result'])
+        assignments = ''.join(f', {k} = ?' for k in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f'UPDATE jobs SET lease_expires = ?, updated_at = ?{assignments} '
+                "WHERE job_id = ? AND worker_id = ? AND status = 'processing'",
+                (now + lease_seconds, now, *fields.values(), job_id, worker_id))
+            if cursor.rowcount == 0:
+                return False
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE job_id = ?',
+                               (job_id,)).fetchone()
+            return not row['cancel_requested']
+
+    def finish(self, job_id, worker_id, status, result=None, error=None):
+        now = time.time()
+        extra = ', progress = 100, eta = 0' if status == 'completed' else ''
+        with self._connect() as conn:
+            conn.execute(
+                f'UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires = NULL, '
+                f'updated_at = ?, finished_at = ?{extra} WHERE job_id = ? AND worker_id = ?',
+                (status, json.dumps(result) if result is not None else None, error,
+                 now, now, job_id, worker_id))
+
+    def release(self, job_id, worker_id, error):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ? AND worker_id = ?',
+                               (job_id, worker_id)).fetchone()
+            if row:
+                self._retry_or_fail(conn, row, error, now)
+            conn.execute('COMMIT')
+
+    def request_cancel(self, job_id):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ?, finished_at = ? "
+                "WHERE job_id = ? AND status = 'queued'", (now, now, job_id))
+            conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?', (job_id,))
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            conn.execute('COMMIT')
+            return self._to_record(row)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            return self._to_record(row)
+
+    def queue_depth(self, tenant=None):
+        with self._connect() as conn:
+            if tenant is None:
+                row = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+            else:
+                row = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND tenant = ?",
+                                   (tenant,)).fetchone()
+            return row[0]
+
+    def active(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE status IN ('queued', 'processing')").fetchall()
+            return [self._to_record(row) for row in rows]
+
+    def completed_since(self, timestamp):
+        with self._connect() as conn:
+            row = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'completed' AND finished_at > ?",
+                               (timestamp,)).fetchone()
+            return row[0]
+
+    def prune(self, older_than):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+                         (older_than,))
+
+    def _requeue_expired(self, conn, now):
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'processing' AND lease_expires < ?",
+            (now,)).fetchall()
+        for row in rows:
+            logger.warning(f"Lease expired for job {row['job_id']} on {row['worker_id']}")
+            self._retry_or_fail(conn, row, 'Worker lease expired', now)
+
+    def _retry_or_fail(self, conn, row, error, now):
+        if row['cancel_requested']:
+            status, finished_at = 'cancelled', now
+        elif row['attempts'] < self.max_attempts:
+            status, finished_at = 'queued', None
+        else:
+            status, finished_at = 'failed', now
+        conn.execute(
+            'UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, '
+            'worker_id = CASE WHEN ? = \'queued\' THEN NULL ELSE worker_id END, '
+            'updated_at = ?, finished_at = ? WHERE job_id = ?',
+            (status, error, status, now, finished_at, row['job_id']))
+
+
+class _Connection:
+    """Context manager that closes a sqlite3 connection and rolls back open transactions"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.conn.close()
+
+
+def create_job_store(backend=None, path=None, max_attempts=3):
+    """Build the job store selected by JOB_STORE ('sqlite' or 'memory')"""
+    backend = backend or os.getenv('JOB_STORE', 'sqlite')
+    if backend == 'memory':
+        return MemoryJobStore(max_attempts=max_attempts)
+    if backend == 'sqlite':
+        path = path or os.getenv('JOB_DB_PATH', './jobs/jobs.db')
+        logger.info(f"Using SQLite job store at {path}")
+        return SQLiteJobStore(path, max_attempts=max_attempts)
+    raise ValueError(f"Unknown job store backend: {backend}")
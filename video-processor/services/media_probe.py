@@ -0,0 +1,210 @@
+import collections
+import json
+import logging
+import os
+import subprocess
+import threading
+from dataclasses import asdict, dataclass, field, replace
+import ffmpeg
+from services.fingerprint import content_hash, stat_key
+from services.metrics import cache_lookup, stage
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeError(Exception):
+    """Raised when a media file can't be probed or has no usable video stream"""
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Stream metadata for a media file"""
+    duration: float
+    width: int
+    height: int
+    fps: float
+    video_codec: str
+    pix_fmt: str
+    has_audio: bool
+    audio_codec: str = None
+    sample_rate: int = None
+    bit_rate: int = None
+    video_profile: str = None  # as ffprobe names it, e.g. 'High'
+    video_level: int = None  # e.g. 40 for level 4.0
+    start_time: float = 0.0
+    keyframes: tuple = field(default=None, repr=False)
+
+
+class MediaProbe:
+    """
+    Probe media files with an in-memory LRU and an on-disk cache
+
+    Entries are keyed by inode/size/mtime (key_mode='stat', the default) or by
+    content hash (key_mode='content'), so a file is only probed once until it
+    changes. Keyframe positions are probed separately on first request. Disk
+    entries are touched when read, so the cache directory can be trimmed
+    least-recently-used (see output_cache.evict_lru); entries for files that
+    no longer exist are never read again and age out.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=256, key_mode='stat'):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.key_mode = key_mode
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def probe(self, path, cached=True):
+        """
+        Return MediaInfo for path
+        cached=False probes without touching the cache (e.g. a file still being written)
+        """
+        if not cached:
+            return self._probe(path)
+        key = self._key(path)
+        info = self._get(key)
+        cache_lookup('probe', info is not None)
+        if info is None:
+            info = self._probe(path)
+            self._put(key, info)
+        return info
+
+    def keyframes(self, path):
+        """
+        Return the video keyframe times in path, in seconds from the start of
+        the file (the timeline used by FFmpeg's -ss)
+        """
+        key = self._key(path)
+        info = self.probe(path)
+        if info.keyframes is None:
+            info = replace(info, keyframes=self._probe_keyframes(path, info.start_time))
+            self._put(key, info)
+        return info.keyframes
+
+    def _key(self, path):
+        try:
+            return content_hash(path) if self.key_mode == 'content' else stat_key(path)
+        except OSError as e:
+            raise ProbeError(f"Cannot read {path}: {e}") from e
+
+    def _get(self, key):
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None:
+                self._entries.move_to_end(key)
+                return info
+
+        cache_path = self._cache_path(key)
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if 'video_profile' not in data:
+                return None  # written before profile/level were probed
+            if data.get('keyframes') is not None:
+                data['keyframes'] = tuple(data['keyframes'])
+            info = MediaInfo(**data)
+            os.utime(cache_path)
+        except FileNotFoundError:
+            return None  # evicted since the exists() check
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable probe cache entry {cache_path}: {e}")
+            return None
+
+        self._remember(key, info)
+        return info
+
+    def _put(self, key, info):
+        self._remember(key, info)
+        cache_path = self._cache_path(key)
+        if not cache_path:
+            return
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(asdict(info), f)
+        os.replace(tmp_path, cache_path)
+
+    def _remember(self, key, info):
+        with self._lock:
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _cache_path(self, key):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _probe(self, path):
+        try:
+            with stage('probe'):
+                probe = ffmpeg.probe(path)
+        except ffmpeg.Error as e:
+            stderr = e.stderr.decode('utf-8', 'replace').strip() if e.stderr else ''
+            raise ProbeError(f"ffprobe failed for {path}: {stderr}") from e
+
+        video = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+        if video is None:
+            raise ProbeError(f"No video stream in {path}")
+        audio = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
+
+        duration = _to_float(probe['format'].get('duration')) or _to_float(video.get('duration'))
+        if not duration:
+            raise ProbeError(f"Cannot determine duration of {path}")
+
+        return MediaInfo(
+            duration=duration,
+            width=int(video['width']),
+            height=int(video['height']),
+            fps=_parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')),
+            video_codec=video.get('codec_name'),
+            pix_fmt=video.get('pix_fmt'),
+            has_audio=audio is not None,
+            audio_codec=audio.get('codec_name') if audio else None,
+            sample_rate=int(audio['sample_rate']) if audio and audio.get('sample_rate') else None,
+            bit_rate=int(probe['format']['bit_rate']) if probe['format'].get('bit_rate') else None,
+            video_profile=video.get('profile'),
+            video_level=int(video['level']) if video.get('level', -99) > 0 else None,
+            start_time=_to_float(probe['format'].get('start_time')) or 0.0
+        )
+
+    def _probe_keyframes(self, path, start_time=0.0):
+        """Read keyframe times from packet flags, without decoding"""
+        args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path]
+        with stage('keyframes'):
+            result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+        if result.returncode != 0:
+            raise ProbeError(f"ffprobe keyframe scan failed for {path}: {result.stderr.strip()}")
+
+        keyframes = []
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags:
+                pts = _to_float(pts_time)
+                if pts is not None:
+                    keyframes.append(round(pts - start_time, 6))
+        return tuple(sorted(keyframes))
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_rate(value):
+    """Parse an ffprobe rational such as '30000/1001'"""
+    if not value:
+        return None
+    num, _, den = value.partition('/')
+    try:
+        return float(num) / float(den or 1) if float(den or 1) else None
+    except ValueError:
+        return None
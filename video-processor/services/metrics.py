@@ -0,0 +1,523 @@
+import bisect
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Metric:
+    """A named metric with one value (or histogram) per label set"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def collect(self):
+        """Values by label key, merged with the other processes' when metrics are shared (see share_metrics)"""
+        with self._lock:
+            values = dict(self._values)
+        for snapshot in _peer_snapshots():
+            if not self._includes(snapshot):
+                continue
+            for key, value in snapshot['metrics'].get(self.name, []):
+                key = tuple(key)
+                values[key] = self._merge(values[key], value) if key in values else value
+        return values
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.collect().items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def _includes(self, snapshot):
+        # Totals of exited processes still count, so they never go back
+        return True
+
+    def _merge(self, value, other):
+        return value + other
+
+    def _samples(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {_number(value)}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing total"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """
+    Current value, set directly or read from a callback at scrape time
+
+    When metrics are shared across processes, multiprocess_mode 'sum' or
+    'max' merges the values of the live processes; 'live' reports the
+    scraping process's own value (for callbacks that read node-wide state).
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='live'):
+        super().__init__(name, documentation, labelnames)
+        if multiprocess_mode not in ('live', 'sum', 'max'):
+            raise ValueError(f"Unknown multiprocess mode: {multiprocess_mode}")
+        self.multiprocess_mode = multiprocess_mode
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Read the value from function() whenever metrics are rendered"""
+        self._functions[self._key(labels)] = function
+
+    def collect(self):
+        self._refresh()
+        return super().collect()
+
+    def _refresh(self):
+        for key, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"Gauge {self.name} callback failed: {str(e)}")
+                continue
+            with self._lock:
+                if value is None:
+                    self._values.pop(key, None)
+                else:
+                    self._values[key] = value
+
+    def _snapshot(self):
+        if self.multiprocess_mode == 'live':
+            return []
+        self._refresh()
+        return super()._snapshot()
+
+    def _includes(self, snapshot):
+        return self.multiprocess_mode != 'live' and snapshot['alive']
+
+    def _merge(self, value, other):
+        return value + other if self.multiprocess_mode == 'sum' else max(value, other)
+
+
+class Histogram(_Metric):
+    """Distribution of observations over fixed upper bounds"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _number(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+    def _merge(self, value, other):
+        return [a + b for a, b in zip(value[0], other[0])], value[1] + other[1]
+
+
+# Every metric created in this process, in definition order
+REGISTRY = []
+
+
+def render():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+_shared = {'directory': None, 'pid': None}
+_peers = {'read_at': None, 'snapshots': []}
+_shared_lock = threading.Lock()
+# Seconds a read of the other processes' snapshots is reused (one scrape renders every metric)
+_PEERS_TTL = 1.0
+
+
+def share_metrics(directory, interval=1.0, clear=False):
+    """
+    Merge the metrics of the processes of a pre-forked server (see gunicorn.conf.py)
+
+    Each process writes its values to directory/<pid>.json (every interval
+    seconds from a background thread; once with interval None) and render()
+    adds the other processes' files. clear=True removes a previous server's
+    files first. A process forked after sharing starts its counters and
+    histograms from zero, as the parent's file already holds their counts.
+    directory must be local to the node.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if clear:
+        for name in os.listdir(directory):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(directory, name))
+    elif _shared['pid'] not in (None, os.getpid()):
+        for metric in REGISTRY:
+            if not isinstance(metric, Gauge):
+                with metric._lock:
+                    metric._values.clear()
+
+    # A file left by an exited process with the same PID is kept under another name
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with contextlib.suppress(FileNotFoundError):
+        os.replace(path, os.path.join(directory, f"{os.getpid()}-{time.time_ns()}.json"))
+
+    _shared['directory'], _shared['pid'] = directory, os.getpid()
+    _peers['read_at'] = None
+    save_metrics()
+    if interval:
+        threading.Thread(target=_save_periodically, args=(interval,), name='metrics-writer', daemon=True).start()
+
+
+def save_metrics():
+    """Write this process's values for the other processes (see share_metrics)"""
+    directory = _shared['directory']
+    if directory is None:
+        return
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({metric.name: metric._snapshot() for metric in REGISTRY}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not save metrics to {path}: {str(e)}")
+
+
+def _save_periodically(interval):
+    while _shared['pid'] == os.getpid():
+        time.sleep(interval)
+        save_metrics()
+
+
+def _peer_snapshots():
+    """The other processes' metrics as [{'alive': bool, 'metrics': {name: [[key, value], ...]}}]"""
+    directory = _shared['directory']
+    if directory is None:
+        return []
+    with _shared_lock:
+        if _peers['read_at'] is not None and time.monotonic() - _peers['read_at'] < _PEERS_TTL:
+            return _peers['snapshots']
+
+        snapshots = []
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            if ext != '.json' or stem == str(os.getpid()):
+                continue
+            try:
+                with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                    metrics = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Renamed files (PID-time) are from exited processes
+            snapshots.append({'alive': stem.isdigit() and _alive(int(stem)), 'metrics': metrics})
+        _peers['read_at'], _peers['snapshots'] = time.monotonic(), snapshots
+        return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_SIZE_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(2, 14))  # 4 MB to 8 GB
+
+STAGE_SECONDS = Histogram('video_processor_stage_seconds', 'Time spent in each processing stage', ['stage'])
+JOBS = Counter('video_processor_jobs_total', 'Finished jobs by kind and outcome', ['kind', 'status'])
+JOB_SECONDS = Histogram('video_processor_job_seconds', 'Job run time by kind', ['kind'],
+                        buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+QUEUE_DEPTH = Gauge('video_processor_queue_depth', 'Jobs waiting for a worker across all nodes')
+RUNNING_JOBS = Gauge('video_processor_running_jobs', 'Jobs running on this node', multiprocess_mode='sum')
+FFMPEG_PROCESSES = Counter('video_processor_ffmpeg_processes_total', 'FFmpeg processes run, by stage', ['stage'])
+FFMPEG_CPU_SECONDS = Counter('video_processor_ffmpeg_cpu_seconds_total',
+                             'User plus system CPU time of FFmpeg processes, by stage', ['stage'])
+FFMPEG_PEAK_RSS = Histogram('video_processor_ffmpeg_peak_rss_bytes', 'Peak RSS of each FFmpeg process, by stage',
+                            ['stage'], buckets=_SIZE_BUCKETS)
+BYTES_IN = Counter('video_processor_bytes_in_total', 'Bytes received', ['source'])
+BYTES_OUT = Counter('video_processor_bytes_out_total', 'Bytes written as outputs or served', ['kind'])
+CACHE_REQUESTS = Counter('video_processor_cache_requests_total', 'Cache lookups by cache and result',
+                         ['cache', 'result'])
+CACHE_HIT_RATIO = Gauge('video_processor_cache_hit_ratio', 'Hits over lookups since start, by cache', ['cache'])
+ENCODES = Counter('video_processor_encodes_total', 'Encodes started, by encoding profile', ['profile'])
+ENCODE_SLOTS_BUSY = Gauge('video_processor_encode_slots_busy', 'Encode slots held on this node')
+ADMISSION_REJECTIONS = Counter('video_processor_admission_rejections_total',
+                               'Requests refused with 429, by reason (queue, tenant, slots, cpu, memory)',
+                               ['reason'])
+STARTUP_SECONDS = Gauge('video_processor_startup_seconds', 'Time from server start until ready to fork workers',
+                        multiprocess_mode='max')
+MOCK_CAPTIONS = Counter('video_processor_mock_captions_total',
+                        'Caption requests answered with placeholder captions', ['reason'])
+
+
+def cache_lookup(cache, hit):
+    """Count a cache lookup (and so that cache's hit ratio)"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def _hit_ratio(cache):
+    values = CACHE_REQUESTS.collect()
+    hits, misses = values.get((cache, 'hit'), 0), values.get((cache, 'miss'), 0)
+    return hits / (hits + misses) if hits + misses else None
+
+
+for _cache in ('probe', 'analysis', 'transcripts', 'outputs'):
+    CACHE_HIT_RATIO.set_function(functools.partial(_hit_ratio, _cache), cache=_cache)
+
+
+def record_process(usage):
+    """Account an FFmpeg child's resource usage (from os.wait4) to the current stage"""
+    stage_name = current_stage() or 'other'
+    FFMPEG_PROCESSES.inc(stage=stage_name)
+    FFMPEG_CPU_SECONDS.inc(usage.ru_utime + usage.ru_stime, stage=stage_name)
+    FFMPEG_PEAK_RSS.observe(usage.ru_maxrss * 1024, stage=stage_name)  # ru_maxrss is in KB on Linux
+
+
+class Trace:
+    """Spans recorded for one job (keyed by its clip/job ID)"""
+
+    def __init__(self, trace_id, attributes=None, on_change=None):
+        self.trace_id = trace_id
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self.finished_at = None
+        self.spans = []
+        self.on_change = on_change
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            span['id'] = len(self.spans)
+            self.spans.append(span)
+        self.changed()
+        return span['id']
+
+    def changed(self):
+        """Called when a span starts or ends"""
+        if self.on_change:
+            self.on_change(self)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'traceId': self.trace_id,
+                'attributes': self.attributes,
+                'startedAt': self.started_at,
+                'finishedAt': self.finished_at,
+                'spans': [dict(span) for span in self.spans]
+            }
+
+
+class Tracer:
+    """
+    Keep per-job traces: active ones in memory, finished ones in a bounded
+    in-memory LRU and, when trace_dir is set, as JSON files there (so any
+    process or node sharing the directory can answer for a job that ran
+    elsewhere). Active traces are saved too, at most every save_interval
+    seconds, so a job still running in another process can be followed.
+    """
+
+    def __init__(self, trace_dir=None, max_traces=500, save_interval=1.0):
+        self.trace_dir = trace_dir
+        self.max_traces = max_traces
+        self.save_interval = save_interval
+        self._active = {}
+        self._finished = collections.OrderedDict()
+        self._saved_at = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def trace(self, trace_id, **attributes):
+        """Record spans started on this thread (and propagated ones) under trace_id"""
+        trace = Trace(trace_id, attributes, on_change=self._save_active)
+        with self._lock:
+            self._active[trace_id] = trace
+            self._saved_at[trace_id] = time.monotonic()
+        self._save(trace)
+        previous = _local.__dict__.get('trace'), _local.__dict__.get('spans')
+        _local.trace, _local.spans = trace, []
+        try:
+            yield trace
+        finally:
+            _local.trace, _local.spans = previous
+            trace.finished_at = time.time()
+            with self._lock:
+                self._active.pop(trace_id, None)
+                self._saved_at.pop(trace_id, None)
+                self._finished[trace_id] = trace
+                self._finished.move_to_end(trace_id)
+                while len(self._finished) > self.max_traces:
+                    self._finished.popitem(last=False)
+            with self._save_lock:
+                self._save(trace)
+
+    def get(self, trace_id):
+        """
+        Trace dict for trace_id, or None
+        A finished trace is read from trace_dir first: the job may have run
+        again in another process since
+        """
+        with self._lock:
+            trace = self._active.get(trace_id)
+            finished = self._finished.get(trace_id)
+        if trace:
+            return trace.as_dict()
+        if self.trace_dir:
+            try:
+                with open(self._path(trace_id), 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        return finished.as_dict() if finished else None
+
+    def _save_active(self, trace):
+        # Under the save lock so an in-progress copy can't replace the finished one
+        with self._save_lock:
+            now = time.monotonic()
+            with self._lock:
+                saved_at = self._saved_at.get(trace.trace_id)
+                if saved_at is None or now - saved_at < self.save_interval:
+                    return
+                self._saved_at[trace.trace_id] = now
+            self._save(trace)
+
+    def _path(self, trace_id):
+        return os.path.join(self.trace_dir, f"{os.path.basename(trace_id)}.json")
+
+    def _save(self, trace):
+        if not self.trace_dir:
+            return
+        path = self._path(trace.trace_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(trace.as_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not save trace {trace.trace_id}: {str(e)}")
+
+
+_local = threading.local()
+
+
+def current_stage():
+    """Name of the innermost stage running on this thread, or None"""
+    spans = _local.__dict__.get('spans')
+    return spans[-1][0] if spans else None
+
+
+@contextlib.contextmanager
+def stage(name, **attributes):
+    """
+    Time a processing stage: observed in the stage latency histogram and,
+    inside a trace, recorded as a span (nested under the enclosing stage)
+    """
+    trace = _local.__dict__.get('trace')
+    spans = _local.__dict__.setdefault('spans', [])
+    span = None
+    if trace is not None:
+        span = {'name': name, 'parent': spans[-1][1] if spans else None, 'start': time.time(),
+                'duration': None, 'thread': threading.current_thread().name, 'attributes': attributes}
+        trace.add(span)
+    spans.append((name, span['id'] if span else None))
+    started = time.monotonic()
+    try:
+        yield span
+    except BaseException as e:
+        if span is not None:
+            span['error'] = str(e) or type(e).__name__
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        spans.pop()
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if span is not None:
+            span['duration'] = round(elapsed, 6)
+            trace.changed()
+
+
+def propagate(function):
+    """Wrap function so it runs in the calling thread's trace and stage (for thread pools)"""
+    trace = _local.__dict__.get('trace')
+    spans = list(_local.__dict__.get('spans') or [])
+
+    def wrapper(*args, **kwargs):
+        previous = _local.__dict__.get('trace'), _local.__dict__.get('spans')
+        _local.trace, _local.spans = trace, list(spans)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.trace, _local.spans = previous
+    return wrapper
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(round(value, 6))
+    return str(value)
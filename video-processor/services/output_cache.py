@@ -0,0 +1,190 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from services.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+# Bump when a change to the processing code should invalidate cached outputs
+OUTPUT_CACHE_VERSION = 1
+
+
+class OutputCache:
+    """
+    Content-addressed store of finished outputs
+
+    An entry is keyed by the input's content hash plus a canonical hash of
+    every processing parameter, and holds the files one job produced (the
+    clip and any renditions). Restoring an entry hard-links its files under
+    the new clip's name, so a repeated request costs no encode and no extra
+    disk; published outputs must therefore be replaced, never rewritten in
+    place (see VideoProcessor._writing). A file lock per key lets only one of several identical concurrent
+    jobs (on any node sharing the directory) do the encode; the others wait
+    and restore its result. Entries are evicted least-recently-used once the
+    store exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'locks'), exist_ok=True)
+
+    def key(self, input_hash, params):
+        """Cache key for an input content hash and a dict of processing parameters"""
+        canonical = json.dumps({'version': OUTPUT_CACHE_VERSION, 'input': input_hash, 'params': params},
+                               sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold the build lock for key (blocks while another job builds the same output)"""
+        lock_path = os.path.join(self.cache_dir, 'locks', key)
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def restore(self, key, output_path):
+        """
+        Link a cached entry's files next to output_path (an .mp4 path)
+        Returns {name: path} as passed to store(), or None on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            cache_lookup('outputs', False)
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable output cache entry {key[:12]}: {e}")
+            cache_lookup('outputs', False)
+            return None
+
+        stem = output_path[:-len('.mp4')]
+        paths = {}
+        try:
+            for name, suffix in manifest['files'].items():
+                paths[name] = stem + suffix
+                _link(os.path.join(entry_dir, name + os.path.splitext(suffix)[1]), paths[name])
+                os.utime(paths[name])
+        except FileNotFoundError:
+            # Evicted while we were reading it
+            cache_lookup('outputs', False)
+            return None
+
+        cache_lookup('outputs', True)
+        os.utime(entry_dir)
+        logger.info(f"Restored cached output {key[:12]} to {output_path}")
+        return paths
+
+    def store(self, key, output_path, paths):
+        """Add the files {name: path} produced for key; paths must share output_path's stem"""
+        stem = output_path[:-len('.mp4')]
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            files = {}
+            for name, path in paths.items():
+                suffix = path[len(stem):]
+                _link(path, os.path.join(tmp_dir, name + os.path.splitext(suffix)[1]))
+                files[name] = suffix
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump({'files': files, 'created_at': time.time()}, f)
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        with self._lock:
+            self._evict()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _evict(self):
+        """Delete least recently used entries until the store fits in max_bytes"""
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                    entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+                except FileNotFoundError:
+                    continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logger.info(f"Evicted output cache entry {os.path.basename(entry_dir)[:12]}")
+
+
+def evict_lru(directory, max_bytes, min_age=3600, max_age=None, group=None, keep=None):
+    """
+    Delete the least recently modified files in directory until it fits in max_bytes
+    Files modified within min_age seconds are kept (they may still be in use);
+    files not modified for max_age seconds are deleted whatever the total size.
+    group(name) names the unit a file belongs to (default: the file itself):
+    a unit's files are evicted together, as recent as its newest file, and
+    units for which keep(unit) is true are never evicted
+    Returns the number of bytes freed
+    """
+    now = time.time()
+    units = {}
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                unit = units.setdefault(group(entry.name) if group else entry.name, [0.0, 0, []])
+                unit[0] = max(unit[0], st.st_mtime)
+                unit[1] += st.st_size
+                unit[2].append(entry.path)
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for _, size, _ in units.values())
+    freed = 0
+    for name, (mtime, size, paths) in sorted(units.items(), key=lambda item: item[1][0]):
+        expired = max_age is not None and now - mtime > max_age
+        if total <= max_bytes and not expired:
+            break
+        if now - mtime < min_age or (keep and keep(name)):
+            continue
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        total -= size
+        freed += size
+        logger.info(f"Evicted {name if group else paths[0]} ({size} bytes)")
+    return freed
+
+
+def _link(source, target):
+    """Hard-link source to target (replacing it), copying when links aren't possible"""
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
@@ -0,0 +1,176 @@
+import ffmpeg
+import logging
+from services.ffmpeg_runner import run_ffmpeg
+from services.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+class ClipPipeline:
+    """
+    Compose clip operations into a single FFmpeg filter graph
+
+    Trim is applied as input-side seeking so only the requested range is
+    decoded, and crop/scale/subtitles/credits are chained in one graph so
+    the clip is encoded exactly once.
+    """
+
+    def __init__(self, input_path, has_audio=True, source_duration=None):
+        self.input_path = input_path
+        self.has_audio = has_audio
+        self.source_duration = source_duration
+        self.start_time = 0
+        self.duration = None
+        self.filters = []
+
+    def trim(self, start_time=0, duration=None):
+        """Limit decoding to [start_time, start_time + duration)"""
+        self.start_time = max(0, start_time or 0)
+        self.duration = duration
+        return self
+
+    def crop(self, width, height, x, y):
+        """Crop the video to width x height at offset (x, y)"""
+        self.filters.append(('crop', (width, height, x, y), {}))
+        return self
+
+    def scale(self, width, height):
+        """Scale the video to width x height"""
+        self.filters.append(('scale', (width, height), {}))
+        return self
+
+    def subtitles(self, srt_path, force_style=None):
+        """Burn in subtitles from an SRT file (timestamps relative to the trim start)"""
+        kwargs = {'force_style': force_style} if force_style else {}
+        self.filters.append(('subtitles', (srt_path,), kwargs))
+        return self
+
+    def credits(self, credits_text):
+        """Draw a credits line near the bottom of the frame"""
+        self.filters.append(('drawtext', (), {
+            'text': credits_text,
+            'fontsize': 20,
+            'fontcolor': 'white',
+            'x': '(w-text_w)/2',
+            'y': 'h-60',
+            'box': 1,
+            'boxcolor': 'black@0.5'
+        }))
+        return self
+
+    def expected_duration(self):
+        """Duration of the output in seconds, if known"""
+        if self.source_duration is None:
+            return self.duration
+        remaining = max(0, self.source_duration - self.start_time)
+        return min(self.duration, remaining) if self.duration else remaining
+
+    def build(self, output_path, **output_kwargs):
+        """Return the ffmpeg-python output node for this pipeline"""
+        source, video = self._source()
+
+        streams = [video]
+        if self.has_audio:
+            streams.append(source.audio)
+        else:
+            output_kwargs.pop('acodec', None)
+            output_kwargs.pop('audio_bitrate', None)
+
+        return ffmpeg.output(*streams, output_path, **output_kwargs)
+
+    def build_split(self, outputs, **output_kwargs):
+        """
+        Return an ffmpeg-python node writing several outputs from one decode
+
+        outputs is [(output_path, offset, duration)] with offsets relative to
+        the trim start; each branch is trimmed to its own window.
+        """
+        branches = []
+        for output_path, offset, duration in outputs:
+            video_filters = [('trim', (), {'start': offset, 'duration': duration}),
+                             ('setpts', ('PTS-STARTPTS',), {})]
+            audio_filters = [('atrim', (), {'start': offset, 'duration': duration}),
+                             ('asetpts', ('PTS-STARTPTS',), {})]
+            branches.append((output_path, video_filters, audio_filters, output_kwargs))
+        return self.build_fanout(branches)
+
+    def build_fanout(self, branches):
+        """
+        Return an ffmpeg-python node feeding several outputs from one decode
+
+        branches is [(output_path, video_filters, audio_filters, output_kwargs)].
+        The pipeline's filters run once; the result (and the audio) is split
+        per branch and each branch's own filters ([(name, args, kwargs)]) are
+        applied after the split. audio_filters of None means a video-only output.
+        """
+        source, video = self._source()
+        videos = video.filter_multi_output('split', len(branches))
+        audio_count = sum(1 for _, _, audio_filters, _ in branches if audio_filters is not None)
+        audios = None
+        if self.has_audio and audio_count:
+            audios = source.audio.filter_multi_output('asplit', audio_count)
+
+        nodes = []
+        audio_index = 0
+        for i, (output_path, video_filters, audio_filters, output_kwargs) in enumerate(branches):
+            branch_video = videos[i]
+            for name, args, kwargs in video_filters:
+                branch_video = branch_video.filter(name, *args, **kwargs)
+            streams = [branch_video]
+
+            output_kwargs = dict(output_kwargs)
+            if audios is not None and audio_filters is not None:
+                branch_audio = audios[audio_index]
+                audio_index += 1
+                for name, args, kwargs in audio_filters:
+                    branch_audio = branch_audio.filter(name, *args, **kwargs)
+                streams.append(branch_audio)
+            else:
+                output_kwargs.pop('acodec', None)
+                output_kwargs.pop('audio_bitrate', None)
+
+            nodes.append(ffmpeg.output(*streams, output_path, **output_kwargs))
+        return ffmpeg.merge_outputs(*nodes)
+
+    def _source(self):
+        """(input node, video stream with the pipeline's filters applied)"""
+        input_kwargs = {}
+        if self.start_time:
+            input_kwargs['ss'] = self.start_time
+        if self.duration:
+            input_kwargs['t'] = self.duration
+
+        source = ffmpeg.input(self.input_path, **input_kwargs)
+        video = source.video
+        for name, args, kwargs in self.filters:
+            video = video.filter(name, *args, **kwargs)
+        return source, video
+
+    def run(self, output_path, progress=None, **output_kwargs):
+        """
+        Build and execute the pipeline in a single FFmpeg invocation
+        progress is an optional reporter passed through to run_ffmpeg
+        """
+        logger.info(f"Running clip pipeline: {self.input_path} -> {output_path} "
+                    f"({len(self.filters)} filters, ss={self.start_time}, t={self.duration})")
+        stream = self.build(output_path, **output_kwargs)
+        with stage('encode'):
+            run_ffmpeg(stream, duration=self.expected_duration(), progress=progress)
+        return output_path
+
+    def run_split(self, outputs, progress=None, **output_kwargs):
+        """Build and execute build_split(outputs) in a single FFmpeg invocation"""
+        logger.info(f"Running split clip pipeline: {self.input_path} -> {len(outputs)} outputs "
+                    f"({len(self.filters)} filters, ss={self.start_time}, t={self.duration})")
+        stream = self.build_split(outputs, **output_kwargs)
+        with stage('encode'):
+            run_ffmpeg(stream, duration=self.expected_duration(), progress=progress)
+        return [output_path for output_path, _, _ in outputs]
+
+    def run_fanout(self, branches, progress=None):
+        """Build and execute build_fanout(branches) in a single FFmpeg invocation"""
+        logger.info(f"Running fan-out clip pipeline: {self.input_path} -> {len(branches)} outputs "
+                    f"({len(self.filters)} filters, ss={self.start_time}, t={self.duration})")
+        stream = self.build_fanout(branches)
+        with stage('encode'):
+            run_ffmpeg(stream, duration=self.expected_duration(), progress=progress)
+        return [output_path for output_path, _, _, _ in branches]
@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """
+    One output of a clip: a platform encode, a preview, or an image
+
+    kind is 'video', 'poster' (one frame at poster_at of the clip's length)
+    or 'sprite' (a sprite_columns x sprite_rows sheet of evenly spaced
+    thumbnails). caption_format is the format_for_social_media style used
+    when this rendition is requested as a platform.
+    """
+    name: str
+    width: int
+    height: int
+    kind: str = 'video'
+    video_bitrate: str = None
+    audio_bitrate: str = '128k'
+    max_fps: float = None
+    extension: str = 'mp4'
+    caption_format: str = None
+    platforms: tuple = ()
+    poster_at: float = 0.25
+    sprite_columns: int = 5
+    sprite_rows: int = 5
+
+    def output_path(self, base_path):
+        """Output path for this rendition next to base_path (an .mp4 path)"""
+        return base_path.replace('.mp4', f'_{self.name}.{self.extension}')
+
+    def branch(self, base_size, duration, fps=None):
+        """
+        (video_filters, audio_filters, output_kwargs) for this rendition when fed
+        from a stream already cropped and scaled to base_size, lasting duration
+        seconds at fps; audio_filters is None for image outputs
+        """
+        video_filters = []
+        if self.kind == 'poster':
+            video_filters.append(('select', (f'gte(t,{round(duration * self.poster_at, 3)})',), {}))
+        elif self.kind == 'sprite':
+            interval = max(duration, 1) / (self.sprite_columns * self.sprite_rows)
+            video_filters.append(('fps', (), {'fps': f'1/{round(interval, 3)}'}))
+        elif self.max_fps and (fps is None or fps > self.max_fps):
+            video_filters.append(('fps', (), {'fps': self.max_fps}))
+
+        if (self.width, self.height) != tuple(base_size):
+            video_filters.append(('scale', (self.width, self.height), {}))
+
+        if self.kind == 'sprite':
+            video_filters.append(('tile', (f'{self.sprite_columns}x{self.sprite_rows}',), {}))
+        if self.kind != 'video':
+            return video_filters, None, {'frames:v': 1}
+        return video_filters, [], self.encode_options()
+
+    def encode_options(self):
+        """FFmpeg output options for a video rendition"""
+        options = {
+            'vcodec': 'libx264',
+            'acodec': 'aac',
+            'video_bitrate': self.video_bitrate,
+            'audio_bitrate': self.audio_bitrate
+        }
+        if self.extension == 'mp4':
+            # moov atom up front so playback starts before the whole file is fetched
+            options['movflags'] = '+faststart'
+        return options
+
+
+# Registry of rendition profiles by name
+RENDITIONS = {}
+
+
+def register_rendition(rendition):
+    """Add (or replace) a rendition profile"""
+    RENDITIONS[rendition.name] = rendition
+    return rendition
+
+
+def get_rendition(name):
+    """Rendition profile registered under name, or None"""
+    return RENDITIONS.get(name)
+
+
+def rendition_for_platform(platform):
+    """Rendition profile for a platform name (its own name or one of its platforms), or None"""
+    if platform in RENDITIONS:
+        return RENDITIONS[platform]
+    return next((r for r in RENDITIONS.values() if platform in r.platforms), None)
+
+
+def is_published_name(filename):
+    """
+    True for the file names outputs are published under, <clip>.mp4 and
+    <clip>_<rendition>.<extension> (see Rendition.output_path); work
+    directories, subtitles and partial files written next to them are not
+    """
+    if '/' in filename or '.part.' in filename:
+        return False
+    suffixes = ['.mp4'] + [f"_{r.name}.{r.extension}" for r in RENDITIONS.values()]
+    return any(filename.endswith(suffix) and len(filename) > len(suffix) for suffix in suffixes)
+
+
+def resolve_renditions(names):
+    """Rendition profiles for names (profile or platform names), raising ValueError for unknown ones"""
+    renditions = []
+    for name in names:
+        rendition = rendition_for_platform(name)
+        if rendition is None:
+            raise ValueError(f"Unknown rendition: {name}")
+        if rendition not in renditions:
+            renditions.append(rendition)
+    return renditions
+
+
+register_rendition(Rendition('tiktok', 1080, 1920, video_bitrate='4M', audio_bitrate='192k',
+                             caption_format='tiktok'))
+register_rendition(Rendition('shorts', 1080, 1920, video_bitrate='6M', audio_bitrate='192k',
+                             caption_format='youtube', platforms=('youtube',)))
+register_rendition(Rendition('reels', 1080, 1920, video_bitrate='3500k', audio_bitrate='128k', max_fps=30,
+                             caption_format='tiktok', platforms=('instagram',)))
+register_rendition(Rendition('preview', 360, 640, video_bitrate='600k', audio_bitrate='64k'))
+register_rendition(Rendition('poster', 1080, 1920, kind='poster', extension='jpg'))
+register_rendition(Rendition('sprite', 108, 192, kind='sprite', extension='jpg'))
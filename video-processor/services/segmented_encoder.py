@@ -0,0 +1,186 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+from services.ffmpeg_runner import run_ffmpeg
+from services.metrics import propagate, stage
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentedEncoder:
+    """
+    Encode long inputs as keyframe-aligned segments in parallel
+
+    The range is split at source keyframes (so every segment seeks straight
+    to a keyframe), each segment's video is encoded by its own FFmpeg process
+    with identical settings and a share of the job's core budget, and the
+    audio is encoded once for the whole range so there are no AAC priming
+    gaps at the joins. The segments are MPEG-TS and are joined losslessly
+    with the concat demuxer while the audio is muxed in.
+    """
+
+    def __init__(self, probe, cores=None, threads_per_segment=2, segment_seconds=120,
+                 min_segment_seconds=30, min_duration=180):
+        self.probe = probe
+        self.cores = cores or os.cpu_count() or 1  # per-job core budget, or a callable returning it
+        self.threads_per_segment = threads_per_segment
+        self.segment_seconds = segment_seconds
+        self.min_segment_seconds = min_segment_seconds
+        self.min_duration = min_duration  # shorter ranges aren't worth splitting
+
+    @property
+    def max_parallel(self):
+        cores = self.cores() if callable(self.cores) else self.cores
+        return max(1, cores // self.threads_per_segment)
+
+    def plan(self, input_path, start_time, end_time):
+        """Return [(start, end)] segments for the range, or None if it should be encoded in one piece"""
+        total = end_time - start_time
+        max_parallel = self.max_parallel
+        if max_parallel < 2 or total < self.min_duration:
+            return None
+
+        # Enough segments to occupy every slot, but short enough to balance the load
+        target = min(self.segment_seconds, max(self.min_segment_seconds, total / max_parallel))
+        segments = plan_segments(self.probe.keyframes(input_path), start_time, end_time, target)
+        return segments if len(segments) > 1 else None
+
+    def encode(self, input_path, output_path, make_pipeline, segments, encode_options, progress=None):
+        """
+        Encode segments [(start, end)] and join them into output_path
+
+        make_pipeline(index, start, duration) returns the ClipPipeline for one
+        segment (crop/scale/captions etc. already applied); its audio is
+        ignored. encode_options are the output options used for every segment.
+        """
+        info = self.probe.probe(input_path)
+        start_time, end_time = segments[0][0], segments[-1][1]
+        frame = 1 / (info.fps or 25)
+
+        video_options = {k: v for k, v in encode_options.items()
+                         if k not in ('acodec', 'audio_bitrate', 'movflags')}
+        video_options['threads'] = self.threads_per_segment
+        max_parallel = self.max_parallel
+
+        work_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(output_path)))
+        tracker = _SegmentProgress(progress, len(segments), end_time - start_time)
+        try:
+            logger.info(f"Encoding {input_path} as {len(segments)} segments "
+                        f"({max_parallel} in parallel, {self.threads_per_segment} threads each)")
+
+            piece_paths = [os.path.join(work_dir, f"segment_{i}.ts") for i in range(len(segments))]
+            audio_path = os.path.join(work_dir, 'audio.m4a') if info.has_audio else None
+
+            with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+                futures = []
+                if audio_path:
+                    futures.append(executor.submit(propagate(self._encode_audio), input_path, audio_path,
+                                                   start_time, end_time, encode_options))
+                for i, (segment_start, segment_end) in enumerate(segments):
+                    # Stop half a frame early so the next segment's first frame isn't duplicated
+                    duration = segment_end - segment_start - frame / 2
+                    pipeline = make_pipeline(i, segment_start, duration)
+                    pipeline.has_audio = False
+                    stream = pipeline.build(piece_paths[i], format='mpegts', **video_options)
+                    futures.append(executor.submit(propagate(self._encode_segment), i, stream, duration,
+                                                   tracker.reporter(i)))
+
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Stop the segments still running
+                    tracker.abort()
+                    raise
+
+            list_path = os.path.join(work_dir, 'segments.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for piece_path in piece_paths:
+                    f.write(f"file '{piece_path}'\n")
+
+            streams = [ffmpeg.input(list_path, format='concat', safe=0).video]
+            if audio_path:
+                streams.append(ffmpeg.input(audio_path).audio)
+            with stage('segments_join'):
+                run_ffmpeg(ffmpeg.output(*streams, output_path, c='copy', movflags='+faststart'))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return output_path
+
+    def _encode_segment(self, index, stream, duration, reporter):
+        with stage('encode_segment', segment=index):
+            run_ffmpeg(stream, duration, reporter)
+
+    def _encode_audio(self, input_path, audio_path, start_time, end_time, encode_options):
+        stream = ffmpeg.input(input_path, ss=start_time, t=end_time - start_time).audio
+        acodec = encode_options.get('acodec', 'aac')
+        if acodec == 'copy':
+            stream = ffmpeg.output(stream, audio_path, acodec='copy')
+        else:
+            stream = ffmpeg.output(stream, audio_path, acodec=acodec,
+                                   audio_bitrate=encode_options.get('audio_bitrate', '192k'))
+        with stage('encode_audio'):
+            run_ffmpeg(stream)
+
+
+class _SegmentProgress:
+    """Combine progress from segments encoding in parallel into one reporter"""
+
+    def __init__(self, progress, count, duration):
+        self.progress = progress
+        self.duration = duration
+        self.out_times = [0.0] * count
+        self.fps = [0.0] * count
+        self.speeds = [0.0] * count
+        self._aborted = threading.Event()
+        self._lock = threading.Lock()
+
+    def reporter(self, index):
+        return _SegmentReporter(self, index)
+
+    def abort(self):
+        self._aborted.set()
+
+    def update(self, index, out_time, fps, speed):
+        with self._lock:
+            self.out_times[index] = out_time or self.out_times[index]
+            self.fps[index] = fps or 0.0
+            self.speeds[index] = speed or 0.0
+            if self.progress is not None:
+                self.progress.update(sum(self.out_times), sum(self.fps) or None,
+                                     sum(self.speeds) or None, self.duration)
+
+    def is_cancelled(self):
+        return self._aborted.is_set() or (self.progress is not None and self.progress.is_cancelled())
+
+
+class _SegmentReporter:
+    """run_ffmpeg progress reporter for one segment"""
+
+    def __init__(self, tracker, index):
+        self.tracker = tracker
+        self.index = index
+
+    def update(self, out_time, fps, speed, duration):
+        self.tracker.update(self.index, out_time, fps, speed)
+
+    def is_cancelled(self):
+        return self.tracker.is_cancelled()
+
+
+def plan_segments(keyframes, start_time, end_time, segment_seconds):
+    """
+    Split [start_time, end_time) at keyframes into segments of about segment_seconds
+    The last segment is merged into the previous one if it would be under half that length
+    """
+    boundaries = [start_time]
+    for keyframe in keyframes:
+        if keyframe - boundaries[-1] >= segment_seconds and end_time - keyframe >= segment_seconds / 2:
+            boundaries.append(keyframe)
+    boundaries.append(end_time)
+    return list(zip(boundaries, boundaries[1:]))
@@ -0,0 +1,199 @@
+import logging
+import os
+import subprocess
+import threading
+import ffmpeg
+from services.ffmpeg_runner import drain_stderr, wait_process
+from services.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisError(Exception):
+    """Raised when the analysis decode fails"""
+
+
+class SignalSet:
+    """
+    Per-second analysis signals for one source video
+
+    Every array has one value per second of video:
+    motion - mean absolute frame difference (0-255 scale)
+    cuts - number of histogram scene cuts
+    audio_rms - RMS level of the audio (0-1)
+    speech - fraction of audio energy in the 300-3000 Hz voice band
+    high_energy - fraction of audio energy above 3000 Hz
+    """
+
+    NAMES = ('motion', 'cuts', 'audio_rms', 'speech', 'high_energy')
+
+    def __init__(self, **signals):
+        import numpy as np
+        length = max((len(v) for v in signals.values()), default=0)
+        for name in self.NAMES:
+            values = np.asarray(signals.get(name, ()), dtype=np.float32)
+            if len(values) < length:
+                values = np.pad(values, (0, length - len(values)))
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.motion)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.NAMES}
+
+
+class SignalAnalyzer:
+    """
+    Compute every clip-type signal from a single low-resolution decode
+
+    FFmpeg decodes the source once, writing tiny grayscale frames to stdout
+    and low-rate mono PCM to a second pipe. Both are consumed one second at a
+    time, so memory stays bounded by the per-second arrays regardless of how
+    long the video is.
+    """
+
+    def __init__(self, width=64, height=36, fps=4, sample_rate=8000, cut_threshold=0.5):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self.cut_threshold = cut_threshold  # L1 histogram distance (0-2) counted as a cut
+
+    def analyze(self, video_path, has_audio=True):
+        """Decode video_path once and return its SignalSet"""
+        with stage('analysis'):
+            return self._analyze(video_path, has_audio)
+
+    def _analyze(self, video_path, has_audio):
+        logger.info(f"Analyzing signals for {video_path}")
+
+        read_fd, write_fd = os.pipe() if has_audio else (None, None)
+        try:
+            source = ffmpeg.input(video_path)
+            outputs = [source.video
+                       .filter('fps', self.fps)
+                       .filter('scale', self.width, self.height)
+                       .output('pipe:1', format='rawvideo', pix_fmt='gray')]
+            if has_audio:
+                outputs.append(source.audio.output(f"pipe:{write_fd}", format='s16le',
+                                                   ac=1, ar=self.sample_rate))
+            args = ffmpeg.merge_outputs(*outputs).global_args('-v', 'error').compile()
+
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       pass_fds=(write_fd,) if has_audio else ())
+        except BaseException:
+            if has_audio:
+                os.close(read_fd)
+                os.close(write_fd)
+            raise
+
+        audio_signals = {}
+        audio_thread = None
+        if has_audio:
+            os.close(write_fd)
+            audio_thread = threading.Thread(target=self._read_audio,
+                                            args=(os.fdopen(read_fd, 'rb'), audio_signals),
+                                            daemon=True)
+            audio_thread.start()
+        stderr_thread, stderr_tail = drain_stderr(process)
+
+        try:
+            video_signals = self._read_video(process.stdout)
+        finally:
+            process.stdout.close()
+            wait_process(process)
+            if audio_thread:
+                audio_thread.join()
+            stderr_thread.join(timeout=1)
+
+        if process.returncode != 0:
+            stderr = b''.join(stderr_tail).decode('utf-8', 'replace').strip()
+            raise AnalysisError(f"Analysis decode failed for {video_path}: {stderr}")
+        if 'error' in audio_signals:
+            raise AnalysisError(f"Audio analysis failed for {video_path}: {audio_signals['error']}")
+
+        signals = SignalSet(**video_signals, **audio_signals.get('signals', {}))
+        logger.info(f"Analyzed {len(signals)}s of {video_path}")
+        return signals
+
+    def _read_video(self, pipe):
+        """Per-second motion and scene-cut counts from raw grayscale frames"""
+        import numpy as np
+        frame_size = self.width * self.height
+        motion, cuts = [], []
+        previous, previous_hist = None, None
+
+        while True:
+            data = _read_exact(pipe, frame_size * self.fps)
+            count = len(data) // frame_size
+            if count == 0:
+                break
+
+            frames = np.frombuffer(data[:count * frame_size], dtype=np.uint8)
+            frames = frames.reshape(count, frame_size).astype(np.int16)
+            hists = luma_histograms(frames)
+
+            if previous is not None:
+                frames = np.vstack([previous, frames])
+                hists = np.vstack([previous_hist, hists])
+            if len(frames) > 1:
+                diffs = np.abs(np.diff(frames, axis=0)).mean(axis=1)
+                hist_distance = np.abs(np.diff(hists, axis=0)).sum(axis=1)
+                motion.append(float(diffs.mean()))
+                cuts.append(int((hist_distance > self.cut_threshold).sum()))
+            else:
+                motion.append(0.0)
+                cuts.append(0)
+
+            previous, previous_hist = frames[-1:], hists[-1:]
+
+        return {'motion': motion, 'cuts': cuts}
+
+    def _read_audio(self, pipe, out):
+        """Per-second RMS and band-energy ratios from 16-bit mono PCM"""
+        import numpy as np
+        rms, speech, high = [], [], []
+        freqs = np.fft.rfftfreq(self.sample_rate, d=1 / self.sample_rate)
+        speech_band = (freqs >= 300) & (freqs < 3000)
+        high_band = freqs >= 3000
+
+        try:
+            with pipe:
+                while True:
+                    data = _read_exact(pipe, self.sample_rate * 2)
+                    if len(data) < 2:
+                        break
+                    samples = np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2') / 32768.0
+                    rms.append(float(np.sqrt(np.mean(samples ** 2))))
+
+                    spectrum = np.abs(np.fft.rfft(samples, n=self.sample_rate)) ** 2
+                    total = spectrum.sum()
+                    speech.append(float(spectrum[speech_band].sum() / total) if total else 0.0)
+                    high.append(float(spectrum[high_band].sum() / total) if total else 0.0)
+            out['signals'] = {'audio_rms': rms, 'speech': speech, 'high_energy': high}
+        except Exception as e:
+            out['error'] = str(e)
+
+
+def luma_histograms(frames, bins=16):
+    """Normalised luma histograms for a block of flattened 8-bit frames, in one bincount"""
+    import numpy as np
+    shift = 8 - int(np.log2(bins))
+    offsets = (np.arange(len(frames)) * bins)[:, None]
+    counts = np.bincount(((frames >> shift) + offsets).ravel(), minlength=len(frames) * bins)
+    return counts.reshape(len(frames), bins) / frames.shape[1]
+
+
+def _read_exact(pipe, size):
+    """Read up to size bytes, only returning short at end of stream"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = pipe.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
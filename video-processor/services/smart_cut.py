@@ -0,0 +1,122 @@
+import bisect
+import logging
+import os
+import shutil
+import tempfile
+import ffmpeg
+from services.ffmpeg_runner import run_ffmpeg
+from services.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Codecs whose streams can be joined with re-encoded libx264 boundary pieces
+SMART_CUT_CODECS = ('h264',)
+
+# libx264 -profile:v for each H.264 profile ffprobe reports
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444'
+}
+
+
+class SmartCutter:
+    """
+    Frame-accurate cuts that only re-encode the partial GOPs at each end
+
+    [start, first keyframe) and [last keyframe, end) are re-encoded; every
+    full GOP in between is stream-copied. The re-encoded pieces use the
+    source's profile, level and pixel format, so the single avcC the MP4
+    gets is valid for every piece; sources libx264 can't match aren't
+    smart-cut. The video pieces are written as MPEG-TS (parameter sets
+    in-band) and joined with the concat demuxer, then muxed with audio
+    copied from the source in one remux.
+    """
+
+    def __init__(self, probe, preset='veryfast', crf=18):
+        self.probe = probe
+        self.preset = preset
+        self.crf = crf
+
+    def can_cut(self, input_path):
+        """True if boundary pieces can be encoded to match the source's stream"""
+        info = self.probe.probe(input_path)
+        return (info.video_codec in SMART_CUT_CODECS and info.video_profile in X264_PROFILES
+                and info.video_level is not None and info.pix_fmt is not None)
+
+    def cut(self, input_path, output_path, start_time, end_time, progress=None):
+        """Cut [start_time, end_time) from input_path into output_path"""
+        with stage('smart_cut'):
+            return self._cut(input_path, output_path, start_time, end_time, progress)
+
+    def _cut(self, input_path, output_path, start_time, end_time, progress):
+        info = self.probe.probe(input_path)
+        end_time = min(end_time, info.duration)
+        keyframes = self.probe.keyframes(input_path)
+        frame = 1 / (info.fps or 25)
+
+        # First keyframe at/after start and last keyframe at/before end
+        first = bisect.bisect_left(keyframes, start_time - frame / 2)
+        last = bisect.bisect_right(keyframes, end_time) - 1
+        if first >= len(keyframes) or last < 0 or keyframes[first] >= keyframes[last]:
+            logger.info("No full GOP inside the cut, re-encoding the whole range")
+            pieces = [('encode', start_time, end_time)]
+        else:
+            copy_start, copy_end = keyframes[first], keyframes[last]
+            pieces = []
+            if copy_start - start_time >= frame / 2:
+                pieces.append(('encode', start_time, copy_start))
+            pieces.append(('copy', copy_start, copy_end))
+            if end_time - copy_end >= frame / 2:
+                pieces.append(('encode', copy_end, end_time))
+
+        work_dir = tempfile.mkdtemp(prefix='smartcut_', dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            list_path = os.path.join(work_dir, 'pieces.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for i, (mode, piece_start, piece_end) in enumerate(pieces):
+                    piece_path = os.path.join(work_dir, f"piece_{i}.ts")
+                    if mode == 'copy':
+                        self._copy_piece(input_path, piece_path, piece_start, piece_end)
+                    else:
+                        self._encode_piece(input_path, piece_path, piece_start, piece_end, info)
+                    f.write(f"file '{piece_path}'\n")
+
+            logger.info(f"Smart cut {start_time}s-{end_time}s: "
+                        + ', '.join(f"{m} {s:.2f}-{e:.2f}" for m, s, e in pieces))
+
+            video = ffmpeg.input(list_path, format='concat', safe=0).video
+            streams = [video]
+            if info.has_audio:
+                streams.append(ffmpeg.input(input_path, ss=start_time, t=end_time - start_time).audio)
+            stream = ffmpeg.output(*streams, output_path, c='copy', movflags='+faststart')
+            run_ffmpeg(stream, duration=end_time - start_time, progress=progress)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return output_path
+
+    def _copy_piece(self, input_path, piece_path, start, end):
+        # Seek just past the keyframe so rounding can't land on the previous GOP;
+        # with stream copy the duration counts from the keyframe actually used
+        stream = ffmpeg.input(input_path, ss=start + 0.001, t=end - start).video
+        stream = ffmpeg.output(stream, piece_path, c='copy', bsf='h264_mp4toannexb', format='mpegts')
+        run_ffmpeg(stream)
+
+    def _encode_piece(self, input_path, piece_path, start, end, info):
+        # Stop half a frame early so the frame at `end` (the next piece's first) isn't duplicated
+        frame = 1 / (info.fps or 25)
+        stream = ffmpeg.input(input_path, ss=start, t=max(frame / 2, end - start - frame / 2)).video
+        stream = ffmpeg.output(stream, piece_path,
+                               vcodec='libx264',
+                               preset=self.preset,
+                               crf=self.crf,
+                               pix_fmt=info.pix_fmt,
+                               level=f"{info.video_level / 10:.1f}",
+                               format='mpegts',
+                               **{'profile:v': X264_PROFILES[info.video_profile]})
+        run_ffmpeg(stream)
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+import ffmpeg
+from services.ffmpeg_runner import drain_stderr, wait_process
+from services.fingerprint import stat_key
+from services.metrics import cache_lookup, stage
+from services.transcription import shift_segment
+
+logger = logging.getLogger(__name__)
+
+# Audio fingerprint: WINDOW_SECONDS decoded at 0s and at 30s, 90s, 270s, ...
+# (x3 each time), so a 2-hour source costs six short seeks, not a full decode
+FINGERPRINT_VERSION = 2
+WINDOW_SECONDS = 5
+FIRST_WINDOW_GAP = 30
+
+
+class TranscriptCache:
+    """
+    On-disk transcript cache keyed by a fingerprint of the decoded audio
+
+    Each entry holds the segments (with any word timings) transcribed so far
+    for one audio track, in source time, plus the ranges they cover. A request
+    for a range inside a covered range is answered by slicing, so overlapping
+    clips from the same source are only transcribed once. Entries and the
+    remembered audio keys are evicted least-recently-used once the directory
+    exceeds max_bytes; keys not used for key_max_age seconds (their file is
+    usually gone) are dropped whatever the size.
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, key_max_age=30 * 86400):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_max_age = key_max_age
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'audio_keys'), exist_ok=True)
+
+    def audio_key(self, video_path, duration):
+        """
+        SHA-256 of the duration (to the second) and of fixed windows of the
+        audio decoded to 8 kHz mono PCM (see WINDOW_SECONDS); the cost is
+        bounded however long the source is
+        Remembered by stat key, so each file version is only decoded once
+        """
+        key_path = os.path.join(self.cache_dir, 'audio_keys', f"{stat_key(video_path)}.v{FINGERPRINT_VERSION}")
+        try:
+            with open(key_path, 'r') as f:
+                digest = f.read().strip()
+            os.utime(key_path)
+            return digest
+        except OSError:
+            pass
+
+        windows = [ffmpeg.input(video_path, ss=start, t=WINDOW_SECONDS).audio
+                   for start in _window_starts(duration)]
+        args = (ffmpeg.concat(*windows, v=0, a=1)
+                .output('pipe:1', format='s16le', ac=1, ar=8000)
+                .global_args('-v', 'error')
+                .compile())
+        with stage('audio_fingerprint'):
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stderr_thread, stderr_tail = drain_stderr(process)
+            sha = hashlib.sha256(f"{FINGERPRINT_VERSION}:{round(duration)}:".encode('ascii'))
+            for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                sha.update(chunk)
+            wait_process(process)
+            stderr_thread.join(timeout=1)
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', None, b''.join(stderr_tail))
+
+        digest = sha.hexdigest()
+        _write_atomic(key_path, digest)
+        return digest
+
+    def lookup(self, audio_key, start_time, end_time):
+        """
+        Segments for [start_time, end_time) with times relative to start_time,
+        or None if that range hasn't been transcribed
+        """
+        entry = self._read(audio_key)
+        covered = bool(entry) and any(s <= start_time + 0.01 and end_time - 0.01 <= e
+                                      for s, e in entry['ranges'])
+        cache_lookup('transcripts', covered)
+        if not covered:
+            return None
+
+        try:
+            os.utime(self._entry_path(audio_key))
+        except FileNotFoundError:
+            pass  # evicted since it was read; the segments read are still good
+        segments = []
+        for segment in entry['segments']:
+            if segment['end'] <= start_time or segment['start'] >= end_time:
+                continue
+            segments.append(shift_segment(segment, -start_time, end_time - start_time))
+        return segments
+
+    def store(self, audio_key, start_time, end_time, segments):
+        """Add segments transcribed for [start_time, end_time) (times relative to start_time)"""
+        with self._lock:
+            entry = self._read(audio_key) or {'ranges': [], 'segments': []}
+
+            kept = [s for s in entry['segments']
+                    if not start_time <= (s['start'] + s['end']) / 2 < end_time]
+            added = [shift_segment(s, start_time) for s in segments]
+            entry['segments'] = sorted(kept + added, key=lambda s: s['start'])
+            entry['ranges'] = _merge_ranges(entry['ranges'] + [[start_time, end_time]])
+
+            _write_atomic(self._entry_path(audio_key), json.dumps(entry))
+            self._evict()
+
+    def _entry_path(self, audio_key):
+        return os.path.join(self.cache_dir, f"{audio_key}.json")
+
+    def _read(self, audio_key):
+        try:
+            with open(self._entry_path(audio_key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable transcript cache entry {audio_key}: {e}")
+            return None
+
+    def _evict(self):
+        """Delete least recently used entries and keys until the cache fits in max_bytes"""
+        key_dir = os.path.join(self.cache_dir, 'audio_keys')
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name.endswith('.json')]
+        files += [os.path.join(key_dir, name) for name in os.listdir(key_dir) if not name.endswith('.tmp')]
+
+        entries = []
+        for path in files:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            expired_key = path.startswith(key_dir + os.sep) and now - mtime > self.key_max_age
+            if total <= self.max_bytes and not expired_key:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted transcript cache file {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
+
+
+def _window_starts(duration):
+    """Start times of the fingerprint windows in [0, duration)"""
+    starts = [0]
+    start = FIRST_WINDOW_GAP
+    while start < duration:
+        starts.append(start)
+        start *= 3
+    return starts
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
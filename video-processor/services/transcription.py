@@ -0,0 +1,168 @@
+import logging
+import re
+import subprocess
+import ffmpeg
+
+logger = logging.getLogger(__name__)
+
+_SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+_SILENCE_END = re.compile(r'silence_end: (-?[\d.]+)')
+
+
+class TranscriptionBackend:
+    """Speech-to-text service used by CaptionGenerator"""
+
+    def transcribe(self, audio_file, filename, duration):
+        """
+        Transcribe an audio file object of the given duration (seconds)
+        Returns [{'start', 'end', 'text'}] with times relative to the audio start;
+        segments may also carry 'words': [{'start', 'end', 'word'}]
+        """
+        raise NotImplementedError
+
+
+class WhisperBackend(TranscriptionBackend):
+    """OpenAI Whisper transcription"""
+
+    def __init__(self, client, model='whisper-1'):
+        self.client = client
+        self.model = model
+
+    def transcribe(self, audio_file, filename, duration):
+        transcript = self.client.audio.transcriptions.create(
+            model=self.model,
+            file=(filename, audio_file),
+            response_format="verbose_json",
+            timestamp_granularities=["segment", "word"]
+        )
+        words = [{
+            'start': float(_field(word, 'start')),
+            'end': float(_field(word, 'end')),
+            'word': _field(word, 'word')
+        } for word in getattr(transcript, 'words', None) or []]
+
+        segments = []
+        for segment in transcript.segments or []:
+            start = float(_field(segment, 'start'))
+            end = float(_field(segment, 'end'))
+            segments.append({
+                'start': start,
+                'end': end,
+                'text': _field(segment, 'text').strip(),
+                'words': [w for w in words if start <= w['start'] < end]
+            })
+        return segments
+
+
+class FakeTranscriptionBackend(TranscriptionBackend):
+    """Deterministic local backend: one numbered segment every segment_length seconds"""
+
+    def __init__(self, segment_length=3.0):
+        self.segment_length = segment_length
+        self.calls = []
+
+    def transcribe(self, audio_file, filename, duration):
+        self.calls.append({'filename': filename, 'duration': duration, 'bytes': len(audio_file.read())})
+        segments = []
+        start = 0.0
+        while start < duration:
+            end = min(duration, start + self.segment_length)
+            segments.append({'start': start, 'end': end, 'text': f"Segment at {start:.1f}s"})
+            start = end
+        return segments
+
+
+def shift_segment(segment, offset, limit=None):
+    """Copy of a segment (and its words) moved by offset seconds, clamped to [0, limit]"""
+    def move(t):
+        t = round(t + offset, 3)
+        return max(0.0, min(t, limit)) if limit is not None else t
+
+    shifted = dict(segment, start=move(segment['start']), end=move(segment['end']))
+    if segment.get('words'):
+        shifted['words'] = [dict(w, start=move(w['start']), end=move(w['end']))
+                            for w in segment['words']]
+    return shifted
+
+
+def _field(segment, name):
+    """Segments come back as dicts or attribute objects depending on the client version"""
+    if isinstance(segment, dict):
+        return segment[name]
+    return getattr(segment, name)
+
+
+def detect_silences(video_path, start_time=0, duration=None, noise='-35dB', min_silence=0.4):
+    """
+    Find silent stretches in the audio of video_path with FFmpeg's silencedetect
+    Returns [(silence_start, silence_end)] relative to start_time
+    """
+    input_kwargs = {}
+    if start_time:
+        input_kwargs['ss'] = start_time
+    if duration:
+        input_kwargs['t'] = duration
+
+    args = (ffmpeg.input(video_path, **input_kwargs).audio
+            .filter('silencedetect', noise=noise, d=min_silence)
+            .output('-', format='null')
+            .global_args('-nostats', '-hide_banner')
+            .compile())
+    result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        logger.warning(f"Silence detection failed for {video_path}, chunking at fixed intervals")
+        return []
+
+    silences = []
+    silence_start = None
+    for line in result.stderr.splitlines():
+        match = _SILENCE_START.search(line)
+        if match:
+            silence_start = max(0.0, float(match.group(1)))
+            continue
+        match = _SILENCE_END.search(line)
+        if match and silence_start is not None:
+            silences.append((silence_start, float(match.group(1))))
+            silence_start = None
+    return silences
+
+
+def plan_chunks(total_duration, silences, max_chunk=600.0):
+    """
+    Split [0, total_duration) into chunks no longer than max_chunk seconds
+
+    Each boundary is placed in the middle of the latest silence in the second
+    half of the chunk, falling back to a hard cut at max_chunk when there is
+    none. Returns [(start, end)].
+    """
+    midpoints = sorted((s + e) / 2 for s, e in silences)
+    chunks = []
+    start = 0.0
+    while total_duration - start > max_chunk:
+        limit = start + max_chunk
+        candidates = [m for m in midpoints if start + max_chunk / 2 <= m <= limit]
+        end = candidates[-1] if candidates else limit
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, total_duration))
+    return chunks
+
+
+def merge_chunk_segments(chunk_results):
+    """
+    Merge per-chunk segments into one timeline
+
+    chunk_results is [(chunk_start, chunk_end, audio_offset, segments)] where
+    segment times are relative to audio_offset (the chunk's audio is padded
+    on both sides). A segment belongs to the chunk that contains its
+    midpoint, which drops the duplicates transcribed in the padding.
+    """
+    merged = []
+    for chunk_start, chunk_end, audio_offset, segments in sorted(chunk_results, key=lambda c: c[0]):
+        for segment in segments:
+            midpoint = (segment['start'] + segment['end']) / 2 + audio_offset
+            if not chunk_start <= midpoint < chunk_end:
+                continue
+            merged.append(shift_segment(segment, audio_offset))
+    return merged
@@ -0,0 +1,260 @@
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from services.fingerprint import remember_content_hash
+
+logger = logging.getLogger(__name__)
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """Raised for a rejected upload request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadStore:
+    """
+    Resumable uploads written straight to their final location
+
+    An upload is created with its total size, then its bytes are appended
+    in any number of requests, each starting at the offset the server has
+    (so a dropped connection resumes instead of restarting). Bodies are
+    copied to disk in chunk_size pieces and hashed on the way, so the
+    finished file already has its content hash (kept in its state and
+    seeded into services.fingerprint). State lives next to the data in
+    upload_dir, so any process or node sharing the directory can continue
+    an upload. Each process keeps its running hash of the uploads it has
+    appended to and, when another process appended in between, only reads
+    the bytes it hasn't hashed yet; an upload spread over N processes is
+    read back at most N times, not once per request.
+    """
+
+    def __init__(self, upload_dir, max_bytes=4 * 1024 * 1024 * 1024, chunk_size=1024 * 1024,
+                 header_bytes=2 * 1024 * 1024, abandon_after=86400):
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self.abandon_after = abandon_after  # seconds without a chunk before an unfinished upload may go
+        self.chunk_size = chunk_size
+        self.header_bytes = header_bytes  # bytes after which the container header is usually readable
+        self._hashers = collections.OrderedDict()  # upload_id -> (offset, sha256) appended in this process
+        self.max_hashers = 256
+        self._lock = threading.Lock()
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def create(self, size, filename=None):
+        """Start an upload of size bytes; returns its state"""
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('Upload size must be a positive number of bytes')
+        if size > self.max_bytes:
+            raise UploadError(f"Upload of {size} bytes exceeds the {self.max_bytes} byte limit", status=413)
+
+        upload_id = uuid.uuid4().hex
+        state = {'uploadId': upload_id, 'size': size, 'offset': 0, 'filename': filename,
+                 'complete': False, 'sha256': None, 'info': None, 'probed': False,
+                 'probedComplete': False, 'createdAt': time.time()}
+        open(self._part_path(upload_id), 'wb').close()
+        self._write_state(state)
+        logger.info(f"Created upload {upload_id} ({size} bytes)")
+        return state
+
+    def status(self, upload_id):
+        """Current state of an upload (raises UploadError 404 if unknown)"""
+        return self._read_state(upload_id)
+
+    def append(self, upload_id, stream, offset, length=None):
+        """
+        Append the bytes read from stream at offset
+        offset must equal the bytes already received (409 otherwise, with the
+        current offset so the client can resume); length, when known from
+        Content-Length, is checked against the declared size before reading
+        """
+        with self._file_lock(upload_id):
+            state = self._read_state(upload_id)
+            if state['complete']:
+                raise UploadError('Upload already complete', status=409, offset=state['offset'])
+            if offset != state['offset']:
+                raise UploadError(f"Expected offset {state['offset']}", status=409, offset=state['offset'])
+            remaining = state['size'] - offset
+            if length is not None and length > remaining:
+                raise UploadError(f"Chunk of {length} bytes exceeds the {remaining} bytes remaining",
+                                  status=413, offset=offset)
+
+            part_path = self._part_path(upload_id)
+            if not os.path.exists(part_path):
+                raise UploadError(f"Upload {upload_id} expired", status=410)
+            sha = self._hasher(upload_id, part_path, offset)
+            written = 0
+            try:
+                with open(part_path, 'r+b') as f:
+                    f.seek(offset)
+                    while True:
+                        chunk = stream.read(min(self.chunk_size, remaining - written + 1))
+                        if not chunk:
+                            break
+                        if written + len(chunk) > remaining:
+                            raise UploadError(f"Upload exceeds its declared size of {state['size']} bytes",
+                                              status=413, offset=offset)
+                        f.write(chunk)
+                        sha.update(chunk)
+                        written += len(chunk)
+            except BaseException:
+                # Drop whatever this request wrote; the client resumes from the old offset
+                with open(part_path, 'r+b') as f:
+                    f.truncate(offset)
+                with self._lock:
+                    self._hashers.pop(upload_id, None)
+                raise
+
+            state['offset'] = offset + written
+            with self._lock:
+                self._hashers[upload_id] = (state['offset'], sha)
+                self._hashers.move_to_end(upload_id)
+                while len(self._hashers) > self.max_hashers:
+                    self._hashers.popitem(last=False)  # uploads finished or abandoned elsewhere
+            if state['offset'] == state['size']:
+                self._complete(state, sha.hexdigest())
+            self._write_state(state)
+            return state
+
+    def path(self, upload_id):
+        """Path of a completed upload (raises UploadError 409 if still in progress)"""
+        state = self._read_state(upload_id)
+        if not state['complete']:
+            raise UploadError(f"Upload {upload_id} is incomplete", status=409, offset=state['offset'])
+        return self._data_path(upload_id)
+
+    def partial_path(self, upload_id):
+        """Path of the bytes received so far"""
+        state = self._read_state(upload_id)
+        return self._data_path(upload_id) if state['complete'] else self._part_path(upload_id)
+
+    def header_ready(self, state):
+        """True once enough of the upload has arrived to try probing it"""
+        return state['complete'] or state['offset'] >= min(self.header_bytes, state['size'])
+
+    def set_info(self, upload_id, info, complete=False):
+        """
+        Record media info probed from the upload (None if probing failed);
+        complete says it was probed from the whole file, which a later
+        probe of a partial file doesn't overwrite
+        """
+        with self._file_lock(upload_id):
+            state = self._read_state(upload_id)
+            if state.get('probedComplete') and not complete:
+                return state
+            state.update(info=info, probed=True, probedComplete=complete)
+            self._write_state(state)
+            return state
+
+    def eviction_unit(self, name):
+        """The upload a file in upload_dir belongs to (its files are evicted together), else the file name"""
+        upload_id = name.split('.', 1)[0]
+        return upload_id if _UPLOAD_ID.match(upload_id) else name
+
+    def in_progress(self, unit):
+        """True if unit (see eviction_unit) is an unfinished upload that hasn't been abandoned"""
+        if not _UPLOAD_ID.match(unit):
+            return False
+        try:
+            state = self._read_state(unit)
+            idle = time.time() - os.path.getmtime(self._state_path(unit))
+        except (UploadError, OSError, ValueError):
+            return False
+        return not state['complete'] and idle < self.abandon_after
+
+    def delete(self, upload_id):
+        """Abort an upload and remove its data"""
+        with self._file_lock(upload_id):
+            self._read_state(upload_id)
+            for path in (self._part_path(upload_id), self._data_path(upload_id),
+                         self._state_path(upload_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+
+    def _complete(self, state, digest):
+        upload_id = state['uploadId']
+        data_path = self._data_path(upload_id)
+        os.replace(self._part_path(upload_id), data_path)
+        remember_content_hash(data_path, digest)
+        state.update(complete=True, sha256=digest)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        logger.info(f"Upload {upload_id} complete ({state['size']} bytes, sha256 {digest[:12]})")
+
+    def _hasher(self, upload_id, part_path, offset):
+        """
+        SHA-256 of the first offset bytes: this process's running hash, caught
+        up on the bytes other processes appended since, or read from the start
+        """
+        with self._lock:
+            hashed_offset, sha = self._hashers.pop(upload_id, (0, None))
+        if sha is None or hashed_offset > offset:
+            hashed_offset, sha = 0, hashlib.sha256()
+        if hashed_offset == offset:
+            return sha
+
+        with open(part_path, 'rb') as f:
+            f.seek(hashed_offset)
+            remaining = offset - hashed_offset
+            while remaining:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                sha.update(chunk)
+                remaining -= len(chunk)
+        return sha
+
+    def _check_id(self, upload_id):
+        if not _UPLOAD_ID.match(upload_id or ''):
+            raise UploadError('Upload not found', status=404)
+
+    def _state_path(self, upload_id):
+        self._check_id(upload_id)
+        return os.path.join(self.upload_dir, f"{upload_id}.upload.json")
+
+    def _part_path(self, upload_id):
+        self._check_id(upload_id)
+        return os.path.join(self.upload_dir, f"{upload_id}.part")
+
+    def _data_path(self, upload_id):
+        self._check_id(upload_id)
+        return os.path.join(self.upload_dir, f"{upload_id}.mp4")
+
+    def _read_state(self, upload_id):
+        try:
+            with open(self._state_path(upload_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', status=404)
+
+    def _write_state(self, state):
+        state_path = self._state_path(state['uploadId'])
+        tmp_path = f"{state_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    @contextlib.contextmanager
+    def _file_lock(self, upload_id):
+        self._check_id(upload_id)
+        with open(os.path.join(self.upload_dir, f"{upload_id}.lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
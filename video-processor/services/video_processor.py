@@ -1,14 +1,34 @@
+import contextlib
 import ffmpeg
 import os
 import logging
+import threading
+from dataclasses import asdict
+from services.crop_planner import CropPlanner
+from services.encoding_profiles import COPYABLE_AUDIO, ProfilePolicy, parse_bitrate
+from services.ffmpeg_runner import run_ffmpeg
+from services.media_probe import MediaProbe
+from services.pipeline import ClipPipeline
+from services.renditions import get_rendition, resolve_renditions
+from services.segmented_encoder import SegmentedEncoder
+from services.smart_cut import SmartCutter
+from services.transcription import shift_segment
 
 logger = logging.getLogger(__name__)
 
 class VideoProcessor:
     """Handle video processing operations using FFmpeg"""
     
-    def __init__(self):
-        self.output_resolution = (1080, 1920)  # 9:16 aspect ratio
+    def __init__(self, probe=None, encode_cores=None, rendition='tiktok', reframe=True, profile_policy=None):
+        self.probe = probe or MediaProbe()
+        self.encode_cores = encode_cores  # per-job core budget, or a callable returning it (None: every core)
+        self.profile_policy = profile_policy or ProfilePolicy()  # see services.encoding_profiles
+        self.crop_planner = CropPlanner(self.probe) if reframe else None  # None: static centre crop
+        self.smart_cutter = SmartCutter(self.probe)
+        self.segmented_encoder = SegmentedEncoder(self.probe, cores=self.core_budget)
+        self.rendition = get_rendition(rendition)  # profile for single-output encodes
+        self.output_resolution = (self.rendition.width, self.rendition.height)  # 9:16 aspect ratio
+        self.caption_style = 'FontSize=24,PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline=2'
         
     def convert_to_vertical(self, input_path, output_path):
         """
@@ -17,38 +37,12 @@ class VideoProcessor:
         try:
             logger.info(f"Converting video to vertical format: {input_path}")
             
-            # Get input video info
-            probe = ffmpeg.probe(input_path)
-            video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-            width = int(video_info['width'])
-            height = int(video_info['height'])
-            
-            # Calculate scaling and cropping
-            target_width, target_height = self.output_resolution
-            target_aspect = target_width / target_height
-            source_aspect = width / height
-            
-            if source_aspect > target_aspect:
-                # Source is wider, crop width
-                new_width = int(height * target_aspect)
-                x_offset = (width - new_width) // 2
-                crop_filter = f"crop={new_width}:{height}:{x_offset}:0"
-            else:
-                # Source is taller, crop height
-                new_height = int(width / target_aspect)
-                y_offset = (height - new_height) // 2
-                crop_filter = f"crop={width}:{new_height}:0:{y_offset}"
-            
-            # Process video
-            stream = ffmpeg.input(input_path)
-            stream = ffmpeg.filter(stream, 'crop', crop_filter)
-            stream = ffmpeg.filter(stream, 'scale', target_width, target_height)
-            stream = ffmpeg.output(stream, output_path, 
-                                   vcodec='libx264',
-                                   acodec='aac',
-                                   video_bitrate='4M',
-                                   audio_bitrate='192k')
-            ffmpeg.run(stream, overwrite_output=True, quiet=True)
+            info = self.probe.probe(input_path)
+            crop_path = self._plan_crop(input_path, 0, info.duration)
+            with self._writing(output_path) as (part_path,):
+                if not self._encode_segmented(input_path, part_path, 0, info.duration, crop_path=crop_path):
+                    pipeline = self.build_vertical_pipeline(input_path, crop_path=crop_path)
+                    pipeline.run(part_path, **self._encode_options(info))
             
             logger.info(f"Video converted successfully: {output_path}")
             return output_path
@@ -57,18 +51,370 @@ class VideoProcessor:
             logger.error(f"Error converting video: {str(e)}")
             raise
     
-    def trim_video(self, input_path, output_path, duration):
+    def create_vertical_clip(self, input_path, output_path, start_time=0, duration=None,
+                             captions=None, credits_text=None, progress=None):
+        """
+        Produce a finished vertical clip in a single encode
+        Seeks the input to start_time, crops/scales to 9:16, burns in captions
+        (timestamps relative to start_time) and draws credits in one filter graph
+        Sources that are already 9:16 H.264 with nothing to burn in are smart-cut
+        (remuxed) instead of re-encoded
+        Long ranges are encoded as parallel keyframe-aligned segments
+        progress is an optional reporter (see services.ffmpeg_runner.run_ffmpeg)
+        """
+        srt_path = None
+        try:
+            logger.info(f"Creating vertical clip from {input_path} "
+                        f"(start={start_time}s, duration={duration}s)")
+            
+            if not captions and not credits_text and self._can_smart_cut(input_path):
+                end_time = start_time + duration if duration else self.probe.probe(input_path).duration
+                with self._writing(output_path) as (part_path,):
+                    self.smart_cutter.cut(input_path, part_path, start_time, end_time, progress=progress)
+                logger.info(f"Vertical clip smart-cut successfully: {output_path}")
+                return output_path
+            
+            info = self.probe.probe(input_path)
+            end_time = min(start_time + duration, info.duration) if duration else info.duration
+            crop_path = self._plan_crop(input_path, start_time, end_time)
+            with self._writing(output_path) as (part_path,):
+                if self._encode_segmented(input_path, part_path, start_time, end_time,
+                                          captions=captions, credits_text=credits_text,
+                                          crop_path=crop_path, progress=progress):
+                    logger.info(f"Vertical clip created successfully: {output_path}")
+                    return output_path
+                
+                pipeline = self.build_vertical_pipeline(input_path, crop_path=crop_path)
+                pipeline.trim(start_time, duration)
+                
+                if captions:
+                    srt_path = output_path.replace('.mp4', '.srt')
+                    self._create_srt_file(captions, srt_path)
+                    pipeline.subtitles(srt_path, force_style=self.caption_style)
+                
+                if credits_text:
+                    pipeline.credits(credits_text)
+                
+                pipeline.run(part_path, progress=progress, **self._encode_options(info))
+            
+            logger.info(f"Vertical clip created successfully: {output_path}")
+            return output_path
+            
+        except Exception as e:
+            logger.error(f"Error creating vertical clip: {str(e)}")
+            raise
+        finally:
+            if srt_path and os.path.exists(srt_path):
+                os.remove(srt_path)
+    
+    def create_vertical_clips(self, input_path, clips, progress=None, on_complete=None, max_gap=5):
+        """
+        Produce several vertical clips [(output_path, start_time, duration)] from one source
+        Clips whose windows overlap (or are within max_gap seconds) share one
+        decode: the cropped video is split into one encode per clip in a single
+        FFmpeg run. Each output is written under a temporary name and moved into
+        place when its group finishes, then on_complete(output_path) is called
+        """
+        info = self.probe.probe(input_path)
+        vertical = self._can_smart_cut(input_path)
+        
+        for group in self._group_clips(clips, max_gap):
+            if vertical or len(group) == 1:
+                # Smart cuts don't decode, and a lone clip gains nothing from a split
+                for output_path, start_time, duration in group:
+                    self.create_vertical_clip(input_path, output_path, start_time, duration,
+                                              progress=progress)
+                    if on_complete:
+                        on_complete(output_path)
+                continue
+            
+            group_start = min(start_time for _, start_time, _ in group)
+            group_end = min(info.duration, max(start_time + duration for _, start_time, duration in group))
+            logger.info(f"Creating {len(group)} vertical clips from one decode of {input_path} "
+                        f"({group_start}s-{group_end}s)")
+            
+            outputs = [(_part_path(output_path), start_time - group_start, duration)
+                       for output_path, start_time, duration in group]
+            crop_path = self._plan_crop(input_path, group_start, group_end)
+            pipeline = self.build_vertical_pipeline(input_path, crop_path=crop_path)
+            pipeline.trim(group_start, group_end - group_start)
+            try:
+                pipeline.run_split(outputs, progress=progress, **self._encode_options(outputs=len(outputs)))
+            except BaseException:
+                for part_path, _, _ in outputs:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                raise
+            
+            for (output_path, _, _), (part_path, _, _) in zip(group, outputs):
+                os.replace(part_path, output_path)
+                if on_complete:
+                    on_complete(output_path)
+    
+    def _group_clips(self, clips, max_gap):
+        """Group clips by start time into runs whose windows overlap or nearly touch"""
+        groups = []
+        group_end = None
+        for clip in sorted(clips, key=lambda c: c[1]):
+            _, start_time, duration = clip
+            if groups and start_time - group_end <= max_gap:
+                groups[-1].append(clip)
+                group_end = max(group_end, start_time + duration)
+            else:
+                groups.append([clip])
+                group_end = start_time + duration
+        return groups
+    
+    def create_renditions(self, input_path, output_path, renditions, start_time=0, duration=None,
+                          captions=None, credits_text=None, progress=None):
+        """
+        Produce several renditions of one clip (see services.renditions) in a single FFmpeg run
+        The range is decoded, cropped and captioned once at the largest rendition's
+        size, then split into one scale/encode or image branch per rendition.
+        The first video rendition is written to output_path, the others next to it
+        Returns {rendition_name: path}
+        """
+        renditions = resolve_renditions(renditions)
+        base_size = max(((r.width, r.height) for r in renditions), key=lambda size: size[0] * size[1])
+        
+        paths = {}
+        for rendition in renditions:
+            if rendition.kind == 'video' and output_path not in paths.values():
+                paths[rendition.name] = output_path
+            else:
+                paths[rendition.name] = rendition.output_path(output_path)
+        
+        srt_path = None
+        try:
+            logger.info(f"Creating {len(renditions)} renditions from {input_path} "
+                        f"(start={start_time}s, duration={duration}s): "
+                        + ', '.join(r.name for r in renditions))
+            
+            info = self.probe.probe(input_path)
+            end_time = min(start_time + duration, info.duration) if duration else info.duration
+            crop_path = self._plan_crop(input_path, start_time, end_time)
+            pipeline = self.build_vertical_pipeline(input_path, resolution=base_size, crop_path=crop_path)
+            pipeline.trim(start_time, duration)
+            
+            if captions:
+                srt_path = output_path.replace('.mp4', '.srt')
+                self._create_srt_file(captions, srt_path)
+                pipeline.subtitles(srt_path, force_style=self.caption_style)
+            
+            if credits_text:
+                pipeline.credits(credits_text)
+            
+            clip_duration = pipeline.expected_duration() or 0
+            profile = self.profile_policy.select()
+            video_count = sum(1 for rendition in renditions if rendition.kind == 'video')
+            with self._writing(*paths.values()) as part_paths:
+                part_paths = dict(zip(paths, part_paths))
+                branches = []
+                for rendition in renditions:
+                    video_filters, audio_filters, output_kwargs = rendition.branch(base_size, clip_duration,
+                                                                                   info.fps)
+                    if rendition.kind == 'video':
+                        output_kwargs = self._limit_threads(profile.apply(output_kwargs), video_count)
+                    branches.append((part_paths[rendition.name], video_filters, audio_filters, output_kwargs))
+                pipeline.run_fanout(branches, progress=progress)
+            
+            logger.info(f"Renditions created successfully: {', '.join(paths.values())}")
+            return paths
+            
+        except BaseException as e:
+            logger.error(f"Error creating renditions: {str(e)}")
+            raise
+        finally:
+            if srt_path and os.path.exists(srt_path):
+                os.remove(srt_path)
+    
+    def output_settings(self, renditions=()):
+        """Every setting that affects an output, for keying cached outputs"""
+        return {
+            'resolution': list(self.output_resolution),
+            'encode': self.rendition.encode_options(),
+            'profiles': self.profile_policy.settings(),
+            'caption_style': self.caption_style,
+            'reframe': self.crop_planner is not None,
+            'renditions': [asdict(r) for r in resolve_renditions(renditions)]
+        }
+    
+    def build_vertical_pipeline(self, input_path, resolution=None, crop_path=None):
+        """
+        Probe the input and return a ClipPipeline cropped and scaled to the output resolution
+        crop_path (see _plan_crop) moves the crop over time, with t=0 at the trim start
+        """
+        info = self.probe.probe(input_path)
+        
+        target_width, target_height = resolution or self.output_resolution
+        pipeline = ClipPipeline(input_path, has_audio=info.has_audio, source_duration=info.duration)
+        width, height, x, y = self._get_crop(info.width, info.height)
+        if crop_path is not None:
+            if crop_path.axis == 'x':
+                x = crop_path.expression()
+            else:
+                y = crop_path.expression()
+        pipeline.crop(width, height, x, y)
+        pipeline.scale(target_width, target_height)
+        return pipeline
+    
+    def _plan_crop(self, input_path, start_time, end_time):
+        """
+        Content-aware crop path for [start_time, end_time) (see services.crop_planner),
+        or None for the static centre crop; analysis failures fall back to the centre
+        """
+        if self.crop_planner is None:
+            return None
+        
+        info = self.probe.probe(input_path)
+        try:
+            return self.crop_planner.plan(input_path, self._get_crop(info.width, info.height),
+                                          start_time, end_time)
+        except Exception as e:
+            logger.warning(f"Crop planning failed for {input_path}, using a centre crop: {str(e)}")
+            return None
+    
+    def _encode_segmented(self, input_path, output_path, start_time, end_time,
+                          captions=None, credits_text=None, crop_path=None, progress=None):
+        """
+        Encode [start_time, end_time) as parallel keyframe-aligned segments
+        Returns False (having done nothing) if the range is too short to split
+        """
+        segments = self.segmented_encoder.plan(input_path, start_time, end_time)
+        if not segments:
+            return False
+        
+        srt_paths = []
+        
+        def make_pipeline(index, segment_start, segment_duration):
+            # Captions and the crop path are relative to start_time; each segment's timeline starts at zero
+            offset = segment_start - start_time
+            segment_crop = crop_path.window(offset, segment_duration) if crop_path else None
+            pipeline = self.build_vertical_pipeline(input_path, crop_path=segment_crop)
+            pipeline.trim(segment_start, segment_duration)
+            
+            segment_captions = [shift_segment(c, -offset, segment_duration) for c in captions or []
+                                if c['end'] > offset and c['start'] < offset + segment_duration]
+            if segment_captions:
+                srt_path = output_path.replace('.mp4', f'.{index}.srt')
+                self._create_srt_file(segment_captions, srt_path)
+                srt_paths.append(srt_path)
+                pipeline.subtitles(srt_path, force_style=self.caption_style)
+            
+            if credits_text:
+                pipeline.credits(credits_text)
+            return pipeline
+        
+        try:
+            self.segmented_encoder.encode(input_path, output_path, make_pipeline, segments,
+                                          self._encode_options(self.probe.probe(input_path)),
+                                          progress=progress)
+        finally:
+            for srt_path in srt_paths:
+                if os.path.exists(srt_path):
+                    os.remove(srt_path)
+        return True
+    
+    def _can_smart_cut(self, input_path, bitrate_tolerance=1.5):
+        """
+        True if the input can be stream-copied as the output: already at the output
+        resolution, within bitrate_tolerance times the rendition's bitrate, and
+        smart-cuttable (see SmartCutter.can_cut)
+        """
+        info = self.probe.probe(input_path)
+        if (info.width, info.height) != self.output_resolution:
+            return False
+        video_bitrate = parse_bitrate(self.rendition.video_bitrate)
+        if video_bitrate and info.bit_rate:
+            budget = video_bitrate * bitrate_tolerance + (parse_bitrate(self.rendition.audio_bitrate) or 0)
+            if info.bit_rate > budget:
+                return False
+        return self.smart_cutter.can_cut(input_path)
+    
+    def _get_crop(self, width, height):
+        """Calculate the centre crop (w, h, x, y) that matches the output aspect ratio"""
+        target_width, target_height = self.output_resolution
+        target_aspect = target_width / target_height
+        source_aspect = width / height
+        
+        if source_aspect > target_aspect:
+            # Source is wider, crop width
+            new_width = int(height * target_aspect)
+            x_offset = (width - new_width) // 2
+            return new_width, height, x_offset, 0
+        else:
+            # Source is taller, crop height
+            new_height = int(width / target_aspect)
+            y_offset = (height - new_height) // 2
+            return width, new_height, 0, y_offset
+    
+    def core_budget(self):
+        """Cores the current job's encodes may use (see encode_cores)"""
+        if callable(self.encode_cores):
+            return self.encode_cores()
+        return self.encode_cores or os.cpu_count() or 1
+    
+    def _encode_options(self, info=None, outputs=1):
+        """
+        Output options for the vertical encode with the encoding profile picked for the current load
+        info (the source's MediaInfo) is given when the output's audio is the
+        source's, unfiltered, so a profile may stream-copy it. Unless the
+        profile sets threads, the core budget is shared between outputs encodes
+        """
+        profile = self.profile_policy.select()
+        copy_audio = info is not None and info.audio_codec in COPYABLE_AUDIO
+        options = profile.apply(self.rendition.encode_options(), copy_audio=copy_audio)
+        return self._limit_threads(options, outputs)
+    
+    def _limit_threads(self, options, outputs=1):
+        """options with x264 threads set to a share of the core budget, unless already set"""
+        if 'threads' not in options:
+            options = dict(options, threads=max(1, self.core_budget() // outputs))
+        return options
+    
+    @contextlib.contextmanager
+    def _writing(self, *paths):
+        """
+        Yield a temporary name for each output path, moved into place once the body succeeds
+        Outputs are never written in place: a published file may be a hard link
+        to an output cache entry, which an FFmpeg overwrite would change too
+        """
+        part_paths = [_part_path(path) for path in paths]
+        try:
+            yield part_paths
+        except BaseException:
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            raise
+        for part_path, path in zip(part_paths, paths):
+            os.replace(part_path, path)
+    
+    def _output_with_audio(self, input_path, source, video, output_path):
+        """Output node for a filtered video plus the source's unfiltered audio (if any)"""
+        info = self.probe.probe(input_path)
+        streams = [video, source.audio] if info.has_audio else [video]
+        return ffmpeg.output(*streams, output_path, **self._encode_options(info))
+    
+    def trim_video(self, input_path, output_path, duration, start_time=0, mode='copy'):
         """
-        Trim video to specified duration (in seconds)
+        Trim video to specified duration (in seconds) from start_time
+        mode='copy' stream-copies (cuts snap to keyframes); mode='smart' is
+        frame-accurate, re-encoding only the partial GOPs at either end
         """
         try:
-            logger.info(f"Trimming video to {duration} seconds")
+            logger.info(f"Trimming video to {duration} seconds from {start_time}s ({mode})")
             
-            stream = ffmpeg.input(input_path, ss=0, t=duration)
-            stream = ffmpeg.output(stream, output_path,
-                                   vcodec='copy',
-                                   acodec='copy')
-            ffmpeg.run(stream, overwrite_output=True, quiet=True)
+            with self._writing(output_path) as (part_path,):
+                if mode == 'smart' and self.smart_cutter.can_cut(input_path):
+                    self.smart_cutter.cut(input_path, part_path, start_time, start_time + duration)
+                else:
+                    stream = ffmpeg.input(input_path, ss=start_time, t=duration)
+                    stream = ffmpeg.output(stream, part_path,
+                                           vcodec='copy',
+                                           acodec='copy',
+                                           movflags='+faststart')
+                    run_ffmpeg(stream)
             
             logger.info(f"Video trimmed successfully: {output_path}")
             return output_path
@@ -90,13 +436,11 @@ class VideoProcessor:
             self._create_srt_file(captions, srt_path)
             
             # Add subtitles to video
-            stream = ffmpeg.input(input_path)
-            stream = ffmpeg.filter(stream, 'subtitles', srt_path,
-                                   force_style='FontSize=24,PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline=2')
-            stream = ffmpeg.output(stream, output_path,
-                                   vcodec='libx264',
-                                   acodec='aac')
-            ffmpeg.run(stream, overwrite_output=True, quiet=True)
+            source = ffmpeg.input(input_path)
+            stream = ffmpeg.filter(source, 'subtitles', srt_path,
+                                   force_style=self.caption_style)
+            with self._writing(output_path) as (part_path,):
+                run_ffmpeg(self._output_with_audio(input_path, source, stream, part_path))
             
             # Clean up SRT file
             os.remove(srt_path)
@@ -123,8 +467,8 @@ class VideoProcessor:
                 f"box=1:boxcolor=black@0.5:boxborderw=5"
             )
             
-            stream = ffmpeg.input(input_path)
-            stream = ffmpeg.filter(stream, 'drawtext', 
+            source = ffmpeg.input(input_path)
+            stream = ffmpeg.filter(source, 'drawtext', 
                                    text=credits_text,
                                    fontsize=20,
                                    fontcolor='white',
@@ -132,10 +476,8 @@ class VideoProcessor:
                                    y='h-60',
                                    box=1,
                                    boxcolor='black@0.5')
-            stream = ffmpeg.output(stream, output_path,
-                                   vcodec='libx264',
-                                   acodec='copy')
-            ffmpeg.run(stream, overwrite_output=True, quiet=True)
+            with self._writing(output_path) as (part_path,):
+                run_ffmpeg(self._output_with_audio(input_path, source, stream, part_path))
             
             logger.info("Credits overlay added successfully")
             return output_path
@@ -161,3 +503,9 @@ class VideoProcessor:
         secs = int(seconds % 60)
         millis = int((seconds % 1) * 1000)
         return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+
+
+def _part_path(path):
+    """Temporary name an output is written under (see VideoProcessor._writing)"""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.part.{os.getpid()}.{threading.get_ident()}{ext}"
@@ -0,0 +1,45 @@
+import pytest
+
+from services.admission import PRIORITY_SHORT, AdmissionController
+from services.job_store import MemoryJobStore, SQLiteJobStore
+
+
+@pytest.fixture
+def admission(tmp_path):
+    return AdmissionController(str(tmp_path / 'slots'), max_slots=4, reserved_slots=1, tenant_share=0.5,
+                               max_load=float('inf'), min_free_memory=0, default_duration=30)
+
+
+def test_idle_slots_do_not_shorten_retry_after(admission):
+    for _ in range(20):
+        admission.acquire(PRIORITY_SHORT).release(record=False)
+    assert admission.retry_after() == 8  # default_duration over the 4 slots
+
+
+def test_full_tenants(admission):
+    slots = [admission.acquire(PRIORITY_SHORT) for _ in range(3)]
+    slots[0].assign('a')
+    assert admission.full_tenants() == set()
+    slots[1].assign('a')
+    slots[2].assign(None)
+    assert admission.full_tenants() == {'a'}
+    slots[1].release()
+    assert admission.full_tenants() == set()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / 'jobs.db'))
+
+
+def test_claim_skips_excluded_tenants(store):
+    store.enqueue('a1', 'clip', {}, tenant='a')
+    store.enqueue('n1', 'clip', {})
+    store.enqueue('b1', 'clip', {}, tenant='b')
+
+    assert store.claim('w', 30, exclude_tenants={'a'})['job_id'] == 'n1'
+    assert store.claim('w', 30, exclude_tenants={'a'})['job_id'] == 'b1'
+    assert store.claim('w', 30, exclude_tenants={'a'}) is None
+    assert store.claim('w', 30)['job_id'] == 'a1'
@@ -0,0 +1,32 @@
+import hashlib
+import threading
+
+from services.analysis_index import AnalysisIndex
+
+
+def test_concurrent_content_hashes_of_one_file(tmp_path, monkeypatch):
+    video_path = tmp_path / 'upload.mp4'
+    video_path.write_bytes(b'video' * 100000)
+    expected = hashlib.sha256(video_path.read_bytes()).hexdigest()
+    index = AnalysisIndex(str(tmp_path / 'index'))
+    # Every thread misses the remembered hash and writes the hash file itself
+    monkeypatch.setattr('services.analysis_index.remembered_content_hash', lambda key: None)
+
+    barrier = threading.Barrier(16)
+    results, errors = [], []
+
+    def hash_upload():
+        barrier.wait()
+        try:
+            results.append(index.content_hash(str(video_path)))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=hash_upload) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert results == [expected] * 16
+    assert AnalysisIndex(str(tmp_path / 'index')).content_hash(str(video_path)) == expected
@@ -0,0 +1,15 @@
+from services.encoding_profiles import ProfilePolicy
+
+
+def test_calibrated_policy_treats_speed_as_node_throughput():
+    depth = {'value': 0}
+    calibration = {'quality': {'speed': 1.0}, 'balanced': {'speed': 2.0},
+                   'fast': {'speed': 4.0}, 'fastest': {'speed': 8.0}}
+    policy = ProfilePolicy(queue_depth=lambda: depth['value'], calibration=calibration,
+                           clip_seconds=60, target_wait=300)
+
+    picks = {}
+    for depth['value'] in (0, 4, 5, 9, 10, 40):
+        picks[depth['value']] = policy.select().name
+    # (depth + 1) clips of 60 s must clear within 300 s at the node's measured speed
+    assert picks == {0: 'quality', 4: 'quality', 5: 'balanced', 9: 'balanced', 10: 'fast', 40: 'fastest'}
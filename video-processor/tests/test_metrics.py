@@ -0,0 +1,116 @@
+import os
+import time
+
+import pytest
+
+from services import metrics
+from services.metrics import Counter, Gauge, Histogram, Tracer, render, share_metrics, stage
+
+
+@pytest.fixture
+def shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    monkeypatch.setattr(metrics, '_shared', {'directory': None, 'pid': None})
+    monkeypatch.setattr(metrics, '_peers', {'read_at': None, 'snapshots': []})
+    monkeypatch.setattr(metrics, '_PEERS_TTL', 0)
+    return str(tmp_path / 'metrics')
+
+
+def _in_child(function):
+    """Run function in a forked process and wait for it"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_counters_and_histograms_sum_across_processes(shared):
+    requests = Counter('requests_total', 'Requests', ['path'])
+    latency = Histogram('latency_seconds', 'Latency', buckets=(1, 10))
+    requests.inc(path='/a')
+    share_metrics(shared, interval=None, clear=True)
+
+    def worker():
+        share_metrics(shared, interval=None)
+        requests.inc(2, path='/a')
+        latency.observe(5)
+        metrics.save_metrics()
+    _in_child(worker)
+    _in_child(worker)
+
+    # Inherited counts are only in the parent's file; the exited workers' counts stay
+    text = render()
+    assert 'requests_total{path="/a"} 5' in text
+    assert 'latency_seconds_bucket{le="10"} 2' in text
+    assert 'latency_seconds_sum 10.0' in text
+
+
+def test_gauges_merge_by_mode(shared):
+    running = Gauge('running', 'Running', multiprocess_mode='sum')
+    startup = Gauge('startup', 'Startup', multiprocess_mode='max')
+    depth = Gauge('depth', 'Depth')
+    running.set(1)
+    startup.set(0.5)
+    depth.set_function(lambda: 3)
+    share_metrics(shared, interval=None, clear=True)
+
+    read, write = os.pipe()
+
+    def worker():
+        share_metrics(shared, interval=None)
+        running.set(2)
+        startup.set(0.25)
+        depth.set_function(lambda: 7)
+        metrics.save_metrics()
+        os.read(read, 1)  # stay alive until the parent has rendered
+    pid = os.fork()
+    if pid == 0:
+        try:
+            worker()
+        finally:
+            os._exit(0)
+    try:
+        deadline = time.time() + 5
+        while len(os.listdir(shared)) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        text = render()
+        assert 'running 3' in text
+        assert 'startup 0.5' in text
+        assert 'depth 3' in text
+    finally:
+        os.write(write, b'x')
+        os.waitpid(pid, 0)
+
+    # An exited process's gauges no longer count
+    assert 'running 1' in render()
+
+
+def test_running_trace_is_visible_to_other_processes(tmp_path):
+    trace_dir = str(tmp_path / 'traces')
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            tracer = Tracer(trace_dir, save_interval=0)
+            with tracer.trace('clip-1', kind='test'):
+                with stage('probe'):
+                    pass
+                with stage('encode'):
+                    os.write(write, b'x')
+                    time.sleep(0.5)
+        finally:
+            os._exit(0)
+    os.read(read, 1)
+    running = Tracer(trace_dir).get('clip-1')
+    os.waitpid(pid, 0)
+    finished = Tracer(trace_dir).get('clip-1')
+
+    assert running['finishedAt'] is None
+    assert [(span['name'], span['duration'] is None) for span in running['spans']] == [
+        ('probe', False), ('encode', True)]
+    assert finished['finishedAt'] is not None
+    assert all(span['duration'] is not None for span in finished['spans'])
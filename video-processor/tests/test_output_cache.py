@@ -0,0 +1,89 @@
+import io
+import os
+import time
+
+import pytest
+
+from services.media_probe import MediaInfo
+from services.output_cache import OutputCache, evict_lru
+from services.pipeline import ClipPipeline
+from services.upload_store import UploadStore
+from services.video_processor import VideoProcessor
+
+
+class StubProbe:
+    """MediaProbe stand-in for a landscape source (never smart-cut, too short to segment)"""
+
+    def probe(self, path, cached=True):
+        return MediaInfo(duration=60.0, width=1920, height=1080, fps=30.0,
+                         video_codec='h264', pix_fmt='yuv420p', has_audio=True)
+
+
+@pytest.fixture
+def encodes(monkeypatch):
+    """Each encode writes the next item to its output like ffmpeg -y (truncating); exceptions are raised"""
+    pending = []
+
+    def run(self, output_path, progress=None, **output_kwargs):
+        outcome = pending.pop(0)
+        with open(output_path, 'wb') as f:
+            f.write(b'partial' if isinstance(outcome, Exception) else outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return output_path
+    monkeypatch.setattr(ClipPipeline, 'run', run)
+    return pending
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_reencoding_a_cached_clip_id_leaves_the_entry_unchanged(tmp_path, encodes):
+    cache = OutputCache(str(tmp_path / 'cache'))
+    processor = VideoProcessor(probe=StubProbe(), reframe=False)
+    output_path = str(tmp_path / 'clip.mp4')
+
+    encodes.append(b'first')
+    processor.create_vertical_clip('source.mp4', output_path, duration=30)
+    cache.store('first-key', output_path, {'video': output_path})
+
+    # The same clipId again with other parameters: a new output, the cached one untouched
+    encodes.append(b'second')
+    processor.create_vertical_clip('source.mp4', output_path, duration=20)
+    assert _read(output_path) == b'second'
+    assert _read(cache.restore('first-key', str(tmp_path / 'other.mp4'))['video']) == b'first'
+
+    # A re-encode failing partway leaves both the published output and the entry as they were
+    cache.restore('first-key', output_path)
+    encodes.append(RuntimeError('encode failed'))
+    with pytest.raises(RuntimeError):
+        processor.create_vertical_clip('source.mp4', output_path, duration=20)
+    assert _read(output_path) == b'first'
+    assert _read(cache.restore('first-key', str(tmp_path / 'another.mp4'))['video']) == b'first'
+    assert not [name for name in os.listdir(tmp_path) if '.part.' in name]
+
+
+def test_upload_eviction_keeps_uploads_in_progress_and_job_inputs(tmp_path):
+    store = UploadStore(str(tmp_path), abandon_after=3600)
+    receiving = store.create(10)['uploadId']
+    store.create(10)  # abandoned: idle for longer than abandon_after
+    queued, finished = (store.create(4)['uploadId'] for _ in range(2))
+    for upload_id in (queued, finished):
+        store.append(upload_id, io.BytesIO(b'data'), 0)
+    with open(tmp_path / 'clip_original.mp4', 'wb') as f:
+        f.write(b'multipart')
+    hours_ago = time.time() - 2 * 3600
+    for name in os.listdir(tmp_path):
+        if not name.startswith(receiving):
+            os.utime(tmp_path / name, (hours_ago, hours_ago))
+
+    in_use = {store.eviction_unit(os.path.basename(store.path(queued)))}
+    evict_lru(str(tmp_path), 0, min_age=0, group=store.eviction_unit,
+              keep=lambda unit: unit in in_use or store.in_progress(unit))
+
+    remaining = {store.eviction_unit(name) for name in os.listdir(tmp_path)}
+    assert remaining == {receiving, queued}
+    assert store.status(receiving)['offset'] == 0
+    assert os.path.exists(store.path(queued))
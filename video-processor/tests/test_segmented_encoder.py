@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from services.admission import PRIORITY_SHORT, AdmissionController
+from services.media_probe import MediaInfo
+from services.segmented_encoder import plan_segments
+from services.video_processor import VideoProcessor
+
+
+class StubProbe:
+    """MediaProbe stand-in for a ten-minute source with a keyframe every two seconds"""
+
+    def probe(self, path, cached=True):
+        return MediaInfo(duration=600.0, width=1920, height=1080, fps=30.0,
+                         video_codec='h264', pix_fmt='yuv420p', has_audio=True)
+
+    def keyframes(self, path):
+        return [float(t) for t in range(0, 600, 2)]
+
+
+@pytest.fixture
+def node(tmp_path, monkeypatch):
+    """An 8-core node with app.py's default admission settings and core budget"""
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    admission = AdmissionController(str(tmp_path / 'slots'), max_load=float('inf'), min_free_memory=0)
+    processor = VideoProcessor(probe=StubProbe(), encode_cores=admission.core_budget, reframe=False)
+    return admission, processor
+
+
+def test_long_range_is_segmented_under_the_default_budget(node):
+    admission, processor = node
+    with admission.acquire(PRIORITY_SHORT):
+        segments = processor.segmented_encoder.plan('source.mp4', 0, 600)
+        options = processor._encode_options()
+    assert segments and len(segments) > 1
+    assert options['threads'] == 8
+
+
+def test_full_node_encodes_with_one_slots_share(node):
+    admission, processor = node
+    slots = [admission.acquire(PRIORITY_SHORT) for _ in range(admission.max_slots - admission.reserved_slots)]
+    slots.append(admission.acquire(0))
+    try:
+        assert processor.segmented_encoder.plan('source.mp4', 0, 600) is None
+        assert processor._encode_options()['threads'] == admission.cores_per_slot()
+    finally:
+        for slot in slots:
+            slot.release()
+
+
+def test_plan_segments_splits_at_keyframes():
+    assert plan_segments([0, 50, 100, 130, 200, 260], 0, 300, 100) == [(0, 100), (100, 200), (200, 300)]
@@ -0,0 +1,107 @@
+import io
+from services.caption_generator import CaptionGenerator
+from services.media_probe import MediaInfo
+from services.transcription import FakeTranscriptionBackend, merge_chunk_segments, plan_chunks
+
+
+class StubProbe:
+    """MediaProbe stand-in for a source of the given duration"""
+
+    def __init__(self, duration, has_audio=True):
+        self.info = MediaInfo(duration=duration, width=1920, height=1080, fps=30.0,
+                              video_codec='h264', pix_fmt='yuv420p', has_audio=has_audio)
+
+    def probe(self, path, cached=True):
+        return self.info
+
+
+def _generator(monkeypatch, duration, silences, max_chunk_seconds, chunk_padding=2.0, segment_length=3.0):
+    """CaptionGenerator over a fake source: no FFmpeg, no transcription service"""
+    backend = FakeTranscriptionBackend(segment_length=segment_length)
+    generator = CaptionGenerator(backend=backend, probe=StubProbe(duration), max_parallel=1,
+                                 max_chunk_seconds=max_chunk_seconds, chunk_padding=chunk_padding)
+    monkeypatch.setattr('services.caption_generator.detect_silences',
+                        lambda video_path, start_time, duration: silences)
+    monkeypatch.setattr(generator, '_extract_audio',
+                        lambda video_path, start_time=0, duration=None: io.BytesIO(b'audio'))
+    return generator, backend
+
+
+def test_plan_chunks_short_range_is_one_chunk():
+    assert plan_chunks(300.0, [(100.0, 101.0)], max_chunk=600.0) == [(0.0, 300.0)]
+
+
+def test_plan_chunks_hard_cuts_without_silences():
+    assert plan_chunks(1300.0, [], max_chunk=600.0) == [(0.0, 600.0), (600.0, 1200.0), (1200.0, 1300.0)]
+
+
+def test_plan_chunks_splits_in_the_latest_silence_of_the_second_half():
+    # 200-201 is in the first half of the chunk; 400-402 and 550-552 are both in the second
+    chunks = plan_chunks(1000.0, [(200.0, 201.0), (400.0, 402.0), (550.0, 552.0)], max_chunk=600.0)
+    assert chunks == [(0.0, 551.0), (551.0, 1000.0)]
+
+
+def test_plan_chunks_ignores_silences_past_the_limit():
+    chunks = plan_chunks(1000.0, [(650.0, 660.0)], max_chunk=600.0)
+    assert chunks == [(0.0, 600.0), (600.0, 1000.0)]
+
+
+def test_merge_keeps_a_segment_only_in_the_chunk_holding_its_midpoint():
+    # Two chunks split at 10s, each transcribed with 2s of padding on the inner side
+    first = (0.0, 10.0, 0.0, [{'start': 0.0, 'end': 5.0, 'text': 'a'},
+                              {'start': 8.0, 'end': 11.0, 'text': 'b'}])  # midpoint 9.5: first chunk
+    second = (10.0, 20.0, 8.0, [{'start': 0.0, 'end': 3.0, 'text': 'b'},  # midpoint 9.5: dropped
+                                {'start': 3.0, 'end': 12.0, 'text': 'c'}])
+    merged = merge_chunk_segments([second, first])
+    assert [(s['start'], s['end'], s['text']) for s in merged] == [(0.0, 5.0, 'a'), (8.0, 11.0, 'b'),
+                                                                   (11.0, 20.0, 'c')]
+
+
+def test_merge_shifts_words_with_their_segment():
+    segment = {'start': 3.0, 'end': 4.0, 'text': 'hi', 'words': [{'start': 3.0, 'end': 3.5, 'word': 'hi'}]}
+    merged = merge_chunk_segments([(10.0, 20.0, 8.0, [segment])])
+    assert merged[0]['words'] == [{'start': 11.0, 'end': 11.5, 'word': 'hi'}]
+
+
+def test_generate_captions_transcribes_silence_aligned_padded_chunks(monkeypatch):
+    generator, backend = _generator(monkeypatch, duration=100.0, silences=[(35.0, 37.0), (70.0, 72.0)],
+                                    max_chunk_seconds=40)
+
+    generator.generate_captions('source.mp4')
+
+    # Boundaries at the silence midpoints (36s and 71s), audio padded by 2s on inner sides
+    assert [call['duration'] for call in backend.calls] == [38.0, 39.0, 31.0]
+    assert [call['filename'] for call in backend.calls] == ['chunk_0.flac', 'chunk_36.flac', 'chunk_71.flac']
+
+
+def test_generate_captions_drops_segments_duplicated_in_the_padding(monkeypatch):
+    generator, _ = _generator(monkeypatch, duration=100.0, silences=[(35.0, 37.0), (70.0, 72.0)],
+                              max_chunk_seconds=40)
+
+    captions = generator.generate_captions('source.mp4')
+
+    # Chunk 1 transcribes 0-38s, chunk 2 34-73s, chunk 3 69-100s; the 3s fake
+    # segments of each chunk start at its audio offset
+    assert [(c['start'], c['end']) for c in captions] == (
+        [(float(t), float(t + 3)) for t in range(0, 36, 3)]  # midpoints up to 34.5s
+        + [(float(t), float(t + 3)) for t in range(37, 70, 3)]  # 37-40s (midpoint 38.5) to 67-70s
+        + [(float(t), min(100.0, float(t + 3))) for t in range(72, 100, 3)])
+    assert all(a['end'] <= b['start'] for a, b in zip(captions, captions[1:]))
+
+
+def test_generate_captions_range_is_relative_to_start_time(monkeypatch):
+    generator, backend = _generator(monkeypatch, duration=100.0, silences=[], max_chunk_seconds=600)
+
+    captions = generator.generate_captions('source.mp4', start_time=90.0, duration=30.0)
+
+    # Only the 10s left in the source are transcribed, as one chunk
+    assert [call['duration'] for call in backend.calls] == [10.0]
+    assert captions[0]['start'] == 0.0 and captions[-1]['end'] == 10.0
+
+
+def test_generate_captions_without_audio_is_empty(monkeypatch):
+    generator, backend = _generator(monkeypatch, duration=100.0, silences=[], max_chunk_seconds=40)
+    generator.probe = StubProbe(100.0, has_audio=False)
+
+    assert generator.generate_captions('source.mp4') == []
+    assert backend.calls == []